@@ -0,0 +1,475 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# BENCHMARKS
+#
+# Run with: python Benchmark.py [--only SECTION] [--json results.json]
+#                               [--baseline baseline.json] [--tolerance 0.2]
+#
+# Everything runs against the emulated device in VMeterFake.py.
+# --json writes the metrics as JSON; --baseline compares them against a
+# file written earlier with --json and exits with status 1 if any metric
+# got worse by more than the tolerance (a fraction).
+#
+
+import os
+import sys
+import time
+import json
+import argparse
+
+from VMeter import VMeter, Event, LedFrame, NUM_LEDS, LED_STATUS
+from VMeter import IntervalThread, AdaptiveThread
+from VMeterFake import FakeBackend
+from VMeterPool import VMeterPool, find_vmeters
+
+class Results(object):
+    """
+    Collects named metrics and prints them as they come in.
+    """
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, value, unit, higher_is_better=True):
+        self.metrics[name] = {"value": value,
+                              "unit": unit,
+                              "better": "higher" if higher_is_better else "lower"}
+        print "%-40s %14.2f %s" % (name, value, unit)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+def cpu_time():
+    """
+    User + system CPU seconds used by this process (all threads).
+    """
+    t = os.times()
+    return t[0] + t[1]
+
+def start_reader(function, adaptive):
+    if adaptive:
+        thread = AdaptiveThread(function, min_interval=.001, max_interval=.02)
+    else:
+        thread = IntervalThread(function, interval=.001)
+    thread.start()
+    return thread
+
+def bench_reader_idle(adaptive, duration=3.0):
+    """
+    Runs a reader loop that never sees any events.
+    Returns (CPU seconds per wall second, wakeups per second).
+    """
+    calls = [0]
+
+    def idle():
+        calls[0] += 1
+        return 0
+
+    cpu_start = cpu_time()
+    wall_start = time.time()
+    thread = start_reader(idle, adaptive)
+    time.sleep(duration)
+    thread.stop()
+    thread.join()
+    wall = time.time() - wall_start
+
+    return (cpu_time() - cpu_start) / wall, calls[0] / wall
+
+def bench_reader_latency(adaptive, trials=20, idle=.25):
+    """
+    Lets the reader loop go idle, then posts a single event and measures
+    how long it takes to be picked up.
+    Returns the worst-case first-event latency in seconds.
+    """
+    pending = [None]
+    latencies = []
+
+    def poll():
+        posted = pending[0]
+        if posted is None:
+            return 0
+        latencies.append(time.time() - posted)
+        pending[0] = None
+        return 1
+
+    thread = start_reader(poll, adaptive)
+    for i in range(trials):
+        time.sleep(idle)
+        pending[0] = time.time()
+        while pending[0] is not None:
+            time.sleep(.0005)
+    thread.stop()
+    thread.join()
+
+    return max(latencies)
+
+def reader_loop(results):
+    """
+    Idle CPU, wakeups and worst first-event latency of the reader loops.
+    """
+    for name, adaptive in (("fixed", False), ("adaptive", True)):
+        cpu, wakeups = bench_reader_idle(adaptive)
+        latency = bench_reader_latency(adaptive)
+        results.add("reader.%s.idle_cpu" % name, cpu * 100.0, "%", False)
+        results.add("reader.%s.idle_wakeups" % name, wakeups, "/s", False)
+        results.add("reader.%s.first_event_latency" % name,
+                    latency * 1000.0, "ms", False)
+
+def fake_vmeter():
+    """
+    A VMeter connected to an emulated device, with its reader thread
+    stopped so dispatch() can be driven directly.
+    """
+    backend = FakeBackend()
+    v = VMeter(backend=backend, reader=False)
+    # the settings reply
+    v.dispatch()
+    return v, backend.devices[0]
+
+def legacy_handle(v, ctrl, data):
+    """
+    The if/elif version of VMeter.handle() that the dispatch table replaced,
+    kept here for comparison.
+    """
+    handlers = None
+    no_arg = False
+
+    try:
+        if ctrl is v.ctrl_out_touch_pos:
+            handlers = v.handlers[Event.TOUCH]
+        elif ctrl is v.ctrl_out_pressure:
+            handlers = v.handlers[Event.PRESSURE]
+        elif ctrl is v.ctrl_out_on_off:
+            no_arg = True
+            if data is 0:
+                handlers = v.handlers[Event.TOUCH_END]
+            else:
+                handlers = v.handlers[Event.TOUCH_START]
+
+        if handlers is not None:
+            if no_arg:
+                for f in handlers:
+                    f()
+            else:
+                for f in handlers:
+                    f(data)
+    except KeyError:
+        pass
+
+def bench_handle(handle, messages, repeat=20):
+    """
+    Returns messages/s through handle(ctrl, data).
+    """
+    start = time.time()
+    for i in xrange(repeat):
+        for ctrl, data in messages:
+            handle(ctrl, data)
+    return len(messages) * repeat / (time.time() - start)
+
+def handle_table(results):
+    """
+    handle() messages/s, if/elif chain against the dispatch table.
+    """
+    v, device = fake_vmeter()
+    v.on_touch(lambda position: None)
+    v.on_touch_start(lambda: None)
+
+    # a swipe: on, position + pressure stream (pressure has no handler),
+    # off, and some unrelated controllers
+    messages = [(v.ctrl_out_on_off, 127)]
+    for i in range(128):
+        messages.append((v.ctrl_out_touch_pos, i))
+        messages.append((v.ctrl_out_pressure, i))
+        messages.append((i % 16 + 30, i))
+    messages.append((v.ctrl_out_on_off, 0))
+
+    results.add("handle.legacy", bench_handle(
+        lambda ctrl, data: legacy_handle(v, ctrl, data), messages), "msg/s")
+    results.add("handle.table", bench_handle(v.handle, messages), "msg/s")
+    v.close()
+
+def legacy_bar(position, size):
+    """
+    The list-based draw_bar + send_array packing that LedFrame replaced,
+    kept here for comparison.
+    """
+    array = [0]*NUM_LEDS
+    cursor_pos = int(float(position) / 127.0 * 37.0)
+    lower_limit = max(cursor_pos - size / 2, 0)
+    upper_limit = min(cursor_pos + size / 2, NUM_LEDS-1)
+    i = lower_limit
+    while i <= upper_limit:
+        array[i] = 1
+        i = i + 1
+
+    bytes = [0,0,0,0,0,0]
+    bytes[0] =  array[0] |  array[1]<<1 |  array[2]<<2 |  array[3]<<3 |  array[4]<<4 |  array[5]<<5 |  array[6]<<6
+    bytes[1] =  array[7] |  array[8]<<1 |  array[9]<<2 | array[10]<<3 | array[11]<<4 | array[12]<<5 | array[13]<<6
+    bytes[2] = array[14] | array[15]<<1 | array[16]<<2 | array[17]<<3 | array[18]<<4 | array[19]<<5 | array[20]<<6
+    bytes[3] = array[21] | array[22]<<1 | array[23]<<2 | array[24]<<3 | array[25]<<4 | array[26]<<5 | array[27]<<6
+    bytes[4] = array[28] | array[29]<<1 | array[30]<<2 | array[31]<<3 | array[32]<<4 | array[33]<<5 | array[34]<<6
+    bytes[5] = array[35] | array[36]<<1 | array[37]<<2
+    return bytes
+
+def bench_frames(build, repeat=200):
+    """
+    Returns frames/s for build(position, size) over a full sweep.
+    """
+    start = time.time()
+    for i in xrange(repeat):
+        for position in xrange(128):
+            build(position, 5)
+    return 128 * repeat / (time.time() - start)
+
+def led_packing(results):
+    """
+    draw_bar frame packing, list-based against LedFrame masks.
+    """
+    results.add("pack.list", bench_frames(legacy_bar), "frames/s")
+    results.add("pack.mask", bench_frames(
+        lambda position, size: LedFrame.pack(LedFrame.bar(position, size))),
+        "frames/s")
+
+def dispatch_throughput(results, swipes=200):
+    """
+    Messages/s through dispatch() for swipes with touch, pressure and
+    on/off output enabled, reading one event per Read() and in batches.
+    """
+    v, device = fake_vmeter()
+    v.set_output_on_off(True)
+    v.set_output_pressure(True)
+    v.on_touch(lambda position: None)
+    v.on_pressure(lambda pressure: None)
+    v.on_touch_start(lambda: None)
+    v.on_touch_end(lambda: None)
+
+    for batch_size in (1, 64):
+        v.batch_size = batch_size
+        total = 0
+        elapsed = 0.0
+        for i in xrange(swipes):
+            device.swipe(0, 127)
+            start = time.time()
+            while device.pending:
+                total += v.dispatch()
+            elapsed += time.time() - start
+        results.add("dispatch.batch_%d" % batch_size, total / elapsed, "msg/s")
+    v.close()
+
+def led_output(results, frames=20000):
+    """
+    Frames/s and MIDI messages per frame for the LED output calls.
+    """
+    v, device = fake_vmeter()
+    arrays = [LedFrame.to_array(LedFrame.bar(p, 5)) for p in range(0, 128, 8)]
+
+    calls = (("send_array", lambda i: v.send_array(arrays[i % len(arrays)])),
+             ("send_column", lambda i: v.send_column(i % 128)),
+             ("draw_bar", lambda i: v.draw_bar(i % 128, 5)))
+
+    for name, send in calls:
+        before = device.messages
+        start = time.time()
+        for i in xrange(frames):
+            send(i)
+        elapsed = time.time() - start
+        results.add("output.%s" % name, frames / elapsed, "frames/s")
+        results.add("output.%s.messages" % name,
+                    (device.messages - before) / float(frames), "msg/frame", False)
+    v.close()
+
+def touch_to_led(results, touches=300):
+    """
+    Latency from a touch CC arriving at the input to the LED frame drawn
+    by an on_touch handler reaching the device, with the reader thread
+    running.
+    """
+    backend = FakeBackend(real_time=True)
+    device = backend.devices[0]
+    v = VMeter(backend=backend)
+    v.on_touch(lambda position: v.draw_bar(position, 3))
+
+    latencies = []
+    injected = [None]
+
+    def listener(status, data1, data2):
+        # frames that are columns go out as a single column message
+        led_output = (status in LED_STATUS or status == device.status() and
+                      data1 == device.ctrl_in_light)
+        if led_output and injected[0] is not None:
+            latencies.append(time.time() - injected[0])
+            injected[0] = None
+
+    device.listener = listener
+    for i in xrange(touches):
+        injected[0] = time.time()
+        # alternate ends of the strip so every touch changes the frame
+        device.touch((i % 2) * 127)
+        deadline = time.time() + 1.0
+        while injected[0] is not None and time.time() < deadline:
+            time.sleep(.0002)
+        time.sleep(.002)
+    v.close()
+
+    results.add("latency.touch_to_led.p50", percentile(latencies, .5) * 1000.0,
+                "ms", False)
+    results.add("latency.touch_to_led.p99", percentile(latencies, .99) * 1000.0,
+                "ms", False)
+
+def pool_scaling(results, duration=2.0):
+    """
+    Idle CPU with 1 and 16 devices, one reader thread per VMeter against
+    a single VMeterPool reader.
+    """
+    for count in (1, 16):
+        for name in ("separate", "pool"):
+            backend = FakeBackend(count)
+            cpu_start = cpu_time()
+            wall_start = time.time()
+            if name == "pool":
+                pool = VMeterPool(backend=backend)
+                time.sleep(duration)
+                pool.close()
+            else:
+                vmeters = [VMeter(i, o, backend=backend)
+                           for n, i, o in find_vmeters(backend)]
+                time.sleep(duration)
+                for v in vmeters:
+                    v.close()
+            cpu = (cpu_time() - cpu_start) / (time.time() - wall_start)
+            results.add("pool.%s.%d_devices.idle_cpu" % (name, count),
+                        cpu * 100.0, "%", False)
+
+def level_rendering(results, frames=100000):
+    """
+    Level-meter frames/s: one draw_bar-style frame per level in Python,
+    against VMeterRender's vectorized column + peak LED rendering, for one
+    channel and for 16 channels at once.
+    """
+    try:
+        import numpy
+        from VMeterRender import LevelRenderer
+    except ImportError:
+        print "render: skipped, numpy is not installed"
+        return
+
+    levels = [(i * 7) % 128 for i in xrange(frames)]
+    start = time.time()
+    for level in levels:
+        legacy_bar(level, 5)
+    results.add("render.list", frames / (time.time() - start), "frames/s")
+
+    block = numpy.array(levels)
+    renderer = LevelRenderer()
+    start = time.time()
+    for offset in xrange(0, frames, 1024):
+        renderer.render(block[offset:offset + 1024])
+    results.add("render.numpy", frames / (time.time() - start), "frames/s")
+
+    channels = numpy.tile(block, (16, 1))
+    renderer = LevelRenderer()
+    start = time.time()
+    for offset in xrange(0, frames, 1024):
+        renderer.render(channels[:, offset:offset + 1024])
+    results.add("render.numpy.16_channels", 16 * frames / (time.time() - start),
+                "frames/s")
+
+def dithering(results, duration=1.0):
+    """
+    Sustained refresh rate of a GrayFramebuffer showing a gradient at
+    1000 frames/s, and the messages each dithered frame costs.
+    """
+    from VMeterDither import GrayFramebuffer, SIGMA_DELTA, PWM
+
+    for name, mode in (("sigma_delta", SIGMA_DELTA), ("pwm", PWM)):
+        v = VMeter(backend=FakeBackend(real_time=True), reader=False)
+        fb = GrayFramebuffer(v, rate=1000, mode=mode)
+        fb.set([i * 127 // (NUM_LEDS - 1) for i in range(NUM_LEDS)])
+        messages = v.messages_sent
+        fb.start()
+        time.sleep(duration)
+        fb.stop()
+        fb.join()
+        results.add("dither.%s.refresh_rate" % name, fb.refresh_rate(),
+                    "frames/s")
+        results.add("dither.%s.messages" % name,
+                    (v.messages_sent - messages) / float(max(fb.frames, 1)),
+                    "msg/frame", False)
+        v.close()
+
+SECTIONS = (("reader", reader_loop),
+            ("handle", handle_table),
+            ("pack", led_packing),
+            ("dispatch", dispatch_throughput),
+            ("output", led_output),
+            ("latency", touch_to_led),
+            ("pool", pool_scaling),
+            ("render", level_rendering),
+            ("dither", dithering))
+
+def compare(metrics, baseline, tolerance):
+    """
+    Prints each metric next to its baseline value.
+    Returns the names of metrics that got worse by more than tolerance.
+    """
+    regressions = []
+    print
+    print "Compared to baseline (tolerance %.0f%%)" % (tolerance * 100.0)
+    for name in sorted(metrics):
+        if name not in baseline:
+            continue
+        old = baseline[name]["value"]
+        new = metrics[name]["value"]
+        if not old:
+            continue
+        change = (new - old) / float(old)
+        if metrics[name]["better"] == "lower":
+            change = -change
+        flag = ""
+        if change < -tolerance:
+            flag = "REGRESSION"
+            regressions.append(name)
+        print "%-40s %14.2f %14.2f %+7.1f%% %s" % (name, old, new,
+                                                    change * 100.0, flag)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="VMeter.py benchmarks")
+    parser.add_argument("--only", action="append", metavar="SECTION",
+                        choices=[name for name, f in SECTIONS],
+                        help="run only this section (repeatable)")
+    parser.add_argument("--json", metavar="PATH",
+                        help="write the results to PATH as JSON")
+    parser.add_argument("--baseline", metavar="PATH",
+                        help="compare against results saved with --json")
+    parser.add_argument("--tolerance", type=float, default=.2,
+                        help="allowed relative slowdown (default 0.2)")
+    args = parser.parse_args(argv)
+
+    results = Results()
+    for name, section in SECTIONS:
+        if args.only is None or name in args.only:
+            section(results)
+
+    if args.json:
+        f = open(args.json, "w")
+        try:
+            json.dump(results.metrics, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if args.baseline:
+        f = open(args.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        if compare(results.metrics, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,29 @@
 import VMeter
+import VMeterFake
+import VMeterLatency
+import VMeterRecord
+import VMeterPool
+import VMeterProfile
+import VMeterDither
+import VMeterShared
+import VMeterBridge
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
+try:
+    import VMeterRender
+except ImportError:
+    VMeterRender = None
+
+try:
+    import VMeterAsync
+except ImportError:
+    VMeterAsync = None
+
 class ManualTests(unittest.TestCase):                          
     def assertState(self, assertion):
         """
@@ -29,27 +52,947 @@ class ManualTests(unittest.TestCase):
         """see if assertState works"""
         self.assertState("This will fail if you say anything.\n...anything at all.")                   
 
+class RecordingOutput(object):
+    """
+    Output port keeping each Write() call's messages.
+    """
+    def __init__(self):
+        self.writes = []
+
+    def Write(self, data):
+        self.writes.append([message for message, timestamp in data])
+
 class AutomatedTests(unittest.TestCase):
     def setUp(self):
-        self.v = VMeter.VMeter()
+        self.backend = VMeterFake.FakeBackend()
+        self.device = self.backend.devices[0]
+        # events are dispatched by hand
+        self.v = VMeter.VMeter(backend=self.backend, reader=False)
+        # the reply to the settings query sent on connect
+        self.v.dispatch()
 
     def tearDown(self):
         self.v.close()
 
-    def test_read_settings(self):                    
+    def test_touch_events(self):
+        """a swipe reaches the handlers in order"""
+        events = []
+        self.v.on_touch_start(lambda: events.append("start"))
+        self.v.on_touch_end(lambda: events.append("end"))
+        self.v.on_touch(events.append)
+        self.v.set_output_on_off(True)
+
+        self.device.swipe(10, 12)
+        self.assertEqual(self.v.dispatch(), 5)
+        self.assertEqual(events, ["start", 10, 11, 12, "end"])
+
+    def test_batches_smaller_than_the_backlog(self):
+        """read_batch keeps reading until the backlog is drained"""
+        positions = []
+        self.v.on_touch(positions.append)
+        self.v.set_output_on_off(True)
+        self.v.batch_size = 4
+        reads = []
+        read = self.v._in.Read
+        def counting_read(length):
+            batch = read(length)
+            reads.append(len(batch))
+            return batch
+        self.v._in.Read = counting_read
+
+        self.device.swipe(0, 14)
+        self.assertEqual(self.v.dispatch(), 17)
+        self.assertEqual(reads, [4, 4, 4, 4, 1])
+        self.assertEqual(positions, range(15))
+        self.assertEqual(self.v.tick_events, 17)
+        self.assertEqual(self.v.max_tick_events, 17)
+
+        self.device.swipe(20, 21)
+        self.assertEqual(self.v.dispatch(), 4)
+        self.assertEqual(positions[15:], [20, 21])
+        self.assertEqual(self.v.tick_events, 4)
+        self.assertEqual(self.v.max_tick_events, 17)
+
+    def test_remapped_output_ctrl(self):
+        """handlers follow set_output_position_ctrl"""
+        positions = []
+        self.v.on_touch(positions.append)
+        self.v.set_output_position_ctrl(42)
+
+        self.device.touch(99)
+        self.v.dispatch()
+        self.assertEqual(self.device.ctrl_out_touch_pos, 42)
+        self.assertEqual(positions, [99])
+
+    def test_echo(self):
+        self.v.echo(77)
+        self.assertEqual(self.v.read(), [VMeter.CONTROL, VMeter.CTRL_ECHO, 77, 0])
+
+    def test_latency_probe(self):
+        """echo round trips are matched by tag and timed with timestamps"""
+        probe = VMeterLatency.LatencyProbe(self.v)
+        self.device.latency = 3
+        probe.ping()
+        self.backend.advance(10)
+        self.device.latency = 7
+        probe.ping()
+        self.v.dispatch()
+
+        stats = probe.stats()
+        self.assertEqual((stats["sent"], stats["received"]), (2, 2))
+        self.assertEqual((stats["min"], stats["max"]), (3, 7))
+        self.assertEqual(probe.histogram()[2], (4, 1))
+
+    def test_stats(self):
+        self.v.enable_stats()
+        positions = []
+        self.v.on_touch(positions.append)
+        self.v.set_output_pressure(True)
+
+        self.device.swipe(0, 3)
+        self.v.dispatch()
+        self.v.dispatch()
+        self.v.send_mask(VMeter.LedFrame.ALL ^ VMeter.LedFrame.led(0))
+
+        stats = self.v.stats()
+        self.assertEqual(stats["events_by_ctrl"], {20: 4, 18: 4})
+        self.assertEqual(stats["unhandled"], 4)
+        self.assertEqual(stats["idle_ratio"], .5)
+        self.assertEqual(stats["handler_calls"], {VMeter.Event.TOUCH: 4})
+        self.assertEqual(stats["output_by_status"],
+                         {0xB0: 1, 0xAD: 1, 0xAE: 1, 0xAF: 1})
+
+    def test_stats_count_real_handler_calls(self):
+        """throttled and queued handlers are timed where they run"""
+        self.v.enable_stats()
+        positions = []
+        self.v.on_touch(positions.append, max_rate=1)
+        started = threading.Event()
+        def slow():
+            started.set()
+            time.sleep(.02)
+        self.v.on_touch_start(slow, policy=VMeter.Policy.SERIAL)
+        self.v.set_output_on_off(True)
+
+        self.device.swipe(0, 9)
+        self.v.dispatch()
+        started.wait(1)
+        # lets the queued call finish
+        self.v.stop_handlers()
+        self.assertEqual(positions, [0, 9])
+        calls = self.v.stats()["handler_calls"]
+        self.assertEqual(calls, {VMeter.Event.TOUCH: 2,
+                                 VMeter.Event.TOUCH_START: 1})
+        self.assertTrue(self.v.stats()["handler_time"][VMeter.Event.TOUCH_START] >= .02)
+
+        # and only while stats are enabled
+        self.v.disable_stats()
+        self.device.touch(5)
+        self.v.dispatch()
+        self.assertEqual(calls[VMeter.Event.TOUCH], 2)
+
+    def test_record_and_replay(self):
+        """a recorded swipe replays to the same handler calls"""
+        fd, path = tempfile.mkstemp(suffix=".vmr")
+        os.close(fd)
+        try:
+            recorder = VMeterRecord.EventRecorder(path, buffer_size=16)
+            recorder.attach(self.v)
+            self.device.swipe(0, 99)
+            self.v.dispatch()
+            recorder.close()
+            self.assertEqual(recorder.records, 100)
+            self.assertEqual(os.path.getsize(path), 5 + 7 * 100)
+
+            positions = []
+            self.v.on_touch(positions.append)
+            self.assertEqual(VMeterRecord.replay(self.v, path, speed=None), 100)
+            self.assertEqual(positions, range(100))
+        finally:
+            os.remove(path)
+
+    def test_send_array_only_sends_changes(self):
+        array = [0]*VMeter.NUM_LEDS
+        # not a column, see test_column_frames_use_one_message
+        array[1] = 1
+        self.v.send_array(array)
+        self.v.send_array(array)
+        array[37] = 1
+        self.v.send_array(array)
+
+        self.assertEqual(self.device.led_array(), array)
+        self.assertEqual(self.v.messages_sent, 4)
+        self.assertEqual(self.v.messages_suppressed, 5)
+
+    def test_replies_keep_the_last_frame(self):
+        """only touches make the next frame go out in full"""
+        mask = VMeter.LedFrame.led(1) | VMeter.LedFrame.led(37)
+        self.v.send_mask(mask)
+        self.v.echo(5)
+        self.v.get_version(timeout=None)
+        self.v.dispatch()
+        messages = self.device.messages
+        self.v.send_mask(mask)
+        self.assertEqual(self.device.messages, messages)
+
+        self.device.touch(64)
+        self.v.dispatch()
+        self.v.send_mask(mask)
+        self.assertEqual(self.device.messages, messages + 3)
+
+    def test_concurrent_frames_stay_in_step(self):
+        """the last frame sent matches the device with two senders"""
+        def sender(masks):
+            for i in range(200):
+                self.v.send_mask(masks[i % len(masks)])
+
+        LED = VMeter.LedFrame.led
+        threads = [threading.Thread(target=sender,
+                                    args=([LED(1), LED(1) | LED(20)],)),
+                   threading.Thread(target=sender,
+                                    args=([LED(30), LED(3) | LED(37)],))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(VMeter.LedFrame.pack(self.device.leds),
+                         self.v._last_frame)
+
+    def test_writer_sends_config_first(self):
+        output = RecordingOutput()
+        writer = VMeter.OutputWriter(output, threading.Lock())
+        writer.put([(0xDD, 1, 2), (0xDE, 3, 4), (0xDF, 5, 6)])
+        writer.put([(VMeter.CONTROL, VMeter.CTRL_CONFIG, 113)], True)
+        writer.start()
+        writer.stop()
+        writer.join()
+        self.assertEqual(output.writes, [[[VMeter.CONTROL, VMeter.CTRL_CONFIG, 113],
+                                          [0xDD, 1, 2], [0xDE, 3, 4], [0xDF, 5, 6]]])
+
+    def test_writer_keeps_frames_whole(self):
+        """batches of at most MAX_WRITE messages, never splitting a frame"""
+        output = RecordingOutput()
+        writer = VMeter.OutputWriter(output, threading.Lock())
+        for i in range(400):
+            writer.put([(0xDD, i % 128, 0), (0xDE, 0, 0), (0xDF, 0, 0)])
+        writer.start()
+        writer.stop()
+        writer.join()
+        sizes = [len(messages) for messages in output.writes]
+        self.assertEqual(sizes, [1023, 177])
+        for messages in output.writes:
+            self.assertEqual([status for status, data1, data2 in messages],
+                             [0xDD, 0xDE, 0xDF] * (len(messages) // 3))
+
+    def test_writer_drains_queue(self):
+        """flush() and stop_writer() return once everything is written"""
+        LedFrame = VMeter.LedFrame
+        self.v.start_writer()
+        writer = self.v.writer
+        for i in range(50):
+            self.v.send_mask(LedFrame.led(i % 37) | LedFrame.led(37))
+        writer.flush()
+        self.assertEqual(writer.pending(), 0)
+        self.assertEqual(self.device.leds, LedFrame.led(49 % 37) | LedFrame.led(37))
+
+        self.v.send_mask(LedFrame.led(3))
+        self.v.stop_writer()
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(self.device.leds, LedFrame.led(3))
+        self.assertEqual(writer.messages, self.v.messages_sent)
+
+    def test_writer_counts_errors(self):
+        self.v.start_writer()
+        self.backend.unplug()
+        self.v.send_mask(VMeter.LedFrame.led(3))
+        self.v.writer.flush()
+        self.assertEqual(self.v.writer.errors, 1)
+        self.assertEqual(self.v.writer.writes, 0)
+        self.assertFalse(self.v.connected)
+
+    def blocking_handler(self, count):
+        """
+        A handler that waits for gate to be set, and an Event set once it
+        was called count times.
+        """
+        calls = []
+        started = threading.Event()
+        gate = threading.Event()
+        finished = threading.Event()
+        def handler(value):
+            started.set()
+            gate.wait()
+            calls.append(value)
+            if len(calls) == count:
+                finished.set()
+        return handler, calls, started, gate, finished
+
+    def test_queued_handler_drops_oldest(self):
+        handler, calls, started, gate, finished = self.blocking_handler(3)
+        h = VMeter.QueuedHandler(handler, backlog=2)
+        h(0)
+        started.wait(1)
+        for value in (1, 2, 3):
+            h(value)
+        stats = h.stats()
+        self.assertEqual(stats["depth"], 2)
+        self.assertEqual(stats["dropped"], 1)
+
+        time.sleep(.05)
+        gate.set()
+        finished.wait(1)
+        h.stop()
+        self.assertEqual(calls, [0, 2, 3])
+        stats = h.stats()
+        self.assertEqual(stats["calls"], 3)
+        self.assertEqual(stats["depth"], 0)
+        # from queueing to completion, including the wait for the gate
+        self.assertTrue(stats["max_latency"] >= .05)
+        self.assertTrue(0 < stats["mean_latency"] <= stats["max_latency"])
+
+    def test_queued_handler_coalesces(self):
+        handler, calls, started, gate, finished = self.blocking_handler(3)
+        h = VMeter.QueuedHandler(handler, backlog=2,
+                                 overflow=VMeter.Overflow.COALESCE)
+        h(0)
+        started.wait(1)
+        for value in (1, 2, 3):
+            h(value)
+        self.assertEqual(h.stats()["coalesced"], 1)
+        gate.set()
+        finished.wait(1)
+        h.stop()
+        self.assertEqual(calls, [0, 1, 3])
+
+    def test_queued_handler_blocks(self):
+        handler, calls, started, gate, finished = self.blocking_handler(4)
+        h = VMeter.QueuedHandler(handler, backlog=2,
+                                 overflow=VMeter.Overflow.BLOCK)
+        h(0)
+        started.wait(1)
+        h(1)
+        h(2)
+        caller = threading.Thread(target=h, args=(3,))
+        caller.start()
+        caller.join(.05)
+        self.assertTrue(caller.is_alive())
+        gate.set()
+        caller.join(1)
+        finished.wait(1)
+        h.stop()
+        self.assertEqual(calls, [0, 1, 2, 3])
+        self.assertEqual(h.stats()["dropped"], 0)
+
+    def test_blocked_call_ends_on_stop(self):
+        """a caller waiting for room returns when the handler is stopped"""
+        handler, calls, started, gate, finished = self.blocking_handler(1)
+        pool = VMeter.HandlerPool(1)
+        h = VMeter.QueuedHandler(handler, pool, backlog=1,
+                                 overflow=VMeter.Overflow.BLOCK)
+        h(0)
+        started.wait(1)
+        h(1)
+        caller = threading.Thread(target=h, args=(2,))
+        caller.start()
+        caller.join(.05)
+        self.assertTrue(caller.is_alive())
+
+        h.stop()
+        caller.join(1)
+        self.assertFalse(caller.is_alive())
+        self.assertEqual(h.stats()["depth"], 0)
+        gate.set()
+        pool.stop()
+        self.assertEqual(calls, [0])
+
+    def test_serial_handler_keeps_order(self):
+        positions = []
+        finished = threading.Event()
+        def handler(position):
+            positions.append(position)
+            if position == 50:
+                finished.set()
+        self.v.register(VMeter.Event.TOUCH, handler,
+                        policy=VMeter.Policy.SERIAL)
+        self.device.swipe(0, 50)
+        self.v.dispatch()
+        finished.wait(1)
+        self.assertEqual(positions, range(51))
+
+        # lets the last call finish
+        self.v.stop_handlers()
+        [(eventType, h, stats)] = self.v.handler_stats()
+        self.assertEqual((eventType, h), (VMeter.Event.TOUCH, handler))
+        self.assertEqual(stats["calls"], 51)
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["dropped"], 0)
+
+    def test_throttled_burst_ends_with_last_value(self):
+        values = []
+        th = VMeter.ThrottledHandler(values.append, max_rate=1)
+        for value in (1, 2, 3):
+            th(value)
+        self.assertEqual(values, [1])
+        # held back until the next slot, then the final value
+        self.assertTrue(th.flush(time.time()))
+        self.assertEqual(values, [1])
+        self.assertFalse(th.flush(time.time() + 1))
+        self.assertEqual(values, [1, 3])
+        self.assertEqual((th.calls, th.skipped), (2, 1))
+
+    def test_throttled_without_coalesce_drops(self):
+        values = []
+        th = VMeter.ThrottledHandler(values.append, max_rate=1, coalesce=False)
+        for value in (1, 2, 3):
+            th(value)
+        self.assertFalse(th.flush(time.time() + 1))
+        self.assertEqual(values, [1])
+        self.assertEqual(th.skipped, 2)
+
+    def test_throttled_values_come_before_touch_end(self):
+        events = []
+        self.v.set_output_on_off(True)
+        self.v.on_touch(events.append, max_rate=1)
+        self.v.on_touch_end(lambda: events.append("end"))
+        self.device.swipe(10, 12)
+        self.v.dispatch()
+        self.assertEqual(events, [10, 12, "end"])
+
+    def test_only_touch_and_pressure_can_be_throttled(self):
+        for eventType in (VMeter.Event.TOUCH_START, VMeter.Event.TOUCH_END):
+            self.assertRaises(ValueError, self.v.register, eventType,
+                              lambda: None, max_rate=10)
+        self.assertEqual(self.v._throttled, [])
+
+    def test_scheduler_keeps_latest_frame(self):
+        """posts don't block and collapse into the latest one per slot"""
+        sent = []
+        sending = threading.Event()
+        gate = threading.Event()
+        def send(value):
+            sending.set()
+            gate.wait()
+            sent.append(value)
+        scheduler = VMeter.FrameScheduler(self.v, max_fps=50)
+        scheduler.start()
+        scheduler.post(send, 0)
+        sending.wait(1)
+        # the thread is stuck sending 0, posting still returns at once
+        start = time.time()
+        for value in range(1, 101):
+            scheduler.post(send, value)
+        self.assertTrue(time.time() - start < .5)
+        gate.set()
+        deadline = time.time() + 1
+        while scheduler.sent < 2 and time.time() < deadline:
+            time.sleep(.005)
+        scheduler.stop()
+        scheduler.join(1)
+        self.assertFalse(scheduler.is_alive())
+
+        self.assertEqual(sent, [0, 100])
+        stats = scheduler.stats()
+        self.assertEqual(stats["posted"], 101)
+        self.assertEqual(stats["sent"], len(sent))
+        self.assertEqual(stats["dropped"], 101 - len(sent))
+
+    def test_scheduler_stays_below_max_fps(self):
+        times = []
+        scheduler = self.v.start_scheduler(max_fps=50)
+        end = time.time() + .3
+        value = 0
+        while time.time() < end:
+            scheduler.post(lambda value: times.append(time.time()), value)
+            value += 1
+            time.sleep(.001)
+        self.v.stop_scheduler()
+        self.assertFalse(scheduler.is_alive())
+
+        self.assertTrue(len(times) > 5)
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        self.assertTrue(min(gaps) >= .019)
+        self.assertTrue(scheduler.fps() <= 50)
+        self.assertTrue(scheduler.dropped > 0)
+
+    def test_adaptive_thread_backs_off_while_idle(self):
+        results = [False] * 6 + [True, False]
+        intervals = []
+        done = threading.Event()
+        def poll():
+            if len(intervals) == len(results):
+                done.set()
+                return True
+            intervals.append(thread.interval)
+            return results[len(intervals) - 1]
+        thread = VMeter.AdaptiveThread(poll, min_interval=.001,
+                                       max_interval=.006)
+        thread.start()
+        self.assertTrue(done.wait(2))
+        thread.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+        # doubles from min_interval up to max_interval, then back to
+        # min_interval right after the call that found something
+        self.assertEqual(intervals, [.001, .001 * 2, .001 * 4, .006, .006,
+                                     .006, .006, .001])
+        self.assertEqual(thread.interval, .001)
+
+    def test_read_settings(self):
         """verify output of read_settings"""
-        #settings = v.read_settings()
-        # perform validations on size, values of settings returned
-        pass
+        self.assertEqual(self.v.settings, VMeter.Settings())
+        self.device.ctrl_out_touch_pos = 30
+        self.device.upside_down = True
+        self.device.brightness = 55
+
+        self.v.read_settings(timeout=None)
+        self.assertEqual(self.v.dispatch(), VMeter.SETTINGS_LENGTH)
+        settings = self.v.settings
+        self.assertEqual(settings.to_bytes(), self.device.settings_bytes())
+        self.assertTrue(settings.upside_down)
+        self.assertEqual(settings.brightness, 55)
+
+        # the dispatch mapping follows the device
+        positions = []
+        self.v.on_touch(positions.append)
+        self.device.touch(12)
+        self.v.dispatch()
+        self.assertEqual(positions, [12])
+
+        self.v.get_version(timeout=None)
+        self.v.dispatch()
+        self.assertEqual(self.v.version, self.device.version)
 
     def test_store_settings(self):
         """set some settings, write to VMeter, test against read_settings"""
-        pass
+        self.v.set_output_pressure(True)
+        self.v.set_MIDI_channel(3)
+        self.v.set_brightness(8)
+        self.v.store_settings()
+
+        # known state is not sent again
+        messages = self.device.messages
+        self.v.set_output_pressure(True)
+        self.v.set_MIDI_channel(3)
+        self.v.set_brightness(8)
+        self.assertEqual(self.device.messages, messages)
+
+        expected = self.v.settings.copy()
+        self.v.read_settings(timeout=None)
+        self.v.dispatch()
+        self.assertEqual(self.v.settings, expected)
+        self.assertEqual(self.device.stores, 1)
+
+    def test_settings_set_while_query_pending(self):
+        """setters called before the settings reply is read survive it"""
+        self.v.close()
+        self.v = v = VMeter.VMeter(backend=self.backend, reader=False)
+        v.set_output_on_off(True)
+        v.set_output_position_ctrl(42)
+        v.dispatch()
+        self.assertTrue(v.settings.output_on_off)
+        self.assertEqual(v.settings.ctrl_out_touch_pos, 42)
+        self.assertEqual(v.settings.to_bytes(), self.device.settings_bytes())
+
+        positions = []
+        v.on_touch(positions.append)
+        self.device.touch(12)
+        v.dispatch()
+        self.assertEqual(positions, [12])
+
+        messages = self.device.messages
+        v.set_output_on_off(False)
+        self.assertEqual(self.device.messages, messages + 1)
+        self.assertFalse(self.device.output_on_off)
+
+    def test_profile_sends_only_differences(self):
+        path = tempfile.mktemp(".json")
+        try:
+            VMeterProfile.Profile(output_pressure=True, midi_channel=2,
+                                  brightness=63).save(path)
+            profile = VMeterProfile.Profile.load(path)
+        finally:
+            os.remove(path)
+
+        # pressure flag, channel, brightness and store
+        self.assertEqual(profile.apply(self.v), 4)
+        self.assertEqual(self.device.stores, 1)
+        self.assertEqual(self.device.settings_bytes(), self.v.settings.to_bytes())
+        self.assertEqual(self.device.brightness, 63)
+
+        # already applied: nothing is sent or stored
+        messages = self.device.messages
+        self.assertEqual(profile.apply(self.v), 0)
+        self.assertEqual(self.device.messages, messages)
+        self.assertEqual(self.device.stores, 1)
+
+    def test_animation_follows_the_clock(self):
+        """frames are picked by time, over the live base frame"""
+        animator = VMeter.Animator(self.v)
+        animator.column(127)
+        sweep = animator.play(VMeter.Animation.sweep_from_center(.01), layer=1)
+        blink = animator.play(VMeter.Animation.blink(VMeter.LedFrame.led(0),
+                                                     on=5, off=5), layer=2)
+
+        self.assertEqual(animator.tick(0), 5)
+        self.assertEqual(self.device.leds, VMeter.LedFrame.range(18, 19) |
+                         VMeter.LedFrame.led(0))
+
+        # a late tick skips frames instead of drifting
+        self.assertEqual(animator.tick(45), 50)
+        self.assertEqual(self.device.leds, VMeter.LedFrame.range(14, 23))
+        self.assertEqual(animator.stats()["skipped"], 3)
+
+        animator.tick(1000)
+        self.assertTrue(sweep.done())
+        self.assertEqual(self.device.leds, VMeter.LedFrame.ALL)
+
+        sweep.cancel()
+        blink.cancel()
+        animator.column(0)
+        self.assertEqual(animator.tick(1005), None)
+        self.assertEqual(self.device.leds, VMeter.LedFrame.OFF)
+
+    def test_live_output_shows_after_sweeps(self):
+        """a finished sweep doesn't hide column() for good"""
+        animator = self.v.animator = VMeter.Animator(self.v)
+        try:
+            for start in (0, 1000, 2000):
+                self.v.sweep_from_center(.01, wait=False)
+                animator.tick(start)
+                animator.tick(start + 500)
+                self.assertEqual(self.device.leds, VMeter.LedFrame.ALL)
+            self.assertEqual(animator.playing(), [])
+
+            animator.column(30)
+            animator.tick(3000)
+            self.assertEqual(self.device.leds, VMeter.LedFrame.height(30))
+
+            # held playbacks are dropped once a later opaque one covers them
+            hold = VMeter.Animation.bar_sweep(start=0, end=8, hold=True)
+            for start in (3000, 4000, 5000):
+                animator.play(hold, start=start)
+                animator.tick(start + 500)
+            self.assertEqual(len(animator.playing()), 1)
+        finally:
+            self.v.animator = None
+
+    def test_dithered_levels(self):
+        """each LED is on for its share of the cycle"""
+        levels = [i * 127 // 37 for i in range(VMeter.NUM_LEDS)]
+        for mode in (VMeterDither.SIGMA_DELTA, VMeterDither.PWM):
+            fb = VMeterDither.GrayFramebuffer(self.v, steps=8, mode=mode)
+            fb.set(levels)
+            masks = [VMeter.LedFrame.unpack(f) for f in fb.cycle()]
+            self.assertEqual(len(masks), 8)
+            for i, level in enumerate(levels):
+                on = len([m for m in masks if m & 1 << i])
+                self.assertEqual(on, (level * 8 + 63) // 127)
+
+            self.assertTrue(fb.degrade())
+            self.assertEqual(len(fb.cycle()), 4)
+            self.assertTrue(fb.degrade())
+            self.assertFalse(fb.degrade())
+
+    def test_column_frames_use_one_message(self):
+        LedFrame = VMeter.LedFrame
+        messages = self.device.messages
+        self.v.send_mask(LedFrame.ALL)
+        self.assertEqual(self.device.messages - messages, 1)
+        self.assertEqual(self.device.leds, LedFrame.ALL)
+
+        # other columns stay aftertouch until their LEDs are known
+        self.v.send_mask(LedFrame.column(20))
+        self.assertEqual(self.device.messages - messages, 3)
+        self.assertEqual(self.device.leds, LedFrame.column(20))
+
+        self.v.set_upside_down_mode(True)
+        messages = self.device.messages
+        self.v.send_mask(LedFrame.OFF)
+        self.assertEqual(self.device.messages - messages, 1)
+        self.assertEqual(self.device.leds, LedFrame.OFF)
+        self.assertEqual(self.v.stats()["column_frames"], 2)
+        self.assertEqual(self.v.stats()["messages_saved"], 3)
+        # pairs that didn't change, not counting the ones saved
+        self.assertEqual(self.v.messages_suppressed, 2)
+
+        # only known columns are kept for diffing
+        self.v.send_column(64)
+        self.assertEqual(self.v._last_frame, None)
+        self.v.send_column(127)
+        self.assertEqual(self.v._last_frame, LedFrame.pack(LedFrame.ALL))
+
+        # all off and all on don't depend on the orientation
+        self.v.invalidate_settings()
+        messages = self.device.messages
+        self.v.send_mask(LedFrame.OFF)
+        self.assertEqual(self.device.messages - messages, 1)
+        self.assertEqual(self.device.leds, LedFrame.OFF)
+
+    def test_shared_framebuffer(self):
+        LedFrame = VMeter.LedFrame
+        fd, path = tempfile.mkstemp(suffix=".fb")
+        os.close(fd)
+        try:
+            owner = VMeterShared.SharedOwner(self.v, path, slots=4)
+            fb = VMeterShared.SharedFramebuffer(path)
+            background = fb.slot(0, priority=0)
+            marker = fb.slot(3, priority=5)
+            self.assertFalse(owner.poll())
+
+            background.column(64)
+            marker.mask(LedFrame.led(37), blend=VMeterShared.OVERLAY)
+            self.assertTrue(owner.poll())
+            self.assertEqual(self.device.leds,
+                             LedFrame.height(64) | LedFrame.led(37))
+            self.assertFalse(owner.poll())
+
+            background.clear()
+            owner.poll()
+            self.assertEqual(self.device.leds, LedFrame.led(37))
+            fb.close()
+            owner.close()
+        finally:
+            os.remove(path)
+
+    def test_bridge_over_loopback(self):
+        bridge = VMeterBridge.Bridge(self.v, port=0)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.bind(("127.0.0.1", 0))
+        client.settimeout(1.0)
+        try:
+            client.sendto(VMeterBridge.encode_message("/vmeter/subscribe"),
+                          bridge.address)
+            client.sendto(VMeterBridge.encode_bundle([
+                VMeterBridge.encode_message("/vmeter/column", 20),
+                VMeterBridge.encode_message("/vmeter/column", 127),
+                VMeterBridge.encode_message("/vmeter/nonsense")]),
+                bridge.address)
+            while bridge.receive():
+                pass
+            self.assertEqual(bridge.subscribers, [client.getsockname()])
+            self.assertEqual(self.device.leds, VMeter.LedFrame.ALL)
+            self.assertEqual((bridge.coalesced, bridge.bad_commands), (1, 1))
+
+            self.device.swipe(5, 7)
+            bridge.tick()
+            messages = VMeterBridge.decode(client.recv(4096))
+            self.assertEqual([(address, args[0]) for address, args in messages],
+                             [("/vmeter/touch", 5), ("/vmeter/touch", 6),
+                              ("/vmeter/touch", 7)])
+            self.assertEqual(bridge.bundles, 1)
+
+            # the clock passes 2^31 ms after about 25 days
+            self.backend.advance(2**31 + 5)
+            self.device.touch(9)
+            bridge.tick()
+            messages = VMeterBridge.decode(client.recv(4096))
+            self.assertEqual(messages, [("/vmeter/touch",
+                                         [9, self.backend.time()])])
+        finally:
+            client.close()
+            bridge.close()
 
     def test_bad_input(self):                                          
         """THIS IS TO SHOW YOU HOW TO ASSERT EXCEPTIONS"""                   
         #self.assertRaises(OutOfRangeError, functionToCall, arguments)
         pass
 
+class PoolTests(unittest.TestCase):
+    def test_events_are_tagged_with_their_vmeter(self):
+        backend = VMeterFake.FakeBackend(3)
+        pool = VMeterPool.VMeterPool(backend=backend)
+        pool.stop()
+        self.assertEqual(len(pool), 3)
+
+        touches = []
+        pool.on_touch(lambda v, position: touches.append((v, position)))
+        backend.devices[2].touch(5)
+        backend.devices[0].touch(9)
+        pool.dispatch()
+        pool.close()
+
+        self.assertEqual(touches, [(pool.vmeters[0], 9), (pool.vmeters[2], 5)])
+
+    def test_replugged_device_reconnects(self):
+        backend = VMeterFake.FakeBackend(2)
+        pool = VMeterPool.VMeterPool(backend=backend, threaded_output=False)
+        pool.stop()
+        registry = VMeter.get_registry(backend)
+        v = pool.vmeters[1]
+        pool.dispatch()
+
+        backend.unplug(1)
+        self.assertEqual(pool.dispatch(), 0)
+        self.assertFalse(v.connected)
+        self.assertEqual(registry.disconnected(), [v])
+
+        # still unplugged: nothing to reconnect to
+        self.assertEqual(registry.rescan(), 1)
+        backend.replug(1)
+        registry.check()
+        self.assertTrue(v.connected)
+
+        touches = []
+        pool.on_touch(lambda v, position: touches.append(position))
+        backend.devices[1].touch(7)
+        pool.dispatch()
+        pool.close()
+        self.assertEqual(touches, [7])
+
+    def test_same_named_strips_keep_their_vmeters(self):
+        backend = VMeterFake.FakeBackend(3, name="VMeter 1.0")
+        pool = VMeterPool.VMeterPool(backend=backend, threaded_output=False)
+        pool.stop()
+        registry = VMeter.get_registry(backend)
+        pool.dispatch()
+        touches = []
+        pool.on_touch(lambda v, position: touches.append(
+            (pool.vmeters.index(v), position)))
+
+        def check(*connected):
+            del touches[:]
+            for i, device in enumerate(backend.devices):
+                if device.plugged:
+                    device.touch(i)
+            pool.dispatch()
+            self.assertEqual(sorted(touches), [(i, i) for i in connected])
+
+        backend.unplug(0)
+        pool.dispatch()
+        # the others stay on their own strips while the first is away
+        self.assertEqual(registry.rescan(), 2)
+        check(1, 2)
+        backend.replug(0)
+        registry.check()
+        self.assertEqual(registry.disconnected(), [])
+        check(0, 1, 2)
+
+        # two lost, one back: taken to be the lower one
+        backend.unplug(0)
+        backend.unplug(1)
+        pool.dispatch()
+        backend.replug(0)
+        self.assertEqual(registry.rescan(), 2)
+        check(0, 2)
+        backend.replug(1)
+        registry.check()
+        check(0, 1, 2)
+        pool.close()
+
+    def test_rescan_under_live_io(self):
+        """rescanning closes and reopens ports without losing a device"""
+        backend = VMeterFake.FakeBackend(2, real_time=True)
+        registry = VMeter.get_registry(backend)
+        vmeters = [VMeter.VMeter(backend=backend, threaded_output=True)
+                   for i in range(2)]
+        done = threading.Event()
+
+        def draw(v, device):
+            i = 0
+            while not done.is_set():
+                v.send_mask(VMeter.LedFrame.led(i % 37) | VMeter.LedFrame.led(37))
+                device.touch(i % 128)
+                i += 1
+
+        threads = [threading.Thread(target=draw, args=(v, device))
+                   for v, device in zip(vmeters, backend.devices)]
+        for t in threads:
+            t.start()
+        try:
+            for i in range(20):
+                self.assertEqual(registry.rescan(), 2)
+        finally:
+            done.set()
+            for t in threads:
+                t.join()
+        for v in vmeters:
+            v.close()
+        self.assertEqual(registry.lost_devices, 0)
+        self.assertEqual(registry.rescans, 20)
+
+@unittest.skipUnless(VMeterRender, "needs numpy")
+class RenderTests(unittest.TestCase):
+    def test_peak_hold_and_decay(self):
+        renderer = VMeterRender.LevelRenderer(decay=10, peak_hold=2, peak_decay=20)
+        level, peak = renderer.process([100, 0, 0])
+        self.assertEqual(list(level), [100, 90, 80])
+        self.assertEqual(list(peak), [100, 100, 100])
+        # state carries over to the next block
+        level, peak = renderer.process([0, 0])
+        self.assertEqual(list(level), [70, 60])
+        self.assertEqual(list(peak), [80, 60])
+
+    def test_frames_match_led_frame_height(self):
+        renderer = VMeterRender.LevelRenderer(decay=127, peak_hold=0)
+        frames = renderer.render([[0, 64, 127], [127, 1, 30]])
+        self.assertEqual([tuple(f) for f in frames[1]],
+                         [VMeter.LedFrame.pack(VMeter.LedFrame.height(h))
+                          for h in (127, 1, 30)])
+
+@unittest.skipUnless(VMeterAsync, "needs trollius")
+class AsyncTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = VMeterFake.FakeBackend()
+        self.device = self.backend.devices[0]
+        self.v = VMeter.VMeter(backend=self.backend, reader=False)
+        self.v.dispatch()
+        self.loop = VMeterAsync.asyncio.new_event_loop()
+        self.vm = VMeterAsync.AsyncVMeter(self.v, loop=self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        self.v.close()
+
+    def test_events_and_commands(self):
+        asyncio = VMeterAsync.asyncio
+        From = asyncio.From
+        stream = self.vm.events()
+        self.v.set_output_on_off(True)
+        self.device.swipe(10, 12)
+        self.v.dispatch()
+
+        @asyncio.coroutine
+        def follow():
+            positions = []
+            while True:
+                item = yield From(stream.get())
+                if item is None:
+                    break
+                event, value = item
+                if event == VMeter.Event.TOUCH:
+                    positions.append(value)
+                elif event == VMeter.Event.TOUCH_END:
+                    stream.close()
+            yield From(self.vm.send_column(127))
+            raise asyncio.Return(positions)
+
+        positions = self.loop.run_until_complete(follow())
+        self.assertEqual(positions, [10, 11, 12])
+        # all events of the tick came over in one batch
+        self.assertEqual(self.vm.batches, 1)
+        self.assertEqual(self.device.leds, VMeter.LedFrame.ALL)
+
+class LedFrameTests(unittest.TestCase):
+    def test_pack_matches_aftertouch_layout(self):
+        """LEDs 1-7 in byte 0, 8-14 in byte 1, ..., 36-38 in byte 5"""
+        mask = VMeter.LedFrame.led(0) | VMeter.LedFrame.led(8) | VMeter.LedFrame.led(37)
+        self.assertEqual(VMeter.LedFrame.pack(mask), (1, 2, 0, 0, 0, 4))
+        self.assertEqual(VMeter.LedFrame.pack(VMeter.LedFrame.ALL),
+                         (127, 127, 127, 127, 127, 7))
+
+    def test_array_round_trip(self):
+        array = [i % 3 == 0 and 1 or 0 for i in range(VMeter.NUM_LEDS)]
+        mask = VMeter.LedFrame.from_array(array)
+        self.assertEqual(VMeter.LedFrame.to_array(mask), array)
+        self.assertEqual(VMeter.LedFrame.unpack(VMeter.LedFrame.pack(mask)), mask)
+
+    def test_bar(self):
+        """bars are clipped at both ends of the strip"""
+        self.assertEqual(VMeter.LedFrame.bar(0, 4), VMeter.LedFrame.range(0, 2))
+        self.assertEqual(VMeter.LedFrame.bar(127, 4), VMeter.LedFrame.range(35, 37))
+        self.assertEqual(VMeter.LedFrame.bar(127, 0), VMeter.LedFrame.led(37))
+        self.assertEqual(VMeter.LedFrame.column(38), VMeter.LedFrame.ALL)
+
 if __name__ == "__main__":
     unittest.main()   
@@ -71,9 +71,12 @@ LEDs 36-38: status 0xAF, data2 bits 0-2.
 
 """
 
-from pygame import pypm
 import time
 import threading
+import traceback
+import Queue
+from bisect import bisect_right, insort
+from collections import deque
 
 NUM_LEDS = 38
 
@@ -84,69 +87,898 @@ CONTROL = 0xB0
 CTRL_ECHO = 118
 CTRL_CONFIG = 119
 
+# Replies to get_version() and read_settings() (config values 103 and 113)
+# arrive as a run of values on these controllers, channel 1:
+# 4 ASCII digits on Ctrl #109 and 16 settings bytes on Ctrl #119.
+CTRL_VERSION = 109
+CTRL_SETTINGS = 119
+VERSION_LENGTH = 4
+SETTINGS_LENGTH = 16
+
+# touch output uses controllers 0-100 (see set_output_position_ctrl), so
+# the ones above can only be replies
+MAX_OUTPUT_CTRL = 100
+
+# polyphonic aftertouch on channels 14, 15 and 16, used for individual LEDs
+LED_STATUS = (0xAD, 0xAE, 0xAF)
+
+# (status, index of data1, index of data2) into the six packed LED bytes
+_LED_PAIRS = ((0xAD, 0, 1), (0xAE, 2, 3), (0xAF, 4, 5))
+
+# pypm.Output.Write() accepts at most this many messages per call
+MAX_WRITE = 1024
+
 class Event:
     TOUCH = 1
     PRESSURE = 2
     TOUCH_START = 3
     TOUCH_END = 4
+    ECHO = 5
 
 class Touch:
     MAX = 127
     MIN = 0
 
-def get_devices():
-    for i in range(pypm.CountDevices()):
-        yield pypm.GetDeviceInfo(i)
+class Policy:
+    """
+    Where a registered handler runs.
+    """
+    INLINE = 1  # on the reader thread (default)
+    POOL = 2    # on the shared HandlerPool, calls may run concurrently
+    SERIAL = 3  # on a dedicated thread, one call at a time, in order
+
+class Overflow:
+    """
+    What a queued handler does when its backlog is full.
+    """
+    DROP_OLDEST = 1  # discard the oldest pending call
+    COALESCE = 2     # replace the newest pending call with the new one
+    BLOCK = 3        # make the caller (normally the reader) wait
+
+# _LED_BITS[i] is the mask bit of LED i
+_LED_BITS = tuple(1 << i for i in range(NUM_LEDS))
+
+class LedFrame:
+    """
+    LED frames as 38-bit integer masks.
+    Bit 0 is the bottom LED, bit 37 the top one.
+
+    Masks can be combined with the usual bitwise operators and are sent
+    with VMeter.send_mask().
+    """
+    OFF = 0
+    ALL = (1 << NUM_LEDS) - 1
+
+    @staticmethod
+    def pack(mask):
+        """
+        Splits a mask into the six 7-bit data bytes of the three
+        aftertouch messages.
+        """
+        return (mask & 0x7F,
+                mask >> 7 & 0x7F,
+                mask >> 14 & 0x7F,
+                mask >> 21 & 0x7F,
+                mask >> 28 & 0x7F,
+                mask >> 35 & 0x07)
+
+    @staticmethod
+    def unpack(data):
+        """
+        Inverse of pack().
+        """
+        return (data[0] | data[1] << 7 | data[2] << 14 |
+                data[3] << 21 | data[4] << 28 | data[5] << 35)
+
+    @staticmethod
+    def from_array(array):
+        """
+        Mask of an array of 1's and 0's, as taken by send_array.
+        """
+        mask = 0
+        i = 0
+        for on in array:
+            if on:
+                mask |= _LED_BITS[i]
+            i += 1
+        return mask
+
+    @staticmethod
+    def to_array(mask):
+        return [mask >> i & 1 for i in range(NUM_LEDS)]
+
+    @staticmethod
+    def led(index):
+        """
+        Single LED (0-37).
+        """
+        return _LED_BITS[index]
+
+    @staticmethod
+    def range(lower, upper):
+        """
+        LEDs lower to upper inclusive, clipped to 0-37.
+        """
+        if lower < 0:
+            lower = 0
+        if upper > NUM_LEDS - 1:
+            upper = NUM_LEDS - 1
+        if upper < lower:
+            return 0
+        return ((1 << (upper - lower + 1)) - 1) << lower
+
+    @staticmethod
+    def column(count):
+        """
+        Bottom count LEDs (0-38).
+        """
+        if count <= 0:
+            return 0
+        if count >= NUM_LEDS:
+            return LedFrame.ALL
+        return (1 << count) - 1
+
+    @staticmethod
+    def height(height, upside_down=False):
+        """
+        LEDs lit by a column of given height (0-127), as sent by
+        VMeter.send_column; drawn from the top in upside-down mode.
+
+        Only heights 0 (all off) and 127 (all on) are known to match the
+        device; the rounding of the heights in between is a guess.
+        """
+        count = (height * NUM_LEDS + 63) // 127
+        if upside_down:
+            return LedFrame.ALL ^ LedFrame.column(NUM_LEDS - count)
+        return LedFrame.column(count)
+
+    @staticmethod
+    def bar(position, size):
+        """
+        Bar of given size (0-38), centered at given position (0-127),
+        as drawn by VMeter.draw_bar.
+        """
+        cursor_pos = int(float(position) / 127.0 * 37.0)
+        return LedFrame.range(cursor_pos - size // 2, cursor_pos + size // 2)
+
+class Settings(object):
+    """
+    Device settings, as parsed from the read_settings() reply
+    (see VMeter.read_settings() for the byte layout).
+
+    Settings() holds the factory defaults; keyword arguments override them.
+    """
+
+    # attribute -> (byte, bit, config value to enable, config value to disable)
+    FLAGS = {
+        "output_pressure": (1, 8, 122, 121),
+        "output_on_off": (1, 4, 120, 119),
+        "output_touch_position": (1, 2, 124, 123),
+        "upside_down": (1, 1, 125, 126),
+        "cross_fader": (2, 32, 105, 104),
+        "noteout_pitch_mode": (2, 16, 109, 108),
+        "noteout_velocity_mode": (2, 8, 111, 110),
+        "leds_ignore_touch": (2, 4, 107, 106),
+        "note_on_off": (2, 2, 117, 116),
+        "pitch_wheel": (2, 1, 115, 114),
+    }
+
+    # attribute -> (byte, controller changing it over channel 1)
+    CONTROLLERS = {
+        "ctrl_out_touch_pos": (3, 116),
+        "ctrl_out_on_off": (4, 115),
+        "ctrl_out_pressure": (5, 114),
+        "ctrl_in_light": (6, 113),
+        "ctrl_in_brightness": (7, 112),
+        "noteout_number": (8, 111),
+        "noteout_velocity": (9, 110),
+        "midi_channel": (11, 117),
+    }
+
+    # attribute -> byte, for values without a controller of their own
+    VALUES = {
+        "brightness": 10,
+        "sensitivity": 14,
+        "return_speed": 15,
+    }
+
+    # what store_settings() saves
+    PERSISTED = frozenset(list(FLAGS) + list(CONTROLLERS) + ["brightness"])
+
+    MARKER = 85
+
+    def __init__(self, **values):
+        for name in self.FLAGS:
+            setattr(self, name, False)
+        self.output_touch_position = True
+        self.ctrl_out_touch_pos = 20
+        self.ctrl_out_on_off = 17
+        self.ctrl_out_pressure = 18
+        self.ctrl_in_light = 20
+        self.ctrl_in_brightness = 21
+        self.noteout_number = 64
+        self.noteout_velocity = 100
+        self.midi_channel = 1
+        self.brightness = 127
+        self.sensitivity = 64
+        self.return_speed = 0
+
+        for name, value in values.items():
+            if not hasattr(self, name):
+                raise TypeError("Unknown setting %r" % name)
+            setattr(self, name, value)
+
+    @staticmethod
+    def parse(data):
+        """
+        Settings from the 16 reply bytes.
+        """
+        if len(data) != SETTINGS_LENGTH or data[0] != Settings.MARKER:
+            raise ValueError("Not a settings reply: %r" % (data,))
+        settings = Settings()
+        for name, (byte, bit, on, off) in Settings.FLAGS.items():
+            setattr(settings, name, bool(data[byte] & bit))
+        for name, (byte, ctrl) in Settings.CONTROLLERS.items():
+            setattr(settings, name, data[byte])
+        for name, byte in Settings.VALUES.items():
+            setattr(settings, name, data[byte])
+        # sent as 0-15
+        settings.midi_channel += 1
+        return settings
+
+    def validate(self):
+        """
+        Raises ValueError for values out of range.
+        """
+        for name in self.FLAGS:
+            if getattr(self, name) not in (True, False):
+                raise ValueError("%s must be True or False" % name)
+        for name in list(self.CONTROLLERS) + list(self.VALUES):
+            value = getattr(self, name)
+            low, high = (1, 16) if name == "midi_channel" else (0, 127)
+            if not isinstance(value, (int, long)) or not low <= value <= high:
+                raise ValueError("%s must be %d-%d, not %r" % (name, low, high, value))
+
+    def to_bytes(self):
+        """
+        The inverse of parse().
+        """
+        data = [0] * SETTINGS_LENGTH
+        data[0] = self.MARKER
+        data[13] = 5
+        for name, (byte, bit, on, off) in self.FLAGS.items():
+            if getattr(self, name):
+                data[byte] |= bit
+        for name, (byte, ctrl) in self.CONTROLLERS.items():
+            data[byte] = getattr(self, name)
+        for name, byte in self.VALUES.items():
+            data[byte] = getattr(self, name)
+        data[11] = self.midi_channel - 1
+        return data
+
+    def names(self):
+        return sorted(self.FLAGS) + sorted(self.CONTROLLERS) + sorted(self.VALUES)
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.names())
+
+    def copy(self):
+        return Settings(**self.as_dict())
+
+    def __eq__(self, other):
+        return isinstance(other, Settings) and self.as_dict() == other.as_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Settings(%s)" % ", ".join("%s=%r" % (name, getattr(self, name))
+                                          for name in self.names())
+
+# settings mirrored as VMeter attributes, used for dispatch and output
+_MAPPED_SETTINGS = ("midi_channel", "ctrl_out_touch_pos", "ctrl_out_on_off",
+                    "ctrl_out_pressure", "ctrl_in_light", "ctrl_in_brightness",
+                    "leds_ignore_touch", "upside_down", "pitch_wheel",
+                    "cross_fader")
+
+# heights whose LEDs are known, see LedFrame.height(); all off and all on
+# look the same in either orientation
+_KNOWN_HEIGHTS = (0, 127)
+# packed frame -> column height (0-127) drawing it
+_COLUMN_FRAMES = dict((LedFrame.pack(LedFrame.height(height)), height)
+                      for height in _KNOWN_HEIGHTS)
+
+class Animation(object):
+    """
+    A precomputed sequence of packed LED frames (see LedFrame.pack), each
+    shown for interval ms, or durations[i] ms with a list of durations.
+
+    loop: start over after the last frame, until cancelled.
+    hold: keep showing the last frame once done, until cancelled or
+          covered by an opaque playback started later.
+    opaque: replace the layers below instead of adding to them.
+    """
+
+    def __init__(self, frames, interval=50, loop=False, hold=False,
+                 opaque=True):
+        self.frames = [tuple(frame) for frame in frames]
+        if not self.frames:
+            raise ValueError("An animation needs at least one frame")
+        if isinstance(interval, (int, long, float)):
+            durations = [interval] * len(self.frames)
+        else:
+            durations = list(interval)
+        if len(durations) != len(self.frames):
+            raise ValueError("Need one duration per frame")
+
+        # start of each frame, in ms from the start of the animation
+        self.offsets = []
+        length = 0
+        for duration in durations:
+            self.offsets.append(length)
+            length += duration
+        self.length = length
+
+        self.loop = loop
+        self.hold = hold
+        self.opaque = opaque
+
+    @staticmethod
+    def from_masks(masks, interval=50, **options):
+        return Animation([LedFrame.pack(mask) for mask in masks], interval,
+                         **options)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def frame_at(self, elapsed):
+        """
+        Returns (index of the frame due elapsed ms after the start, time of
+        the next frame in ms from the start), the latter None once done.
+        """
+        cycle = 0
+        if elapsed >= self.length:
+            if not self.loop or self.length <= 0:
+                return len(self.frames) - 1, None
+            cycle = elapsed // self.length * self.length
+            elapsed -= cycle
+        index = max(bisect_right(self.offsets, elapsed) - 1, 0)
+        if index + 1 < len(self.offsets):
+            return index, cycle + self.offsets[index + 1]
+        return index, cycle + self.length
+
+    #
+    # BUILT-IN ANIMATIONS
+    #
+
+    @staticmethod
+    def sweep_from_center(delay=.05, **options):
+        """
+        The LEDs light up from the center outwards, one step per delay
+        seconds, ending with all on.
+        """
+        return Animation.from_masks([LedFrame.range(NUM_LEDS - 1 - i, i)
+                                     for i in range(NUM_LEDS // 2, NUM_LEDS)],
+                                    int(delay * 1000), **options)
+
+    @staticmethod
+    def bar_sweep(size=5, start=0, end=127, step=4, interval=20, **options):
+        """
+        A draw_bar() bar of given size moving from start to end (0-127).
+        """
+        step = abs(step) if end >= start else -abs(step)
+        return Animation.from_masks([LedFrame.bar(position, size) for position
+                                     in range(start, end + step, step)
+                                     if 0 <= position <= 127],
+                                    interval, **options)
+
+    @staticmethod
+    def bounce(size=5, step=4, interval=20, **options):
+        """
+        A bar moving up and down until cancelled.
+        """
+        positions = range(0, 128, step)
+        positions += positions[-2:0:-1]
+        options.setdefault("loop", True)
+        return Animation.from_masks([LedFrame.bar(position, size)
+                                     for position in positions],
+                                    interval, **options)
+
+    @staticmethod
+    def blink(mask=None, on=250, off=250, times=None, **options):
+        """
+        mask (default: all LEDs) on for on ms, then off for off ms,
+        times times or until cancelled. Transparent by default, so it can
+        blink over live output.
+        """
+        if mask is None:
+            mask = LedFrame.ALL
+        options.setdefault("opaque", False)
+        masks = [mask, LedFrame.OFF]
+        durations = [on, off]
+        if times is None:
+            options.setdefault("loop", True)
+        else:
+            masks *= times
+            durations *= times
+        return Animation.from_masks(masks, durations, **options)
+
+class Backend(object):
+    """
+    Interface between VMeter and a MIDI library.
+
+    Ports returned by open_input() and open_output() follow the pypm API:
+    inputs have Poll(), Read(n) and Close(); outputs have
+    Write([[[status, data1, data2], timestamp], ...]),
+    WriteShort(status, data1, data2) and Close().
+    """
+
+    def count_devices(self):
+        raise NotImplementedError
+
+    def get_device_info(self, device):
+        """
+        Returns (interface, name, input, output, opened) for a device number.
+        """
+        raise NotImplementedError
+
+    def open_input(self, device):
+        raise NotImplementedError
 
-def print_devices(InOrOut=None):
-    for i, (interf,name,inp,outp,opened) in enumerate(get_devices()):
-        if ((InOrOut == _INPUT) and (inp == 1) or
-            (InOrOut == _OUTPUT) and (outp == 1) or
+    def open_output(self, device):
+        raise NotImplementedError
+
+    def time(self):
+        """
+        Current time in milliseconds, on the clock used for event timestamps.
+        """
+        raise NotImplementedError
+
+    def rescan(self):
+        """
+        Re-enumerates the devices, to pick up ones plugged in since.
+        May invalidate every open port; see DeviceRegistry.rescan().
+        """
+        pass
+
+    # the DeviceRegistry of this backend, see get_registry()
+    registry = None
+
+class PypmBackend(Backend):
+    """
+    Backend using pygame.pypm (PortMidi).
+    """
+
+    def __init__(self):
+        from pygame import pypm
+        self.pypm = pypm
+        pypm.Initialize()
+
+    def count_devices(self):
+        return self.pypm.CountDevices()
+
+    def get_device_info(self, device):
+        return self.pypm.GetDeviceInfo(device)
+
+    def open_input(self, device):
+        return self.pypm.Input(device)
+
+    def open_output(self, device):
+        return self.pypm.Output(device)
+
+    def time(self):
+        return self.pypm.Time()
+
+    def rescan(self):
+        # PortMidi only enumerates devices in Pm_Initialize()
+        self.pypm.Terminate()
+        self.pypm.Initialize()
+
+_backend = None
+
+def get_backend():
+    """
+    Returns the default backend, a PypmBackend unless set_backend()
+    was called.
+    """
+    global _backend
+    if _backend is None:
+        _backend = PypmBackend()
+    return _backend
+
+def set_backend(backend):
+    """
+    Sets the backend used by VMeters created without one.
+    """
+    global _backend
+    _backend = backend
+
+def get_devices(backend=None):
+    if backend is None:
+        backend = get_backend()
+    for i in range(backend.count_devices()):
+        yield backend.get_device_info(i)
+
+def print_devices(InOrOut=None, backend=None):
+    for info in get_registry(backend).devices:
+        if ((InOrOut == _INPUT) and info.input or
+            (InOrOut == _OUTPUT) and info.output or
             (InOrOut == None)):
-            print i, name, "\t",
-            if (inp == 1):
+            print info.number, info.name, "\t",
+            if info.input:
                 print "(input) \t",
             else:
                 print "(output)\t",
-            if (opened == 1):
+            if info.opened:
                 print "(opened)"
             else:
                 print "(unopened)"
     print
 
+def get_registry(backend=None):
+    """
+    Returns the DeviceRegistry shared by everything using backend.
+    """
+    if backend is None:
+        backend = get_backend()
+    if backend.registry is None:
+        backend.registry = DeviceRegistry(backend)
+    return backend.registry
+
+class DeviceInfo(object):
+    """
+    One entry of the device list, see DeviceRegistry.
+    """
+
+    def __init__(self, number, interface, name, input, output, opened,
+                 occurrence=0):
+        self.number = number
+        self.interface = interface
+        self.name = name
+        self.input = bool(input)
+        self.output = bool(output)
+        self.opened = bool(opened)
+        # how many inputs (or outputs) with the same name come before it
+        self.occurrence = occurrence
+
+    def __repr__(self):
+        return "<DeviceInfo %d %r %s%s>" % (
+            self.number, self.name, "input" if self.input else "output",
+            " opened" if self.opened else "")
+
+class DeviceRegistry(object):
+    """
+    Cached device list of a backend, and hot-plug handling.
+
+    The list is read once and kept up to date as ports are opened and
+    closed through the registry, so connecting more VMeters doesn't
+    enumerate every MIDI device again. refresh() rereads it.
+
+    VMeters using the registry report lost devices (failed reads or
+    writes); rescan() re-enumerates and reconnects every VMeter to its
+    strip, and start_monitor() does that automatically once something was
+    lost.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.devices = []
+        self.vmeters = []
+        self.lost_devices = 0
+        self.rescans = 0
+        self.monitor = None
+        self._lock = threading.RLock()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Rereads the device list from the backend.
+        """
+        self._lock.acquire()
+        try:
+            devices = [DeviceInfo(i, *info) for i, info
+                       in enumerate(get_devices(self.backend))]
+            seen = {}
+            for info in devices:
+                key = (info.name, info.input)
+                info.occurrence = seen.get(key, 0)
+                seen[key] = info.occurrence + 1
+            self.devices = devices
+        finally:
+            self._lock.release()
+
+    def find(self, name=None, input=False, output=False, unopened=True):
+        """
+        Returns the first DeviceInfo that is an input (or output) with
+        name (default: any name containing "VMeter"), or None.
+        """
+        for info in self.devices:
+            if ((input and not info.input) or (output and not info.output) or
+                (unopened and info.opened)):
+                continue
+            if (info.name == name if name is not None
+                else "VMeter" in info.name):
+                return info
+        return None
+
+    def pairs(self):
+        """
+        Returns [(name, input device, output device), ...] for the unopened
+        VMeters, pairing each input with an output of the same name.
+        """
+        outputs = [info for info in self.devices
+                   if info.output and not info.opened and "VMeter" in info.name]
+        pairs = []
+        for info in self.devices:
+            if info.input and not info.opened and "VMeter" in info.name:
+                for o, output in enumerate(outputs):
+                    if output.name == info.name:
+                        pairs.append((info.name, info.number, output.number))
+                        del outputs[o]
+                        break
+        return pairs
+
+    def open_input(self, device):
+        self._lock.acquire()
+        try:
+            port = self.backend.open_input(device)
+            if device < len(self.devices):
+                self.devices[device].opened = True
+            return port
+        finally:
+            self._lock.release()
+
+    def open_output(self, device):
+        self._lock.acquire()
+        try:
+            port = self.backend.open_output(device)
+            if device < len(self.devices):
+                self.devices[device].opened = True
+            return port
+        finally:
+            self._lock.release()
+
+    def closed(self, device):
+        """
+        Marks a device as no longer opened.
+        """
+        if device is not None and device < len(self.devices):
+            self.devices[device].opened = False
+
+    def register(self, vmeter):
+        self._lock.acquire()
+        try:
+            if vmeter not in self.vmeters:
+                self.vmeters.append(vmeter)
+        finally:
+            self._lock.release()
+
+    def unregister(self, vmeter):
+        self._lock.acquire()
+        try:
+            if vmeter in self.vmeters:
+                self.vmeters.remove(vmeter)
+        finally:
+            self._lock.release()
+
+    def lost(self, vmeter):
+        """
+        Called by a VMeter whose device stopped answering.
+        """
+        self.lost_devices += 1
+
+    def disconnected(self):
+        """
+        Returns the registered VMeters that lost their device.
+        """
+        return [v for v in self.vmeters if not v.connected]
+
+    def rescan(self):
+        """
+        Re-enumerates the devices and reconnects every registered VMeter
+        whose device is present. Returns the number of VMeters connected
+        afterwards.
+
+        With PortMidi this restarts the library, so every VMeter is
+        disconnected first (waiting for reads and writes in progress and
+        closing its ports) and reconnected after, not only the lost ones.
+
+        Strips of one model share a port name, so each VMeter is matched to
+        its strip by position among the ports of that name (see
+        VMeter.slot), assuming the enumeration keeps the strips in order.
+        VMeters that didn't lose their device are placed first; the lost
+        ones only get the ports left over. If only some of several lost
+        strips of one name are back, the ones with the lower slots are
+        taken to be back.
+        """
+        self._lock.acquire()
+        try:
+            lost = self.disconnected()
+            for v in self.vmeters:
+                v.disconnect()
+            self.backend.rescan()
+            self.refresh()
+            self.rescans += 1
+
+            groups = {}
+            for v in self.vmeters:
+                groups.setdefault(v.device_name, []).append(v)
+            pairs = self.pairs()
+            connected = 0
+            for name, group in groups.items():
+                group.sort(key=lambda v: v.slot)
+                ports = [(input, output) for n, input, output in pairs
+                         if n == name]
+                missing = len(group) - len(ports)
+                if missing > 0:
+                    # drop the lost VMeters whose strips are still away
+                    gone = [v for v in group if v in lost][-missing:]
+                    group = [v for v in group if v not in gone]
+                for v, (input, output) in zip(group, ports):
+                    if v.reconnect(input, output):
+                        connected += 1
+            return connected
+        finally:
+            self._lock.release()
+
+    def check(self):
+        """
+        Rescans if any registered VMeter lost its device.
+        """
+        if self.disconnected():
+            self.rescan()
+
+    def start_monitor(self, interval=2.0):
+        """
+        Starts a thread calling check() every interval seconds.
+        """
+        if self.monitor is None:
+            self.monitor = IntervalThread(self.check, interval,
+                                          name="DeviceMonitor")
+            self.monitor.start()
+        return self.monitor
+
+    def stop_monitor(self):
+        if self.monitor is not None:
+            self.monitor.stop()
+            self.monitor.join()
+            self.monitor = None
+
 class VMeter(object):
     """Class used to communicate with a VMeter.
 
     NOTE: this class has not been tested with more than one VMeter connected.
     """
 
-    def __init__(self, input_device=None, output_device=None):
-        pypm.Initialize()
-        
+    def __init__(self, input_device=None, output_device=None, batch_size=64,
+                 adaptive=True, min_interval=.001, max_interval=.02,
+                 threaded_output=False, backend=None, reader=True,
+                 query_settings=True):
+        if backend is None:
+            backend = get_backend()
+        self.backend = backend
+        self.registry = get_registry(backend)
+
         self._in = None
         self._out = None
+        self.input_device = None
+        self.output_device = None
+        self.device_name = None
+        # position among the inputs named device_name when connected,
+        # which tells strips of the same model apart, see
+        # DeviceRegistry.rescan()
+        self.slot = 0
+        self.connected = False
         self.connect(input_device, output_device)
-    
-        # controller mappings
-        # TODO: update from read_settings()
-        self.ctrl_out_on_off = 17
-        self.ctrl_out_pressure = 18
-        self.ctrl_out_touch_pos = 20
-        self.ctrl_in_light = 20
-        self.ctrl_in_brightness = 21
+        self.registry.register(self)
 
+        # serialize access to the ports, see disconnect()
+        self._in_lock = threading.Lock()
+        self._out_lock = threading.Lock()
+
+        # queued output, see start_writer(); None means synchronous writes
+        self.writer = None
+        if threaded_output:
+            self.start_writer()
+    
         self.handlers = {}
+        self._throttled = []
+
+        # counters, see enable_stats(); None while disabled
+        self._stats = None
+        self.stats_dumper = None
+
+        # device state from read_settings() and get_version(), None until
+        # the replies came in; setters keep self.settings up to date
+        self.settings = None
+        self.version = None
+        # LED column orientation, None while unknown
+        self.upside_down = None
+        # modes overriding the LED column input
+        self.pitch_wheel = False
+        self.cross_fader = False
+        # column heights for frames that can be sent as one, see send_packed
+        self._columns = _COLUMN_FRAMES
+        self._settings_reply = Reply(SETTINGS_LENGTH, self._got_settings,
+                                     Settings.MARKER)
+        # values set since the outstanding settings query went out, which
+        # its reply doesn't have yet; None while no query is outstanding
+        self._settings_changes = None
+        self._settings_lock = threading.Lock()
+        self._version_reply = Reply(VERSION_LENGTH, self._got_version)
+
+        # controller mappings, replaced by the device's once its settings
+        # are known
+        self.reset_mappings()
+
+        # last six LED data bytes sent, None when the device state is unknown;
+        # the lock keeps it in step with what was actually written
+        self._last_frame = None
+        self._frame_lock = threading.Lock()
+        self.leds_ignore_touch = False
+        self.frames_sent = 0
+        self.messages_sent = 0
+        self.messages_suppressed = 0
+        # frames sent as a single column message, and the aftertouch
+        # messages that saved
+        self.column_frames = 0
+        self.messages_saved = 0
+
+        # rate-limited LED output, see start_scheduler()
+        self.scheduler = None
+
+        # timed LED animations, see play()
+        self.animator = None
+
+        # shared threads for Policy.POOL handlers, see get_handler_pool()
+        self.handler_pool = None
+
+        # maximum number of events fetched by a single Read() in dispatch()
+        self.batch_size = batch_size
+
+        # pypm timestamp (ms) of the event being handled
+        self.timestamp = None
+
+        # gets every batch of raw events read, see VMeterRecord
+        self.recorder = None
+
+        # per-tick event counts, useful for sizing batch_size
+        self.tick_events = 0
+        self.max_tick_events = 0
+        self.total_events = 0
+        self.ticks = 0
+
+        # The adaptive reader backs off while the strip is idle;
+        # adaptive=False keeps polling every min_interval.
+        # With reader=False, dispatch() has to be called by someone else
+        # (e.g. a VMeterPool).
+        self.reader = None
+        if reader:
+            if adaptive:
+                self.reader = AdaptiveThread(self.dispatch,
+                                             min_interval=min_interval,
+                                             max_interval=max_interval)
+            else:
+                self.reader = IntervalThread(self.dispatch,
+                                             interval=min_interval)
+            self.reader.start()
 
-        self.reader = IntervalThread(self.dispatch, interval=.001)
-        self.reader.start()
+        if query_settings:
+            self.read_settings(timeout=None)
 
     #
     # CONNECTION
     #
 
     def connect(self, input_device=None, output_device=None):
+        if input_device is None and output_device is None:
+            pairs = self.registry.pairs()
+            if pairs:
+                name, input_device, output_device = pairs[0]
         self._in = self.connectInput(device=input_device)
         self._out = self.connectOutput(device=output_device)
+        self.slot = self.registry.devices[self.input_device].occurrence
+        self.connected = True
 
     def connectInput(self, device=None):
         """
@@ -155,15 +987,15 @@ class VMeter(object):
         to the first unopened input device with "VMeter" in the name.
         """
         if device is None:
-            a = [i for (i, (_, name, inp, outp, opened))
-                in enumerate(get_devices())
-                if inp==1 and opened == 0 and "VMeter" in name]
-            if len(a) > 0:
-                device = a[0]
-            else:
+            info = self.registry.find(input=True)
+            if info is None:
                 raise Exception("No unopened VMeter input devices found!")
+            device = info.number
 
-        return pypm.Input(device) 
+        port = self.registry.open_input(device)
+        self.input_device = device
+        self.device_name = self.registry.devices[device].name
+        return port
 
     def connectOutput(self, device=None):
         """
@@ -172,27 +1004,113 @@ class VMeter(object):
         to the first unopened output device with "VMeter" in the name.
         """
         if device is None:
-            a = [i for (i, (_, name, inp, outp, opened))
-                in enumerate(get_devices())
-                if outp==1 and opened == 0 and "VMeter" in name]
-            if len(a) > 0:
-                device = a[0]
-            else:
+            info = self.registry.find(output=True)
+            if info is None:
                 raise Exception("No unopened VMeter output devices found!")
+            device = info.number
+
+        port = self.registry.open_output(device)
+        self.output_device = device
+        if self.device_name is None:
+            self.device_name = self.registry.devices[device].name
+        return port
+
+    def _lost(self):
+        # a read or write failed: the device was most likely unplugged
+        if self.connected:
+            self.connected = False
+            self.registry.lost(self)
+
+    def reconnect(self, input_device=None, output_device=None):
+        """
+        Reopens the ports of the device this VMeter was connected to,
+        closing the old ones first if still open. Returns True if connected
+        afterwards.
+
+        Without device numbers, the first unopened ports with the old
+        device name are used; with several strips of the same model, that
+        may be another one, see DeviceRegistry.rescan().
+        """
+        self.disconnect()
+        if input_device is None or output_device is None:
+            for name, input, output in self.registry.pairs():
+                if name == self.device_name:
+                    input_device, output_device = input, output
+                    break
+            else:
+                return False
 
-        return pypm.Output(device)
+        self._in = self.connectInput(input_device)
+        self._out = self.connectOutput(output_device)
+        self._out_lock.acquire()
+        try:
+            if self.writer is not None:
+                self.writer.output = self._out
+            self.connected = True
+        finally:
+            self._out_lock.release()
+        self.invalidate_frame()
+
+        # a replugged strip comes back with its stored settings
+        self.invalidate_settings()
+        self.read_settings(timeout=None)
+        return True
+
+    def disconnect(self):
+        """
+        Closes the ports but stays registered, so that reconnect() can
+        reopen them. A read or write in progress finishes first; until
+        reconnected, reads return nothing and output is dropped.
+        """
+        self._in_lock.acquire()
+        self._out_lock.acquire()
+        try:
+            self.connected = False
+            if self.writer is not None:
+                self.writer.output = None
+            for port, device in ((self._in, self.input_device),
+                                 (self._out, self.output_device)):
+                if port is not None:
+                    try:
+                        port.Close()
+                    except Exception:
+                        # the device may be gone already
+                        pass
+                    self.registry.closed(device)
+            self._in = None
+            self._out = None
+        finally:
+            self._out_lock.release()
+            self._in_lock.release()
+
+    def stop(self):
+        """
+        Stops the reader thread and waits for it to finish.
+        """
+        if self.reader is not None and self.reader.is_alive():
+            self.reader.stop()
+            self.reader.join()
+        self.stop_scheduler()
+        self.stop_animator()
+        self.stop_handlers()
+        self.stop_writer()
+        self.stop_stats_dump()
 
     def close(self):
+        self.stop()
+        self.registry.unregister(self)
         self.closeInput()
         self.closeOutput()
 
     def closeInput(self):
         if (self._in is not None):
             self._in.Close()
+            self.registry.closed(self.input_device)
 
     def closeOutput(self):
         if (self._out is not None):
             self._out.Close()
+            self.registry.closed(self.output_device)
 
     #
     # SETTINGS
@@ -202,20 +1120,20 @@ class VMeter(object):
         """
         When enabled, VMeter will send 127 via ctrl #17 when touched, 0 when released.
         """
-        self.send_config(120 if which else 119)
+        self._set_flag("output_on_off", which)
 
     def set_output_touch_position(self, which):
         """
         When enabled, VMeter will output touch position.
         Disabling this is useful when setting up mappings.
         """
-        self.send_config(124 if which else 123)
+        self._set_flag("output_touch_position", which)
 
     def set_output_pressure(self, which):
         """
         When enabled, VMeter will output pressure intensity.
         """
-        self.send_config(122 if which else 121)
+        self._set_flag("output_pressure", which)
 
     def set_upside_down_mode(self, which):
         """
@@ -223,7 +1141,9 @@ class VMeter(object):
         MIDI controller outputs are also referenced from the bottom.
         Useful if you want all the USB cables to go away from you rather than towards.
         """
-        self.send_config(125 if which else 126)
+        self._set_flag("upside_down", which)
+        self.upside_down = bool(which)
+        self._update_encoder()
 
 
     def set_LEDs_ignore_touch(self, which):
@@ -233,7 +1153,8 @@ class VMeter(object):
         Useful if you don’t want the LED pattern being controlled by MIDI to be
         overridden by touch.
         """
-        self.send_config(107 if which else 106)
+        self._set_flag("leds_ignore_touch", which)
+        self.leds_ignore_touch = bool(which)
 
     def recalibrate_touch_sensor(self):
         """
@@ -249,14 +1170,16 @@ class VMeter(object):
         """
         When enabled, VMeter will output note on/off messages.
         """
-        self.send_config(117 if which else 116)
+        self._set_flag("note_on_off", which)
 
     def set_pitch_wheel_mode(self, which):
         """
         When enabled, VMeter will behave as a pitch wheel.
         This overrides the lights.
         """
-        self.send_config(115 if which else 114)
+        self._set_flag("pitch_wheel", which)
+        self.pitch_wheel = bool(which)
+        self._update_encoder()
 
     def set_cross_fader_mode(self, which):
         """
@@ -264,33 +1187,102 @@ class VMeter(object):
         Output is same as pitch wheel without snapping back to center.
         This overrides the lights.
         """
-        self.send_config(105 if which else 104)
+        self._set_flag("cross_fader", which)
+        self.cross_fader = bool(which)
+        self._update_encoder()
 
     def set_noteout_velocity_mode(self, which):
         """
         When enabled, velocity of note-outs is based on position.
         When disabled, note-outs use preset velocity. (Default 100)
         """
-        self.send_config(111 if which else 110)
+        self._set_flag("noteout_velocity_mode", which)
 
     def set_noteout_pitch_mode(self, which):
         """
         When enabled, pitch of note-outs is based on position.
         When disabled, note-outs use preset pitch. (Default 64)
         """
-        self.send_config(109 if which else 108)
+        self._set_flag("noteout_pitch_mode", which)
 
-    def get_version(self):
+    def _set_flag(self, name, which):
         """
-        Returns the 4 digit version as ASCII via controller number 109.
+        Sends the config value switching flag name on or off, unless the
+        cached settings say it already is.
         """
+        which = bool(which)
+        self._settings_lock.acquire()
+        try:
+            settings = self.settings
+            if settings is not None and getattr(settings, name) == which:
+                return
+            byte, bit, on, off = Settings.FLAGS[name]
+            self.send_config(on if which else off)
+            self._changed_setting(name, which)
+        finally:
+            self._settings_lock.release()
+
+    def _set_controller(self, name, value):
+        """
+        Sends a new value for setting name over its controller, unless the
+        cached settings already have it. Returns True if it was sent.
+        """
+        self._settings_lock.acquire()
+        try:
+            settings = self.settings
+            if settings is not None and getattr(settings, name) == value:
+                return False
+            byte, ctrl = Settings.CONTROLLERS[name]
+            self.send_controller(ctrl, value)
+            self._changed_setting(name, value)
+            return True
+        finally:
+            self._settings_lock.release()
+
+    def _changed_setting(self, name, value):
+        # called with _settings_lock held, after sending the change
+        if self.settings is not None:
+            setattr(self.settings, name, value)
+        if self._settings_changes is not None:
+            self._settings_changes[name] = value
+
+    def invalidate_settings(self):
+        """
+        Forgets the cached settings, e.g. after another program changed
+        them; the next setter calls are sent unconditionally.
+        """
+        self.settings = None
+        self.upside_down = None
+        self._update_encoder()
+
+    def get_version(self, timeout=1.0):
+        """
+        Requests the 4 digit version, which comes back as ASCII via
+        controller number 109, and returns it as a string.
+
+        Waits up to timeout seconds for the reader to get the reply; returns
+        None if it hasn't arrived by then (it is still stored in
+        self.version when it does). Don't wait from a handler, the reply
+        can't be read while the reader thread is blocked.
+        """
+        self._version_reply.expect()
         self.send_config(103)
+        if timeout:
+            self._version_reply.wait(timeout)
+        return self.version
+
+    def _got_version(self, data):
+        self.version = "".join(chr(c) for c in data)
 
-    def read_settings(self):
+    def read_settings(self, timeout=1.0):
         """
         Reads VMeter's current settings.
         Used to update the configuration utility interface.
 
+        Returns a Settings object, cached as self.settings, which also
+        updates the MIDI channel and controller mappings used to dispatch
+        events. Waits for the reply like get_version().
+
         0 : [85]
         1 : 8 = output_pressure, 4 = output_on_off, 2 = output_touch_position, 1 = upside-down mode
         2 : 32 = cross-fader mode, 16 = noteout pitch mode, 8 = noteout velocity mode, 4 = LEDs ignore touch, 2 = note on/off messages, 1 = pitch wheel mode
@@ -309,7 +1301,37 @@ class VMeter(object):
         15: pitch wheel mode : return-to-center speed
 
         """
-        self.send_config(113)
+        self._settings_lock.acquire()
+        try:
+            self._settings_changes = {}
+            self._settings_reply.expect()
+            self.send_config(113)
+        finally:
+            self._settings_lock.release()
+        if timeout:
+            self._settings_reply.wait(timeout)
+        return self.settings
+
+    def _got_settings(self, data):
+        # reader thread; the reply reflects the device as it was when the
+        # query arrived, so anything set since is applied on top of it
+        settings = Settings.parse(data)
+        self._settings_lock.acquire()
+        try:
+            changes = self._settings_changes or {}
+            self._settings_changes = None
+            for name, value in changes.items():
+                setattr(settings, name, value)
+            self._use_settings(settings)
+        finally:
+            self._settings_lock.release()
+
+    def _use_settings(self, settings):
+        self.settings = settings
+        for name in _MAPPED_SETTINGS:
+            setattr(self, name, getattr(settings, name))
+        self._update_encoder()
+        self.rebuild_dispatch()
 
     def store_settings(self):
         """
@@ -338,6 +1360,75 @@ class VMeter(object):
         """
         self.send_config(118)
 
+    def configure(self, values, store=True, timeout=1.0):
+        """
+        Brings the device to the given settings, a dict of Settings
+        attributes (see VMeterProfile for a file format).
+
+        Only values differing from the known device state are sent, all in
+        one batch, ending with the store_settings() message if store is true
+        and anything persisted changed. If the settings aren't known yet they
+        are read first (see read_settings() for timeout); if they still
+        aren't, everything is sent.
+        Returns the number of messages sent.
+        """
+        if self.settings is None and timeout:
+            self.read_settings(timeout)
+        self._settings_lock.acquire()
+        try:
+            return self._configure(values, store)
+        finally:
+            self._settings_lock.release()
+
+    def _configure(self, values, store):
+        # called with _settings_lock held
+        current = self.settings
+        target = (current or Settings()).copy()
+        for name, value in values.items():
+            if not hasattr(target, name):
+                raise TypeError("Unknown setting %r" % name)
+            if name in Settings.VALUES and name != "brightness":
+                raise ValueError("%s can't be changed" % name)
+            setattr(target, name, value)
+        target.validate()
+
+        changed = [name for name in values
+                   if current is None or
+                   getattr(current, name) != getattr(target, name)]
+
+        messages = []
+        for name in sorted(changed):
+            if name in Settings.FLAGS:
+                byte, bit, on, off = Settings.FLAGS[name]
+                messages.append((CONTROL, CTRL_CONFIG,
+                                 on if getattr(target, name) else off))
+        for name in sorted(changed):
+            if name in Settings.CONTROLLERS:
+                byte, ctrl = Settings.CONTROLLERS[name]
+                messages.append((CONTROL, ctrl, getattr(target, name)))
+        if "brightness" in changed:
+            # goes over the new channel and brightness controller
+            messages.append((CONTROL | (target.midi_channel - 1),
+                             target.ctrl_in_brightness, target.brightness))
+        if store and [name for name in changed if name in Settings.PERSISTED]:
+            messages.append((CONTROL, CTRL_CONFIG, 118))
+
+        if messages:
+            self._write(messages, True)
+        if self._settings_changes is not None:
+            for name in changed:
+                self._settings_changes[name] = getattr(target, name)
+        if current is not None:
+            self._use_settings(target)
+        else:
+            # only the values sent are known
+            for name in _MAPPED_SETTINGS:
+                if name in values:
+                    setattr(self, name, values[name])
+            self._update_encoder()
+            self.rebuild_dispatch()
+        return len(messages)
+
     def set_MIDI_channel(self, value):
         """
         Changes the channel over which Input and Output messages are sent.
@@ -345,7 +1436,9 @@ class VMeter(object):
 
         value 1-16
         """
-        self.send_controller(117, value)
+        if self._set_controller("midi_channel", value):
+            self.midi_channel = value
+            self.rebuild_dispatch()
 
     def set_output_position_ctrl(self, value):
         """
@@ -353,7 +1446,9 @@ class VMeter(object):
 
         value 0-100
         """
-        self.send_controller(116, value)
+        if self._set_controller("ctrl_out_touch_pos", value):
+            self.ctrl_out_touch_pos = value
+            self.rebuild_dispatch()
 
     def set_output_on_off_ctrl(self, value):
         """
@@ -361,7 +1456,9 @@ class VMeter(object):
 
         value 0-100
         """
-        self.send_controller(115, value)
+        if self._set_controller("ctrl_out_on_off", value):
+            self.ctrl_out_on_off = value
+            self.rebuild_dispatch()
 
     def set_output_pressure_ctrl(self, value):
         """
@@ -369,7 +1466,9 @@ class VMeter(object):
 
         value 0-100
         """
-        self.send_controller(114, value)
+        if self._set_controller("ctrl_out_pressure", value):
+            self.ctrl_out_pressure = value
+            self.rebuild_dispatch()
 
     def set_input_light_ctrl(self, value):
         """
@@ -377,7 +1476,8 @@ class VMeter(object):
 
         value 0-100
         """
-        self.send_controller(113, value)
+        self._set_controller("ctrl_in_light", value)
+        self.ctrl_in_light = value
 
     def set_input_brightness_ctrl(self, value):
         """
@@ -385,7 +1485,8 @@ class VMeter(object):
 
         value 0-100
         """
-        self.send_controller(112, value)
+        self._set_controller("ctrl_in_brightness", value)
+        self.ctrl_in_brightness = value
 
     def set_noteout_number(self, value):
         """
@@ -393,7 +1494,7 @@ class VMeter(object):
 
         value 0-127
         """
-        self.send_controller(111, value)
+        self._set_controller("noteout_number", value)
 
     def set_noteout_velocity(self, value):
         """
@@ -401,7 +1502,7 @@ class VMeter(object):
 
         value 0-127
         """
-        self.send_controller(110, value)
+        self._set_controller("noteout_velocity", value)
 
     def set_brightness(self, value):
         """
@@ -410,7 +1511,15 @@ class VMeter(object):
         value 0-16 (0 = off)
         """
         vals = [0, 7, 15, 23, 31, 39, 47, 55, 63, 71, 79, 87, 95, 103, 111, 119, 127]
-        self.send_controller(21, vals[value])
+        self._settings_lock.acquire()
+        try:
+            settings = self.settings
+            if settings is not None and settings.brightness == vals[value]:
+                return
+            self._write(((self._status, self.ctrl_in_brightness, vals[value]),), True)
+            self._changed_setting("brightness", vals[value])
+        finally:
+            self._settings_lock.release()
 
     #
     # SENDING DATA
@@ -431,39 +1540,207 @@ class VMeter(object):
         self.send_controller(CTRL_CONFIG, value)
 
     def send_controller(self, ctrl, value):
-        self._out.WriteShort(CONTROL, ctrl, value)
+        self._write(((CONTROL, ctrl, value),), True)
+
+    def _write(self, messages, config=False):
+        """
+        Sends a sequence of (status, data1, data2) messages, as one unit.
+
+        With a writer thread running the messages are queued, config ones
+        ahead of LED traffic; otherwise they are written immediately.
+        Output to a lost device (see reconnect()) is dropped.
+        """
+        if not self.connected:
+            return
+
+        stats = self._stats
+        if stats is not None:
+            stats.count_output(messages)
 
-    def send_array(self, array):
+        writer = self.writer
+        if writer is not None:
+            writer.put(messages, config)
+            return
+
+        self._out_lock.acquire()
+        try:
+            if not self.connected:
+                return
+            for status, data1, data2 in messages:
+                self._out.WriteShort(status, data1, data2)
+        except Exception:
+            if stats is not None:
+                stats.write_errors += 1
+            self._lost()
+        finally:
+            self._out_lock.release()
+
+    def send_array(self, array, force=False):
         """
         Sends an array of 1's and 0's as LED on/off data.
         Assumes length 38 array.
+        Unchanged parts of the frame are not resent, see send_packed.
+        """
+        self.send_packed(LedFrame.pack(LedFrame.from_array(array)), force)
+
+    def send_mask(self, mask, force=False):
         """
-        
-        # Need to split array into (6) 7-bit chunks
+        Sends an LED frame given as a 38-bit integer, see LedFrame.
+        """
+        # Need to split the mask into (6) 7-bit chunks
         # Individual LED control is sent to the aftertouch MIDI command and
         # channels 14, 15 and 16.
         # Each of the data bytes transmit 7 LED states.
+        self.send_packed(LedFrame.pack(mask), force)
+
+    def send_packed(self, data, force=False):
+        """
+        Sends six packed LED data bytes, as built by send_array.
 
-        bytes = [0,0,0,0,0,0]
-        bytes[0] =  array[0] |  array[1]<<1 |  array[2]<<2 |  array[3]<<3 |  array[4]<<4 |  array[5]<<5 |  array[6]<<6
-        bytes[1] =  array[7] |  array[8]<<1 |  array[9]<<2 | array[10]<<3 | array[11]<<4 | array[12]<<5 | array[13]<<6
-        bytes[2] = array[14] | array[15]<<1 | array[16]<<2 | array[17]<<3 | array[18]<<4 | array[19]<<5 | array[20]<<6
-        bytes[3] = array[21] | array[22]<<1 | array[23]<<2 | array[24]<<3 | array[25]<<4 | array[26]<<5 | array[27]<<6
-        bytes[4] = array[28] | array[29]<<1 | array[30]<<2 | array[31]<<3 | array[32]<<4 | array[33]<<5 | array[34]<<6
-        bytes[5] = array[35] | array[36]<<1 | array[37]<<2
-        self._out.WriteShort(0xAD,bytes[0],bytes[1])
-        self._out.WriteShort(0xAE,bytes[2],bytes[3])
-        self._out.WriteShort(0xAF,bytes[4],bytes[5])
+        Only the aftertouch messages whose pair of bytes changed since the
+        last frame are sent, and an identical frame sends nothing at all.
+        Use force=True to send the whole frame regardless.
+
+        A frame with all LEDs off or all on goes out as one send_column
+        message when that is cheaper. Other columns are not, as long as
+        LedFrame.height() is not checked against a device.
+        """
+        self._frame_lock.acquire()
+        try:
+            last = self._last_frame
+            if last is None:
+                force = True
+
+            messages = [(status, data[a], data[b])
+                        for status, a, b in _LED_PAIRS
+                        if force or data[a] != last[a] or data[b] != last[b]]
+            sent = len(messages)
+            # unchanged pairs; pairs replaced by a column message are
+            # counted in messages_saved instead
+            self.messages_suppressed += 3 - sent
+            if sent > 1 and self._columns is not None:
+                data = tuple(data)
+                height = self._columns.get(data)
+                if height is not None:
+                    # a single column message draws the same frame
+                    messages = [(self._status, self.ctrl_in_light, height)]
+                    self.column_frames += 1
+                    self.messages_saved += sent - 1
+                    sent = 1
+            if sent:
+                # all changed pairs of one frame go out together
+                self._write(messages)
+
+            self._last_frame = tuple(data)
+            if sent:
+                self.frames_sent += 1
+            self.messages_sent += sent
+        finally:
+            self._frame_lock.release()
+
+    def _update_encoder(self):
+        """
+        Enables sending column frames as column messages, unless pitch
+        wheel or cross fader mode override the LED column input.
+        """
+        if self.pitch_wheel or self.cross_fader:
+            self._columns = None
+        else:
+            self._columns = _COLUMN_FRAMES
+
+    def invalidate_frame(self):
+        """
+        Forgets the last LED frame, so the next one is sent in full.
+        Needed whenever the LEDs may have changed behind send_packed's back.
+        """
+        self._frame_lock.acquire()
+        try:
+            self._last_frame = None
+        finally:
+            self._frame_lock.release()
 
     def send_column(self, height):
         """
         Send a column of height from 0 to 127.
         """
-        self._out.WriteShort(CONTROL, self.ctrl_in_light, height)
+        self._frame_lock.acquire()
+        try:
+            self._write(((self._status, self.ctrl_in_light, height),))
+            if self._columns is not None and height in _KNOWN_HEIGHTS:
+                self._last_frame = LedFrame.pack(LedFrame.height(height))
+            else:
+                self._last_frame = None
+        finally:
+            self._frame_lock.release()
 
     def clear(self):
         self.send_column(0)
 
+    #
+    # SCHEDULING
+    #
+
+    def start_writer(self):
+        """
+        Starts an OutputWriter thread; from then on all output is queued
+        and written in batches instead of blocking the caller.
+        """
+        if self.writer is None:
+            self.writer = OutputWriter(self._out, self._out_lock,
+                                       on_error=self._lost)
+            self.writer.start()
+        return self.writer
+
+    def stop_writer(self):
+        """
+        Writes out anything still queued, stops the writer thread and
+        returns to synchronous writes.
+        """
+        writer = self.writer
+        if writer is not None:
+            self.writer = None
+            writer.stop()
+            writer.join()
+
+    def start_scheduler(self, max_fps=60):
+        """
+        Starts a FrameScheduler that sends LED frames posted to it at no
+        more than max_fps, keeping only the latest one.
+        Returns the scheduler; frames are posted with its post_* methods.
+        """
+        self.stop_scheduler()
+        self.scheduler = FrameScheduler(self, max_fps)
+        self.scheduler.start()
+        return self.scheduler
+
+    def stop_scheduler(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler.join()
+            self.scheduler = None
+
+    def start_animator(self):
+        """
+        Starts the Animator thread if needed and returns it.
+        """
+        if self.animator is None:
+            self.animator = Animator(self)
+            self.animator.start()
+        return self.animator
+
+    def stop_animator(self):
+        if self.animator is not None:
+            self.animator.stop()
+            self.animator.join()
+            self.animator = None
+
+    def play(self, animation, layer=0):
+        """
+        Plays an Animation on top of whatever else the Animator shows.
+        Returns its Playback, which can be waited for or cancelled.
+        """
+        return self.start_animator().play(animation, layer)
+
     #
     # RECEIVING DATA
     #
@@ -478,8 +1755,8 @@ class VMeter(object):
         midi_data = self.read()
 
         if midi_data is not None:
-            if midi_data[0] == CONTROL:
-                if midi_data[1] == TOUCH_POS:
+            if midi_data[0] == self._status:
+                if midi_data[1] == self.ctrl_out_touch_pos:
                     return int(midi_data[2])
 
         return None
@@ -488,81 +1765,388 @@ class VMeter(object):
     # EVENTING
     #
 
-    def register(self, eventType, handler):
-        try:
-            handlers = self.handlers[eventType]
-        except KeyError:
-            handlers = self.handlers[eventType] = []
+    def reset_mappings(self):
+        """
+        Resets the MIDI channel and controller mappings to the factory
+        defaults and rebuilds the dispatch table.
+        """
+        self.midi_channel = 1
+        self.ctrl_out_on_off = 17
+        self.ctrl_out_pressure = 18
+        self.ctrl_out_touch_pos = 20
+        self.ctrl_in_light = 20
+        self.ctrl_in_brightness = 21
+        self.rebuild_dispatch()
+
+    def rebuild_dispatch(self):
+        """
+        Rebuilds the controller -> handlers lookup table used by handle().
+
+        Each of the 128 entries is None (nothing to call) or a tuple of
+        (handlers for nonzero data, handlers for zero data, pass data),
+        so handle() only needs a single index to route a message.
+        Replies on channel 1 (echo) get a separate table of handler tuples.
+        Called whenever the handlers, controller mappings or MIDI channel
+        change.
+        """
+        table = [None] * 128
+        stats = self._stats
+
+        def get(eventType):
+            return tuple(timed(eventType, f)
+                         for f in self.handlers.get(eventType, ()))
+
+        def timed(eventType, f):
+            # Timing wrappers only exist while stats are enabled. They go
+            # around the registered function itself, inside any queueing or
+            # throttling, so that only real calls are counted and timed.
+            outer = None
+            inner = f
+            while isinstance(inner, (QueuedHandler, ThrottledHandler)):
+                outer = inner
+                inner = inner.handler
+            if stats is not None:
+                inner = stats.timed(eventType, inner)
+            if outer is None:
+                return inner
+            outer.call = inner
+            return f
+
+        # Filled lowest priority first, so that touch position wins over
+        # pressure, and pressure over on/off, if they share a controller.
+        start = get(Event.TOUCH_START)
+        end = get(Event.TOUCH_END)
+        if start or end:
+            table[self.ctrl_out_on_off] = (start, end, False)
+
+        pressure = get(Event.PRESSURE)
+        if pressure:
+            table[self.ctrl_out_pressure] = (pressure, pressure, True)
+
+        touch = get(Event.TOUCH)
+        if touch:
+            table[self.ctrl_out_touch_pos] = (touch, touch, True)
+
+        replies = [None] * 128
+        echo = get(Event.ECHO)
+        if echo:
+            replies[CTRL_ECHO] = echo
+        replies[CTRL_VERSION] = (self._version_reply,)
+        replies[CTRL_SETTINGS] = (self._settings_reply,)
+
+        self._status = CONTROL | (self.midi_channel - 1)
+        self._dispatch = table
+        self._replies = replies
+
+    def register(self, eventType, handler, policy=Policy.INLINE,
+                 backlog=256, overflow=Overflow.DROP_OLDEST,
+                 max_rate=None, coalesce=True):
+        """
+        Register a handler for eventType.
+
+        policy chooses where the handler runs (see Policy). For POOL and
+        SERIAL handlers at most backlog calls are kept waiting, and overflow
+        (see Overflow) decides what happens to further ones.
+
+        With max_rate, a TOUCH or PRESSURE handler is called at most
+        max_rate times per second, see ThrottledHandler.
+        """
+        if max_rate is not None and eventType not in (Event.TOUCH,
+                                                      Event.PRESSURE):
+            raise ValueError("Only touch and pressure handlers can be throttled")
+
+        if policy == Policy.POOL:
+            handler = QueuedHandler(handler, self.get_handler_pool(),
+                                    backlog, overflow)
+        elif policy == Policy.SERIAL:
+            handler = QueuedHandler(handler, None, backlog, overflow)
+
+        if max_rate is not None:
+            handler = ThrottledHandler(handler, max_rate, coalesce)
+            self._throttled.append(handler)
+
+        self.handlers.setdefault(eventType, []).append(handler)
+        self.rebuild_dispatch()
+
+    def get_handler_pool(self, size=4):
+        """
+        Returns the HandlerPool shared by Policy.POOL handlers,
+        starting it with size threads if needed.
+        """
+        if self.handler_pool is None:
+            self.handler_pool = HandlerPool(size)
+        return self.handler_pool
+
+    def handler_stats(self):
+        """
+        Returns a list of (eventType, handler, stats) for every handler
+        that does not run inline, see QueuedHandler.stats().
+        """
+        result = []
+        for eventType, handlers in self.handlers.items():
+            for h in handlers:
+                if isinstance(h, ThrottledHandler):
+                    h = h.handler
+                if isinstance(h, QueuedHandler):
+                    result.append((eventType, h.handler, h.stats()))
+        return result
+
+    def stop_handlers(self):
+        """
+        Stops the threads of queued handlers. Pending calls are discarded.
+        """
+        for handlers in self.handlers.values():
+            for h in handlers:
+                if isinstance(h, ThrottledHandler):
+                    h = h.handler
+                if isinstance(h, QueuedHandler):
+                    h.stop()
+        if self.handler_pool is not None:
+            self.handler_pool.stop()
+            self.handler_pool = None
+
+    def read_batch(self):
+        """
+        Drains everything currently pending on the input, using Read() calls
+        of at most batch_size events.
+        Returns a list of [[status, data1, data2, data3], timestamp] events
+        in arrival order.
+        """
+        events = []
+        while self._in.Poll():
+            batch = self._in.Read(self.batch_size)
+            if not batch:
+                break
+            events.extend(batch)
+            if len(batch) < self.batch_size:
+                break
 
-        handlers.append(handler)
+        return events
 
     def dispatch(self):
-        midi_data = self.read()
+        """
+        Reads all pending events and passes them to the handlers in
+        arrival order, then delivers any throttled values that are due.
+        Returns the number of events read during this tick, or True if
+        none were read but throttled values are still waiting (so the
+        adaptive reader keeps polling until they are delivered).
+        Returns 0 while the device is lost.
+        """
+        if not self.connected:
+            return 0
+        self._in_lock.acquire()
+        try:
+            if not self.connected:
+                return 0
+            events = self.read_batch()
+        except Exception:
+            self._lost()
+            return 0
+        finally:
+            self._in_lock.release()
+        return self.dispatch_events(events)
+
+    def dispatch_events(self, events):
+        """
+        Does the work of dispatch() for a list of events in the format
+        returned by read_batch(), wherever they came from.
+        """
+        recorder = self.recorder
+        if recorder is not None and events:
+            recorder.write(events)
+
+        status = self._status
+        replies = self._replies
+
+        stats = self._stats
+        if stats is not None:
+            stats.iterations += 1
+            if events:
+                stats.count_events(events, status, self._dispatch, replies)
+            else:
+                stats.idle_iterations += 1
 
-        if midi_data is not None:
+        touched = False
+        for midi_data, timestamp in events:
             # print "$ ", midi_data
 
-            if midi_data[0] == CONTROL:
+            self.timestamp = timestamp
+            if midi_data[0] == status:
                 self.handle(midi_data[1], int(midi_data[2]))
+                if midi_data[1] <= MAX_OUTPUT_CTRL:
+                    touched = True
+            if midi_data[0] == CONTROL:
+                handlers = replies[midi_data[1]]
+                if handlers is not None:
+                    for f in handlers:
+                        f(int(midi_data[2]))
+
+        count = len(events)
+        if touched and not self.leds_ignore_touch:
+            # touching the strip moves the LED column on the device
+            self.invalidate_frame()
+
+        self.tick_events = count
+        self.total_events += count
+        self.ticks += 1
+        if count > self.max_tick_events:
+            self.max_tick_events = count
+
+        if self._throttled:
+            waiting = self.flush_throttled()
+            return count or waiting
+
+        return count
+
+    def flush_throttled(self, force=False):
+        """
+        Delivers the values held back by throttled handlers whose next
+        slot has come (or all of them, with force).
+        Returns True if some values are still waiting.
+        """
+        now = time.time()
+        waiting = False
+        for h in self._throttled:
+            if h.flush(now, force):
+                waiting = True
+        return waiting
+
+    #
+    # STATS
+    #
+
+    def enable_stats(self, dump=None, interval=10.0):
+        """
+        Starts counting events, handler calls and output (see Stats).
+        With dump, dump(self.stats()) is also called every interval seconds
+        from a separate thread.
+        While disabled, the only cost left is a None check per dispatch()
+        and per write.
+        """
+        self.stop_stats_dump()
+        self._stats = Stats()
+        self.rebuild_dispatch()
+        if dump is not None:
+            self.stats_dumper = IntervalThread(lambda: dump(self.stats()),
+                                               interval, name="StatsDump")
+            self.stats_dumper.start()
+
+    def disable_stats(self):
+        self.stop_stats_dump()
+        self._stats = None
+        self.rebuild_dispatch()
+
+    def stop_stats_dump(self):
+        if self.stats_dumper is not None:
+            self.stats_dumper.stop()
+            self.stats_dumper = None
+
+    def stats(self):
+        """
+        Returns a snapshot of the driver's counters as a dict.
+        The counters from Stats are only included while stats are enabled.
+        """
+        result = {"ticks": self.ticks,
+                  "events": self.total_events,
+                  "max_tick_events": self.max_tick_events,
+                  "frames_sent": self.frames_sent,
+                  "messages_sent": self.messages_sent,
+                  "messages_suppressed": self.messages_suppressed,
+                  "column_frames": self.column_frames,
+                  "messages_saved": self.messages_saved}
+
+        writer = self.writer
+        if writer is not None:
+            result["writer"] = {"pending": writer.pending(),
+                                "writes": writer.writes,
+                                "messages": writer.messages,
+                                "errors": writer.errors}
+        if self.scheduler is not None:
+            result["scheduler"] = self.scheduler.stats()
+
+        if self._stats is not None:
+            result.update(self._stats.snapshot())
+            if writer is not None:
+                result["write_errors"] += writer.errors
+
+        return result
+
+    def reset_tick_stats(self):
+        """
+        Resets the per-tick event counters.
+        """
+        self.tick_events = 0
+        self.max_tick_events = 0
+        self.total_events = 0
+        self.ticks = 0
 
     def handle(self, ctrl, data):
-        handlers = None
-	no_arg = False
-
-        try:
-            # There's probably a more Pythonic way to do this, right?
-            if ctrl is self.ctrl_out_touch_pos:
-                handlers = self.handlers[Event.TOUCH]
-            elif ctrl is self.ctrl_out_pressure:
-                handlers = self.handlers[Event.PRESSURE]
-            elif ctrl is self.ctrl_out_on_off:
-                no_arg = True
-                if data is 0:
-                    handlers = self.handlers[Event.TOUCH_END]
-                else:
-                    handlers = self.handlers[Event.TOUCH_START]
+        entry = self._dispatch[ctrl]
+        if entry is None:
+            return
 
-            if handlers is not None:
-                if no_arg:                
-                    for f in handlers:
-                        f()
-                else:
-                    for f in handlers:
-                        f(data)
-        except KeyError:
-            pass
+        if entry[2]:
+            for f in entry[0]:
+                f(data)
+            return
 
-    def on_touch(self, handler):
+        # touch start/end is never throttled, and the last position and
+        # pressure should reach their handlers before it
+        if self._throttled:
+            self.flush_throttled(True)
+
+        if data:
+            for f in entry[0]:
+                f()
+        else:
+            for f in entry[1]:
+                f()
+
+    def on_touch(self, handler, **options):
         """
         Register a handler for VMeter touch positional input.
 
         Handler will be called with one argument, touch_position (0-127).
+        See register() for options.
         """
-        self.register(Event.TOUCH, handler)
+        self.register(Event.TOUCH, handler, **options)
 
-    def on_pressure(self, handler):
+    def on_pressure(self, handler, **options):
         """
         Register a handler for VMeter pressure input.
 
         Handler will be called with one argument, pressure_strength (0-127).
+        See register() for options.
         """
-        self.register(Event.PRESSURE, handler)
+        self.register(Event.PRESSURE, handler, **options)
 
-    def on_touch_start(self, handler):
+    def on_touch_start(self, handler, **options):
         """
         Register a handler for the start of VMeter touch input.
 
         Handler will be called with no arguments.
+        See register() for options.
         """
-        self.register(Event.TOUCH_START, handler)
+        self.register(Event.TOUCH_START, handler, **options)
 
-    def on_touch_end(self, handler):
+    def on_touch_end(self, handler, **options):
         """
         Register a handler for the end of VMeter touch input.
 
         Handler will be called with no arguments.
+        See register() for options.
+        """
+        self.register(Event.TOUCH_END, handler, **options)
+
+    def on_echo(self, handler, **options):
         """
-        self.register(Event.TOUCH_END, handler)
+        Register a handler for values echoed back after echo().
+
+        Handler will be called with one argument, the echoed value (0-127);
+        self.timestamp holds the reply's timestamp meanwhile.
+        See register() for options.
+        """
+        self.register(Event.ECHO, handler, **options)
 
     #
     # MACROS
@@ -573,36 +2157,59 @@ class VMeter(object):
         Draws a bar of given size (0-38),
         centered at given position (0-127)
         """
-        leds = [0]*NUM_LEDS
-        cursor_pos = int(float(position) / 127.0 * 37.0)
-        
-        lower_limit = cursor_pos - size / 2
-        if lower_limit < 0:
-            lower_limit = 0
-        
-        upper_limit = cursor_pos + size / 2
-        if upper_limit > (NUM_LEDS-1):
-            upper_limit = NUM_LEDS-1
-        
-        i = lower_limit
-        while i <= upper_limit:
-            leds[i] = 1
-            i = i + 1
-        self.send_array(leds)
-
-    def sweep_from_center(self, delay=.05):
-        """
-        Draws a sweep from the center, with delay (in sec) between each step
-        """
-        self.clear()
-
-        leds = [0]*NUM_LEDS
-
-        for i in range(NUM_LEDS/2,NUM_LEDS):
-            leds[i] = 1
-            leds[NUM_LEDS-1-i] = 1
-            self.send_array(leds)
-            time.sleep(delay)
+        self.send_mask(LedFrame.bar(position, size))
+
+    def sweep_from_center(self, delay=.05, wait=True):
+        """
+        Draws a sweep from the center, with delay (in sec) between each step.
+        With wait=False it returns the Playback right away.
+
+        The last frame stays up as the Animator's base frame, until live
+        output (e.g. Animator.column()) replaces it.
+        """
+        animation = Animation.sweep_from_center(delay)
+        playback = self.play(animation)
+        self.animator.set_packed(animation.frames[-1])
+        if wait:
+            playback.wait()
+        return playback
+
+class Reply(object):
+    """
+    Collects a reply of length values sent over one controller, then
+    calls callback(values). With marker, values before a marker value are
+    ignored, so a reply that was cut short doesn't shift the next one.
+    """
+
+    def __init__(self, length, callback, marker=None):
+        self.length = length
+        self.callback = callback
+        self.marker = marker
+        self.values = []
+        self.replies = 0
+        self._done = threading.Event()
+
+    def expect(self):
+        """
+        Called when the request is sent: drops partial data.
+        """
+        self.values = []
+        self._done.clear()
+
+    def wait(self, timeout):
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def __call__(self, value):
+        values = self.values
+        if not values and self.marker is not None and value != self.marker:
+            return
+        values.append(value)
+        if len(values) == self.length:
+            self.values = []
+            self.replies += 1
+            self.callback(values)
+            self._done.set()
 
 class IntervalThread(threading.Thread):
     def __init__(self, function, interval, name="Interval"):
@@ -620,3 +2227,797 @@ class IntervalThread(threading.Thread):
             
     def stop(self):
         self.killed = True
+
+class AdaptiveThread(IntervalThread):
+    """
+    Calls function repeatedly, like IntervalThread, but backs off
+    exponentially (up to max_interval) while function returns a false value,
+    and snaps back to min_interval as soon as it returns a true one.
+
+    With VMeter.dispatch() this means tight polling while the strip is in use
+    and only a few wakeups per second while it is idle.
+    """
+    def __init__(self, function, min_interval=.001, max_interval=.02,
+                 backoff=2.0, name="Adaptive"):
+        IntervalThread.__init__(self, function, min_interval, name)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+    def run(self):
+        while not self.killed:
+            time.sleep(self.interval)
+            if self.function():
+                self.interval = self.min_interval
+            elif self.interval < self.max_interval:
+                self.interval = min(self.interval * self.backoff,
+                                    self.max_interval)
+
+class Stats(object):
+    """
+    Counters kept by a VMeter while stats are enabled, see
+    VMeter.enable_stats().
+    """
+    def __init__(self):
+        self.started = time.time()
+        # control changes read, by controller number
+        self.events_by_ctrl = [0] * 128
+        # control changes nobody had a handler for
+        self.unhandled = 0
+        # events that were not control changes on the VMeter's channel
+        # or channel 1
+        self.dropped = 0
+        # dispatch() calls, and those that found nothing to read
+        self.iterations = 0
+        self.idle_iterations = 0
+        # by event type
+        self.handler_calls = {}
+        self.handler_time = {}
+        # messages written, by status byte
+        self.output_by_status = {}
+        self.write_errors = 0
+
+    def count_events(self, events, status, table, replies):
+        by_ctrl = self.events_by_ctrl
+        for midi_data, timestamp in events:
+            s = midi_data[0]
+            if s == status or s == CONTROL:
+                ctrl = midi_data[1]
+                by_ctrl[ctrl] += 1
+                if ((s != status or table[ctrl] is None) and
+                    (s != CONTROL or replies[ctrl] is None)):
+                    self.unhandled += 1
+            else:
+                self.dropped += 1
+
+    def count_output(self, messages):
+        counts = self.output_by_status
+        for status, data1, data2 in messages:
+            counts[status] = counts.get(status, 0) + 1
+
+    def timed(self, eventType, handler):
+        """
+        Wraps handler to count its calls and time under eventType.
+        """
+        calls = self.handler_calls
+        times = self.handler_time
+        calls.setdefault(eventType, 0)
+        times.setdefault(eventType, 0.0)
+
+        def call(*args):
+            start = time.time()
+            try:
+                return handler(*args)
+            finally:
+                times[eventType] += time.time() - start
+                calls[eventType] += 1
+        return call
+
+    def snapshot(self):
+        iterations = self.iterations
+        return {"uptime": time.time() - self.started,
+                "events_by_ctrl": dict((ctrl, n) for ctrl, n
+                                       in enumerate(self.events_by_ctrl) if n),
+                "unhandled": self.unhandled,
+                "dropped": self.dropped,
+                "iterations": iterations,
+                "idle_ratio": (float(self.idle_iterations) / iterations
+                               if iterations else 0.0),
+                "handler_calls": dict(self.handler_calls),
+                "handler_time": dict(self.handler_time),
+                "output_by_status": dict(self.output_by_status),
+                "write_errors": self.write_errors}
+
+class FrameScheduler(threading.Thread):
+    """
+    Sends LED frames to a VMeter at no more than max_fps.
+
+    Producers post frames without blocking. There is a single slot holding
+    the latest frame: a frame posted before the previous one went out
+    replaces it, and the replaced frame is counted as dropped.
+    """
+    def __init__(self, vmeter, max_fps=60, name="FrameScheduler"):
+        threading.Thread.__init__(self)
+        self.name = name
+        self.setDaemon(True)
+        self.killed = False
+        self.vmeter = vmeter
+        self.interval = 1.0 / max_fps
+        self._cond = threading.Condition()
+        self._pending = None
+
+        self.posted = 0
+        self.sent = 0
+        self.dropped = 0
+        self._send_times = deque(maxlen=64)
+
+    def post(self, function, value):
+        """
+        Schedules function(value) as the next frame.
+        """
+        self._cond.acquire()
+        try:
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = (function, value)
+            self.posted += 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def post_mask(self, mask):
+        self.post(self.vmeter.send_mask, mask)
+
+    def post_packed(self, data):
+        self.post(self.vmeter.send_packed, data)
+
+    def post_array(self, array):
+        self.post(self.vmeter.send_array, array)
+
+    def post_column(self, height):
+        self.post(self.vmeter.send_column, height)
+
+    def run(self):
+        cond = self._cond
+        next_time = 0
+        while True:
+            cond.acquire()
+            try:
+                while self._pending is None and not self.killed:
+                    cond.wait()
+            finally:
+                cond.release()
+            if self.killed:
+                break
+
+            # Frames posted while we wait for the next slot replace the
+            # pending one.
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            cond.acquire()
+            try:
+                function, value = self._pending
+                self._pending = None
+            finally:
+                cond.release()
+
+            function(value)
+            now = time.time()
+            next_time = now + self.interval
+            self.sent += 1
+            self._send_times.append(now)
+
+    def stop(self):
+        self._cond.acquire()
+        try:
+            self.killed = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def fps(self):
+        """
+        Frame rate achieved over the last (up to) 64 frames sent.
+        """
+        times = self._send_times
+        if len(times) < 2 or times[-1] == times[0]:
+            return 0.0
+        return (len(times) - 1) / (times[-1] - times[0])
+
+    def stats(self):
+        return {"posted": self.posted,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "fps": self.fps()}
+
+def _combine(below, above):
+    return (below[0] | above[0], below[1] | above[1], below[2] | above[2],
+            below[3] | above[3], below[4] | above[4], below[5] | above[5])
+
+class Playback(object):
+    """
+    An Animation being played by an Animator.
+    """
+
+    def __init__(self, animator, animation, layer, start):
+        self.animator = animator
+        self.animation = animation
+        self.layer = layer
+        self.start = start
+        self.index = None
+        self.cancelled = False
+        self._done = threading.Event()
+
+    def __lt__(self, other):
+        # kept sorted by layer; equal layers in the order started
+        return self.layer < other.layer
+
+    def cancel(self):
+        self.animator.cancel(self)
+
+    def done(self):
+        """
+        True once the last frame was shown, or the playback was cancelled.
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Waits until done(); a looping animation only ends when cancelled.
+        """
+        if timeout is None:
+            while not self._done.is_set():
+                self._done.wait(1.0)
+        else:
+            self._done.wait(timeout)
+        return self._done.is_set()
+
+class Animator(threading.Thread):
+    """
+    Plays Animations on a VMeter against absolute deadlines.
+
+    Each playback's frame is picked from the time elapsed since it started
+    on the backend clock (pypm.Time()), so send times and a late wakeup
+    don't add up: a late frame is shown late, a frame that is entirely
+    missed is skipped. stats() has the number of skipped frames and the
+    longest delay (ms) between a frame being due and sent.
+
+    Playbacks are layered by layer number, higher on top, over a base
+    frame for live output (see column() and set_mask()). Every change is
+    sent through send_packed(), which skips unchanged bytes.
+    """
+
+    def __init__(self, vmeter, name="Animator"):
+        threading.Thread.__init__(self)
+        self.name = name
+        self.setDaemon(True)
+        self.killed = False
+        self.vmeter = vmeter
+        self._cond = threading.Condition()
+        self._changed = False
+        self._playing = []
+        self._base = LedFrame.pack(LedFrame.OFF)
+
+        self.frames = 0
+        self.skipped = 0
+        self.max_late = 0
+
+    #
+    # LIVE OUTPUT
+    #
+
+    def set_packed(self, data):
+        """
+        Sets the base frame, shown below (or through) the animations.
+        """
+        self._cond.acquire()
+        try:
+            self._base = tuple(data)
+            self._changed = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def set_mask(self, mask):
+        self.set_packed(LedFrame.pack(mask))
+
+    def column(self, height):
+        """
+        Column of height (0-127) as the base frame, drawn with
+        LedFrame.height(); only heights 0 and 127 are known to match the
+        device's own column.
+        """
+        self.set_mask(LedFrame.height(height, bool(self.vmeter.upside_down)))
+
+    #
+    # PLAYBACK
+    #
+
+    def play(self, animation, layer=0, start=None):
+        """
+        Starts animation now, or at start (backend ms).
+        """
+        if start is None:
+            start = self.vmeter.backend.time()
+        playback = Playback(self, animation, layer, start)
+        self._cond.acquire()
+        try:
+            insort(self._playing, playback)
+            self._changed = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        return playback
+
+    def cancel(self, playback):
+        self._cond.acquire()
+        try:
+            if playback in self._playing:
+                self._playing.remove(playback)
+            playback.cancelled = True
+            playback._done.set()
+            self._changed = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def cancel_all(self):
+        for playback in list(self._playing):
+            self.cancel(playback)
+
+    def playing(self):
+        return list(self._playing)
+
+    def tick(self, now=None):
+        """
+        Sends the frame due at now (default: the backend time).
+        Returns the time of the next frame change, or None if there is none.
+        """
+        if now is None:
+            now = self.vmeter.backend.time()
+
+        self._cond.acquire()
+        try:
+            frame = self._base
+            deadline = None
+            # finished hold playbacks, hidden for good by a later opaque one
+            held = []
+            for playback in list(self._playing):
+                if now < playback.start:
+                    if deadline is None or playback.start < deadline:
+                        deadline = playback.start
+                    continue
+
+                animation = playback.animation
+                index, next_time = animation.frame_at(now - playback.start)
+                if next_time is None:
+                    playback._done.set()
+                    if not animation.hold:
+                        self._playing.remove(playback)
+                        continue
+                else:
+                    next_time += playback.start
+                    if deadline is None or next_time < deadline:
+                        deadline = next_time
+
+                if index != playback.index:
+                    if playback.index is not None and index > playback.index + 1:
+                        self.skipped += index - playback.index - 1
+                    if next_time is not None:
+                        elapsed = now - playback.start
+                        if animation.loop:
+                            elapsed %= animation.length
+                        late = elapsed - animation.offsets[index]
+                        if late > self.max_late:
+                            self.max_late = late
+                    playback.index = index
+                if animation.opaque:
+                    frame = animation.frames[index]
+                    for below in held:
+                        if below.start <= playback.start:
+                            self._playing.remove(below)
+                    held = [below for below in held
+                            if below.start > playback.start]
+                else:
+                    frame = _combine(frame, animation.frames[index])
+                if next_time is None:
+                    held.append(playback)
+        finally:
+            self._cond.release()
+
+        self.vmeter.send_packed(frame)
+        self.frames += 1
+        return deadline
+
+    def run(self):
+        cond = self._cond
+        time_ms = self.vmeter.backend.time
+        while not self.killed:
+            deadline = self.tick()
+            cond.acquire()
+            try:
+                if not self._changed and not self.killed:
+                    if deadline is None:
+                        cond.wait()
+                    else:
+                        delay = (deadline - time_ms()) / 1000.0
+                        if delay > 0:
+                            cond.wait(delay)
+                self._changed = False
+            finally:
+                cond.release()
+
+    def stop(self):
+        self._cond.acquire()
+        try:
+            self.killed = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        for playback in list(self._playing):
+            playback._done.set()
+
+    def stats(self):
+        return {"frames": self.frames,
+                "skipped": self.skipped,
+                "max_late": self.max_late,
+                "playing": len(self._playing)}
+
+class OutputWriter(threading.Thread):
+    """
+    Writes queued MIDI messages to an output port from a single thread.
+
+    Messages are queued in groups (see VMeter._write) and everything
+    pending is flushed with as few Write() calls as possible. Config groups
+    go ahead of LED groups, and a group is never split across Write() calls,
+    so the aftertouch messages of one LED frame stay together.
+    """
+    def __init__(self, output, lock, name="OutputWriter", on_error=None):
+        threading.Thread.__init__(self)
+        self.name = name
+        self.setDaemon(True)
+        self.killed = False
+        self.output = output
+        self.lock = lock
+        # called after a failed Write(), e.g. VMeter._lost
+        self.on_error = on_error
+        self._cond = threading.Condition()
+        self._config = deque()
+        self._leds = deque()
+        self._busy = False
+
+        self.writes = 0
+        self.messages = 0
+        self.errors = 0
+
+    def put(self, messages, config=False):
+        self._cond.acquire()
+        try:
+            if config:
+                self._config.append(messages)
+            else:
+                self._leds.append(messages)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def pending(self):
+        """
+        Number of message groups waiting to be written.
+        """
+        return len(self._config) + len(self._leds)
+
+    def _take(self):
+        """
+        Removes all queued groups, config first, and packs them into
+        Write() batches of at most MAX_WRITE messages.
+        """
+        batches = []
+        batch = []
+        for queue in (self._config, self._leds):
+            while queue:
+                group = queue.popleft()
+                if batch and len(batch) + len(group) > MAX_WRITE:
+                    batches.append(batch)
+                    batch = []
+                for status, data1, data2 in group:
+                    batch.append([[status, data1, data2], 0])
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def run(self):
+        cond = self._cond
+        while True:
+            cond.acquire()
+            try:
+                while not (self._config or self._leds or self.killed):
+                    cond.wait()
+                if not (self._config or self._leds):
+                    break
+                batches = self._take()
+                self._busy = True
+            finally:
+                cond.release()
+
+            try:
+                self._write(batches)
+            finally:
+                cond.acquire()
+                try:
+                    self._busy = False
+                    cond.notify_all()
+                finally:
+                    cond.release()
+
+    def _write(self, batches):
+        self.lock.acquire()
+        try:
+            if self.output is None:
+                # disconnected, see VMeter.disconnect()
+                return
+            for batch in batches:
+                try:
+                    self.output.Write(batch)
+                except Exception:
+                    self.errors += 1
+                    if self.on_error is not None:
+                        self.on_error()
+                    else:
+                        traceback.print_exc()
+                    continue
+                self.writes += 1
+                self.messages += len(batch)
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """
+        Blocks until everything queued so far has been written.
+        """
+        self._cond.acquire()
+        try:
+            while (self._config or self._leds or self._busy) and self.is_alive():
+                self._cond.wait(.1)
+        finally:
+            self._cond.release()
+
+    def stop(self):
+        """
+        Stops the thread once the queue is empty.
+        """
+        self._cond.acquire()
+        try:
+            self.killed = True
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+class QueuedHandler(object):
+    """
+    Runs a handler off the reader thread.
+
+    Calls are queued, at most backlog of them, and run by a shared
+    HandlerPool or, when pool is None, by a dedicated thread that runs them
+    one at a time in arrival order. overflow (see Overflow) decides what
+    happens to calls made while the backlog is full.
+    """
+    def __init__(self, handler, pool=None, backlog=256,
+                 overflow=Overflow.DROP_OLDEST):
+        self.handler = handler
+        # what actually gets called: handler, or a Stats.timed() wrapper
+        self.call = handler
+        self.pool = pool
+        self.backlog = max(backlog, 1)
+        self.overflow = overflow
+        self.killed = False
+        self._queue = deque()
+        self._cond = threading.Condition()
+
+        self.calls = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+        self._thread = None
+        if pool is None:
+            self._thread = threading.Thread(target=self._serve,
+                                            name="SerialHandler")
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def __call__(self, *args):
+        cond = self._cond
+        queue = self._queue
+        cond.acquire()
+        try:
+            if self.killed:
+                return
+            if len(queue) >= self.backlog:
+                if self.overflow == Overflow.COALESCE:
+                    # keeps the original enqueue time, so latency still
+                    # measures how long the slot has been waiting
+                    queue[-1] = (args, queue[-1][1])
+                    self.coalesced += 1
+                    return
+                elif self.overflow == Overflow.BLOCK:
+                    while len(queue) >= self.backlog and not self.killed:
+                        cond.wait()
+                    if self.killed:
+                        # stopped while waiting: nobody will run it
+                        return
+                else:
+                    queue.popleft()
+                    self.dropped += 1
+            queue.append((args, time.time()))
+            cond.notify_all()
+        finally:
+            cond.release()
+
+        if self.pool is not None:
+            self.pool.submit(self)
+
+    def _pop(self):
+        # called with self._cond held
+        item = self._queue.popleft()
+        self._cond.notify_all()
+        return item
+
+    def run_one(self):
+        """
+        Runs the oldest pending call, if any. Used by HandlerPool.
+        """
+        self._cond.acquire()
+        try:
+            if not self._queue:
+                return
+            args, queued = self._pop()
+        finally:
+            self._cond.release()
+        self._call(args, queued)
+
+    def _serve(self):
+        cond = self._cond
+        while True:
+            cond.acquire()
+            try:
+                while not self._queue and not self.killed:
+                    cond.wait()
+                if self.killed:
+                    break
+                args, queued = self._pop()
+            finally:
+                cond.release()
+            self._call(args, queued)
+
+    def _call(self, args, queued):
+        error = False
+        try:
+            self.call(*args)
+        except Exception:
+            error = True
+            traceback.print_exc()
+
+        latency = time.time() - queued
+        self._cond.acquire()
+        try:
+            self.calls += 1
+            self.errors += error
+            self.latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+        finally:
+            self._cond.release()
+
+    def stats(self):
+        """
+        Returns a dict with call, drop, coalesce and error counts, the
+        current queue depth and the mean and maximum latency (seconds from
+        queueing a call to its completion).
+        """
+        self._cond.acquire()
+        try:
+            return {"calls": self.calls,
+                    "dropped": self.dropped,
+                    "coalesced": self.coalesced,
+                    "errors": self.errors,
+                    "depth": len(self._queue),
+                    "mean_latency": self.latency / self.calls if self.calls else 0.0,
+                    "max_latency": self.max_latency}
+        finally:
+            self._cond.release()
+
+    def stop(self):
+        self._cond.acquire()
+        try:
+            self.killed = True
+            self._queue.clear()
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        if self._thread is not None:
+            self._thread.join()
+
+class ThrottledHandler(object):
+    """
+    Calls handler at most max_rate times per second.
+
+    With coalesce, values arriving too soon are collapsed into one which is
+    delivered in the next slot by flush(), so the handler always ends up
+    with the final value. Without it they are simply dropped.
+    """
+    def __init__(self, handler, max_rate, coalesce=True):
+        self.handler = handler
+        # what actually gets called: handler, or a Stats.timed() wrapper
+        self.call = handler
+        self.interval = 1.0 / max_rate
+        self.coalesce = coalesce
+        self._next = 0.0
+        self._pending = False
+        self._value = None
+
+        self.calls = 0
+        self.skipped = 0
+
+    def __call__(self, value):
+        now = time.time()
+        if now >= self._next:
+            self._deliver(value, now)
+        else:
+            if self._pending or not self.coalesce:
+                self.skipped += 1
+            if self.coalesce:
+                self._pending = True
+                self._value = value
+
+    def _deliver(self, value, now):
+        self._pending = False
+        self._value = None
+        self._next = now + self.interval
+        self.calls += 1
+        self.call(value)
+
+    def flush(self, now, force=False):
+        """
+        Delivers the held back value if its slot has come, or now with force.
+        Returns True if a value is still waiting.
+        """
+        if not self._pending:
+            return False
+        if force or now >= self._next:
+            self._deliver(self._value, now)
+            return False
+        return True
+
+class HandlerPool(object):
+    """
+    A fixed set of threads running QueuedHandler calls.
+    """
+    def __init__(self, size=4):
+        self._tasks = Queue.Queue()
+        self._threads = []
+        for i in range(size):
+            t = threading.Thread(target=self._work, name="HandlerPool-%d" % i)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, handler):
+        self._tasks.put(handler)
+
+    def _work(self):
+        while True:
+            handler = self._tasks.get()
+            if handler is None:
+                break
+            handler.run_one()
+
+    def stop(self):
+        for t in self._threads:
+            self._tasks.put(None)
+        for t in self._threads:
+            t.join()
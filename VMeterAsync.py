@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+asyncio interface to a VMeter, through trollius (the asyncio backport for
+Python 2):
+
+    import trollius as asyncio
+    from trollius import From
+
+    @asyncio.coroutine
+    def follow(vm):
+        stream = vm.events()
+        while True:
+            item = yield From(stream.get())
+            if item is None:
+                break
+            event, value = item
+            if event == Event.TOUCH:
+                yield From(vm.draw_bar(value, 5))
+
+    vm = AsyncVMeter(VMeter())
+    vm.loop.run_until_complete(follow(vm))
+
+Requires trollius.
+
+Events are collected on the VMeter reader thread and handed to the loop in
+batches: the first event of a batch schedules one call_soon_threadsafe(),
+and everything that arrives before the loop runs it goes along with it.
+"""
+
+import threading
+from collections import deque
+
+import trollius as asyncio
+
+from VMeter import Event
+
+class AsyncVMeter(object):
+    """
+    Wraps a VMeter for use from an asyncio event loop.
+    """
+
+    def __init__(self, vmeter, loop=None, maxsize=1024):
+        self.vmeter = vmeter
+        self.loop = loop or asyncio.get_event_loop()
+        self.maxsize = maxsize
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._scheduled = False
+        self._streams = []
+
+        self.batches = 0
+        self.events_posted = 0
+
+        vmeter.on_touch(lambda value: self._post(Event.TOUCH, value))
+        vmeter.on_pressure(lambda value: self._post(Event.PRESSURE, value))
+        vmeter.on_touch_start(lambda: self._post(Event.TOUCH_START, None))
+        vmeter.on_touch_end(lambda: self._post(Event.TOUCH_END, None))
+
+    #
+    # EVENTS
+    #
+
+    def _post(self, event, value):
+        # reader thread
+        self._lock.acquire()
+        try:
+            self._buffer.append((event, value))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        finally:
+            self._lock.release()
+
+        self.loop.call_soon_threadsafe(self._deliver)
+
+    def _deliver(self):
+        # loop thread
+        self._lock.acquire()
+        try:
+            batch = self._buffer
+            self._buffer = []
+            self._scheduled = False
+        finally:
+            self._lock.release()
+
+        self.batches += 1
+        self.events_posted += len(batch)
+        for stream in self._streams:
+            stream._extend(batch)
+
+    def events(self, maxsize=None):
+        """
+        Returns a new EventStream of (event type, value) tuples.
+        value is None for TOUCH_START and TOUCH_END.
+
+        Each stream keeps at most maxsize undelivered events (default: the
+        AsyncVMeter's maxsize) and drops the oldest ones beyond that.
+        """
+        stream = EventStream(self, maxsize or self.maxsize)
+        self._streams.append(stream)
+        return stream
+
+    def _remove(self, stream):
+        if stream in self._streams:
+            self._streams.remove(stream)
+
+    #
+    # SENDING DATA
+    #
+
+    def _call(self, function, *args):
+        """
+        Returns a future for function(*args).
+        With a writer thread the call only queues output, so it is made
+        right away; otherwise it runs in the loop's default executor.
+        """
+        if self.vmeter.writer is not None:
+            future = asyncio.Future(loop=self.loop)
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        return self.loop.run_in_executor(None, function, *args)
+
+    def send_column(self, height):
+        return self._call(self.vmeter.send_column, height)
+
+    def send_array(self, array, force=False):
+        return self._call(self.vmeter.send_array, array, force)
+
+    def send_mask(self, mask, force=False):
+        return self._call(self.vmeter.send_mask, mask, force)
+
+    def send_packed(self, data, force=False):
+        return self._call(self.vmeter.send_packed, data, force)
+
+    def send_controller(self, ctrl, value):
+        return self._call(self.vmeter.send_controller, ctrl, value)
+
+    def send_config(self, value):
+        return self._call(self.vmeter.send_config, value)
+
+    def echo(self, value):
+        return self._call(self.vmeter.echo, value)
+
+    def clear(self):
+        return self._call(self.vmeter.clear)
+
+    def draw_bar(self, position, size):
+        return self._call(self.vmeter.draw_bar, position, size)
+
+class EventStream(object):
+    """
+    Bounded stream of VMeter events, consumed by waiting on get() from a
+    coroutine.
+    """
+
+    def __init__(self, owner, maxsize):
+        self.owner = owner
+        self.maxsize = maxsize
+        self.closed = False
+        self.dropped = 0
+        self._queue = deque()
+        self._waiter = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def _extend(self, batch):
+        queue = self._queue
+        queue.extend(batch)
+        while len(queue) > self.maxsize:
+            queue.popleft()
+            self.dropped += 1
+
+        waiter = self._waiter
+        if waiter is not None and queue:
+            self._waiter = None
+            if not waiter.done():
+                waiter.set_result(queue.popleft())
+
+    def get(self):
+        """
+        Returns a future for the next event, or for None once the stream
+        is closed.
+        """
+        future = asyncio.Future(loop=self.owner.loop)
+        if self._queue:
+            future.set_result(self._queue.popleft())
+        elif self.closed:
+            future.set_result(None)
+        else:
+            self._waiter = future
+        return future
+
+    def close(self):
+        """
+        Stops the stream; a pending get() gets None.
+        """
+        self.closed = True
+        self.owner._remove(self)
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
@@ -0,0 +1,399 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+UDP bridge exposing a VMeter to other processes, speaking OSC.
+
+    python VMeterBridge.py --port 9000 --subscribe 127.0.0.1:9001
+
+or from Python, with a VMeter that has no reader thread of its own:
+
+    bridge = Bridge(VMeter(reader=False), port=9000)
+    bridge.start()
+
+Events go out to every subscriber as OSC bundles, one bundle per dispatch()
+tick (split if it would exceed max_datagram bytes):
+
+    /vmeter/touch    position timestamp
+    /vmeter/pressure strength timestamp
+    /vmeter/on       1|0      timestamp
+
+The timestamp is the backend's clock in ms (pypm.Time()), sent as an
+int64 since it passes 2^31 after about 25 days.
+
+Each event is encoded once and each bundle is built once, whatever the
+number of subscribers.
+
+Commands are OSC messages or bundles sent to the bridge's port:
+
+    /vmeter/subscribe [port]    events go to the sender (or sender:port)
+    /vmeter/unsubscribe [port]
+    /vmeter/leds b0 b1 b2 b3 b4 b5   six packed LED bytes, see LedFrame.pack
+    /vmeter/column height
+    /vmeter/bar position size
+    /vmeter/clear
+    /vmeter/brightness level    0-16
+    /vmeter/config value        raw config value, see VMeter.send_config
+
+Of the LED commands read in one tick only the last is drawn. The bridge
+never blocks on a subscriber: if its socket buffer is full, the bundle is
+dropped and counted, and at most max_pending events wait for the next
+tick (older ones are dropped and counted).
+"""
+
+import errno
+import socket
+import struct
+import sys
+import argparse
+from collections import deque
+
+from VMeter import VMeter, AdaptiveThread, IntervalThread, LedFrame
+
+_INT = struct.Struct(">i")
+_LONG = struct.Struct(">q")
+_FLOAT = struct.Struct(">f")
+
+BUNDLE = "#bundle\0"
+# OSC time tag meaning "immediately"
+IMMEDIATELY = struct.pack(">II", 0, 1)
+
+def _pad(data):
+    return data + "\0" * (4 - len(data) % 4)
+
+def encode_message(address, *args):
+    """
+    Encodes an OSC message; ints are sent as int32, longs as int64,
+    floats as float32 and strings as strings.
+    """
+    tags = ","
+    payload = []
+    for arg in args:
+        if isinstance(arg, long):
+            tags += "h"
+            payload.append(_LONG.pack(arg))
+        elif isinstance(arg, (bool, int)):
+            tags += "i"
+            payload.append(_INT.pack(int(arg)))
+        elif isinstance(arg, float):
+            tags += "f"
+            payload.append(_FLOAT.pack(arg))
+        elif isinstance(arg, basestring):
+            tags += "s"
+            payload.append(_pad(str(arg)))
+        else:
+            raise TypeError("Can't encode %r" % (arg,))
+    return _pad(address) + _pad(tags) + "".join(payload)
+
+def encode_bundle(messages):
+    """
+    Wraps encoded messages into one OSC bundle.
+    """
+    return BUNDLE + IMMEDIATELY + "".join(_INT.pack(len(m)) + m
+                                          for m in messages)
+
+def _string(data, offset):
+    end = data.index("\0", offset)
+    return data[offset:end], (end // 4 + 1) * 4
+
+def decode(data):
+    """
+    Returns [(address, [args]), ...] for an OSC message or bundle
+    (nested bundles are flattened). Raises ValueError for bad packets.
+    """
+    try:
+        if data.startswith(BUNDLE):
+            messages = []
+            offset = len(BUNDLE) + 8
+            while offset < len(data):
+                size = _INT.unpack_from(data, offset)[0]
+                offset += 4
+                if size <= 0 or offset + size > len(data):
+                    raise ValueError("Bad bundle element size")
+                messages.extend(decode(data[offset:offset + size]))
+                offset += size
+            return messages
+
+        address, offset = _string(data, 0)
+        if not address.startswith("/"):
+            raise ValueError("Bad OSC address %r" % address)
+        if offset >= len(data):
+            return [(address, [])]
+        tags, offset = _string(data, offset)
+        if not tags.startswith(","):
+            raise ValueError("Bad OSC type tags %r" % tags)
+        args = []
+        for tag in tags[1:]:
+            if tag == "i":
+                args.append(_INT.unpack_from(data, offset)[0])
+                offset += 4
+            elif tag == "h":
+                args.append(_LONG.unpack_from(data, offset)[0])
+                offset += 8
+            elif tag == "f":
+                args.append(_FLOAT.unpack_from(data, offset)[0])
+                offset += 4
+            elif tag == "s":
+                value, offset = _string(data, offset)
+                args.append(value)
+            elif tag in "TF":
+                args.append(tag == "T")
+            else:
+                raise ValueError("Unsupported OSC type %r" % tag)
+        return [(address, args)]
+    except (struct.error, IndexError) as e:
+        raise ValueError("Truncated OSC packet: %s" % e)
+
+class Bridge(object):
+    """
+    Publishes the events of vmeter over UDP and draws commands received.
+
+    vmeter must not have a reader thread (create it with reader=False):
+    the bridge calls dispatch() itself, so that it knows where a tick ends.
+    """
+
+    def __init__(self, vmeter, host="127.0.0.1", port=9000, subscribers=(),
+                 max_pending=1024, max_datagram=1400, max_commands=256):
+        if vmeter.reader is not None:
+            raise ValueError("The bridge reads the VMeter itself; "
+                             "create it with reader=False")
+        self.vmeter = vmeter
+        self.max_datagram = max_datagram
+        self.max_commands = max_commands
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.setblocking(False)
+        self.address = self.socket.getsockname()
+
+        self.subscribers = []
+        for subscriber in subscribers:
+            self.subscribe(subscriber)
+
+        # encoded events waiting for the end of the tick
+        self._pending = deque(maxlen=max_pending)
+        self.thread = None
+
+        self.events = 0
+        self.bundles = 0
+        self.datagrams = 0
+        self.send_drops = 0
+        self.queue_drops = 0
+        self.commands = 0
+        self.bad_commands = 0
+        self.coalesced = 0
+
+        vmeter.on_touch(lambda value: self._event("/vmeter/touch", value))
+        vmeter.on_pressure(lambda value: self._event("/vmeter/pressure", value))
+        vmeter.on_touch_start(lambda: self._event("/vmeter/on", 1))
+        vmeter.on_touch_end(lambda: self._event("/vmeter/on", 0))
+
+    def subscribe(self, address):
+        if address not in self.subscribers:
+            self.subscribers.append(address)
+
+    def unsubscribe(self, address):
+        if address in self.subscribers:
+            self.subscribers.remove(address)
+
+    #
+    # EVENTS
+    #
+
+    def _event(self, address, value):
+        pending = self._pending
+        if len(pending) == pending.maxlen:
+            self.queue_drops += 1
+        pending.append(encode_message(address, value,
+                                      long(self.vmeter.timestamp or 0)))
+        self.events += 1
+
+    def _bundles(self):
+        # splits the pending events into bundles of at most max_datagram
+        pending = self._pending
+        limit = self.max_datagram - len(BUNDLE) - len(IMMEDIATELY)
+        while pending:
+            messages = []
+            size = 0
+            while pending and (not messages or
+                               size + 4 + len(pending[0]) <= limit):
+                message = pending.popleft()
+                messages.append(message)
+                size += 4 + len(message)
+            yield encode_bundle(messages)
+
+    def publish(self):
+        """
+        Sends the pending events to every subscriber.
+        """
+        if not self.subscribers:
+            self._pending.clear()
+            return
+        sendto = self.socket.sendto
+        for bundle in self._bundles():
+            self.bundles += 1
+            for subscriber in list(self.subscribers):
+                try:
+                    sendto(bundle, subscriber)
+                    self.datagrams += 1
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                   errno.ENOBUFS):
+                        self.send_drops += 1
+                    elif e.errno == errno.ECONNREFUSED:
+                        # nobody listening (yet); keep the subscription
+                        self.send_drops += 1
+                    else:
+                        raise
+
+    #
+    # COMMANDS
+    #
+
+    def receive(self):
+        """
+        Reads and runs up to max_commands pending command packets.
+        Returns the number of packets read.
+        """
+        packets = 0
+        leds = None
+        while packets < self.max_commands:
+            try:
+                data, sender = self.socket.recvfrom(65536)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.errno == errno.ECONNREFUSED:
+                    # ICMP for an earlier sendto to a closed port
+                    continue
+                raise
+            packets += 1
+            try:
+                messages = decode(data)
+            except ValueError:
+                self.bad_commands += 1
+                continue
+            for address, args in messages:
+                try:
+                    led_command = self._command(address, args, sender)
+                except (ValueError, TypeError, IndexError):
+                    self.bad_commands += 1
+                    continue
+                self.commands += 1
+                if led_command is not None:
+                    if leds is not None:
+                        self.coalesced += 1
+                    leds = led_command
+
+        if leds is not None:
+            function, args = leds
+            function(*args)
+        return packets
+
+    def _command(self, address, args, sender):
+        """
+        Runs one command; LED commands are returned as (function, args)
+        to be drawn once per tick.
+        """
+        v = self.vmeter
+        if address == "/vmeter/leds":
+            if len(args) != 6:
+                raise ValueError("Need 6 LED bytes")
+            return v.send_packed, (tuple(int(b) & 0x7F for b in args),)
+        elif address == "/vmeter/column":
+            return v.send_column, (min(max(int(args[0]), 0), 127),)
+        elif address == "/vmeter/bar":
+            return v.send_mask, (LedFrame.bar(min(max(int(args[0]), 0), 127),
+                                              int(args[1])),)
+        elif address == "/vmeter/clear":
+            return v.clear, ()
+        elif address == "/vmeter/brightness":
+            v.set_brightness(min(max(int(args[0]), 0), 16))
+        elif address == "/vmeter/config":
+            v.send_config(int(args[0]) & 0x7F)
+        elif address == "/vmeter/subscribe":
+            self.subscribe((sender[0], int(args[0])) if args else sender)
+        elif address == "/vmeter/unsubscribe":
+            self.unsubscribe((sender[0], int(args[0])) if args else sender)
+        else:
+            raise ValueError("Unknown command %s" % address)
+        return None
+
+    #
+    # RUNNING
+    #
+
+    def tick(self):
+        """
+        One round: read the VMeter, publish its events, run commands.
+        Returns a true value if there was anything to do.
+        """
+        busy = self.vmeter.dispatch()
+        if self._pending:
+            self.publish()
+        return self.receive() or busy
+
+    def start(self, adaptive=True, min_interval=.001, max_interval=.02):
+        if self.thread is None:
+            if adaptive:
+                self.thread = AdaptiveThread(self.tick,
+                                             min_interval=min_interval,
+                                             max_interval=max_interval,
+                                             name="Bridge")
+            else:
+                self.thread = IntervalThread(self.tick, min_interval,
+                                             name="Bridge")
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.thread.stop()
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        self.socket.close()
+
+    def stats(self):
+        return {"events": self.events,
+                "bundles": self.bundles,
+                "datagrams": self.datagrams,
+                "send_drops": self.send_drops,
+                "queue_drops": self.queue_drops,
+                "commands": self.commands,
+                "bad_commands": self.bad_commands,
+                "coalesced": self.coalesced,
+                "subscribers": len(self.subscribers)}
+
+def _address(text):
+    host, port = text.rsplit(":", 1)
+    return host, int(port)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="VMeter OSC/UDP bridge")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--subscribe", action="append", default=[],
+                        type=_address, metavar="HOST:PORT",
+                        help="send events to HOST:PORT (repeatable)")
+    args = parser.parse_args(argv)
+
+    v = VMeter(reader=False)
+    v.set_output_on_off(True)
+    v.set_output_pressure(True)
+    bridge = Bridge(v, args.host, args.port, args.subscribe)
+    print "Bridging %s on %s:%d" % (v.device_name, args.host, bridge.address[1])
+    bridge.start()
+    try:
+        while True:
+            bridge.thread.join(1.0)
+    except KeyboardInterrupt:
+        pass
+    bridge.close()
+    v.close()
+    print bridge.stats()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
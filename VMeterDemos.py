@@ -6,7 +6,6 @@
 #
 
 from VMeter import VMeter
-from pygame import pypm
 from datetime import datetime
 
 vMeter = VMeter()
@@ -25,8 +24,8 @@ def binary_clock():
                  0,0,0,0,0,0,0,0]
     update_time = 0
     while True:
-        if pypm.Time() - last_cycle_time > 500:
-            last_cycle_time = pypm.Time()
+        if vMeter.backend.time() - last_cycle_time > 500:
+            last_cycle_time = vMeter.backend.time()
             led_array[11] = update_time # marker for minutes, just blinks with seconds
             led_array[16] = update_time # marker for minutes, just blinks with seconds
             led_array[26] = update_time # marker for hours, just blinks with seconds
@@ -98,9 +97,9 @@ def binary_counter():
                  0,0,0,0,0,0,0,0]
     
     while True:
-        if pypm.Time() - last_cycle_time > 30:
+        if vMeter.backend.time() - last_cycle_time > 30:
             ##            print "cycle"
-            last_cycle_time = pypm.Time()
+            last_cycle_time = vMeter.backend.time()
             temp_counter = counter
             counter = counter + 1
             for i in range(20):
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Grayscale LEDs through temporal dithering.
+
+    fb = GrayFramebuffer(vMeter, rate=400, steps=16)
+    fb.set([i * 127 // 37 for i in range(38)])     # a gradient
+    fb.start()
+    ...
+    print fb.stats()
+
+Individual LEDs are only on or off (see VMeter.send_array), so each LED's
+level (0-127) is quantized to one of steps + 1 gray steps and spread over a
+cycle of steps binary frames, which are sent over and over at rate frames
+per second. With SIGMA_DELTA the on-frames of an LED are spread evenly over
+the cycle (least flicker); with PWM they come in one run (fewest changes,
+so fewest messages through the diffed send_packed()).
+
+The cycle is precomputed whenever the levels change. If the link can't
+keep up (frames late or piling up in the output queue), the number of
+gray steps is halved, down to min_steps, which keeps the cycle short
+enough not to flicker at the rate actually reached; steps come back once
+it keeps up again.
+"""
+
+import threading
+import time
+from collections import deque
+
+from VMeter import LedFrame, NUM_LEDS
+
+SIGMA_DELTA = 1
+PWM = 2
+
+class GrayFramebuffer(threading.Thread):
+    """
+    Levels (0-127) for each of the 38 LEDs, refreshed on a VMeter by
+    dithering.
+    """
+
+    def __init__(self, vmeter, rate=400, steps=16, min_steps=2,
+                 mode=SIGMA_DELTA, name="GrayFramebuffer"):
+        threading.Thread.__init__(self)
+        self.name = name
+        self.setDaemon(True)
+        self.killed = False
+        self.vmeter = vmeter
+        self.rate = rate
+        self.max_steps = steps
+        self.steps = steps
+        self.min_steps = min_steps
+        self.mode = mode
+
+        self._lock = threading.Lock()
+        self.levels = [0] * NUM_LEDS
+        self._cycle = None
+
+        self.frames = 0
+        self.late = 0
+        self.degraded = 0
+        self.recovered = 0
+        self._send_times = deque(maxlen=256)
+
+    #
+    # LEVELS
+    #
+
+    def set(self, levels):
+        """
+        Sets all 38 levels.
+        """
+        if len(levels) != NUM_LEDS:
+            raise ValueError("Need %d levels" % NUM_LEDS)
+        self._lock.acquire()
+        try:
+            self.levels = [min(max(int(level), 0), 127) for level in levels]
+            self._cycle = None
+        finally:
+            self._lock.release()
+
+    def set_led(self, index, level):
+        levels = list(self.levels)
+        levels[index] = level
+        self.set(levels)
+
+    def fill(self, level):
+        self.set([level] * NUM_LEDS)
+
+    def cycle(self):
+        """
+        The packed frames of one dithering cycle for the current levels.
+        """
+        self._lock.acquire()
+        try:
+            if self._cycle is None:
+                self._cycle = self._build(self.levels, self.steps)
+            return self._cycle
+        finally:
+            self._lock.release()
+
+    def _build(self, levels, steps):
+        # gray step of each LED, 0 (off) to steps (always on)
+        quantized = [(level * steps + 63) // 127 for level in levels]
+        if not [q for q in quantized if 0 < q < steps]:
+            # nothing to dither
+            return [LedFrame.pack(self._mask(quantized, steps, 0, None))]
+
+        if self.mode == PWM:
+            return [LedFrame.pack(self._mask(quantized, steps, frame, None))
+                    for frame in range(steps)]
+
+        # first-order sigma-delta, each LED starting at its own phase so
+        # that they don't all switch in the same frames
+        error = [(i * 7) % steps for i in range(NUM_LEDS)]
+        return [LedFrame.pack(self._mask(quantized, steps, frame, error))
+                for frame in range(steps)]
+
+    def _mask(self, quantized, steps, frame, error):
+        mask = 0
+        for i, q in enumerate(quantized):
+            if error is None:
+                on = frame < q
+            else:
+                error[i] += q
+                on = error[i] >= steps
+                if on:
+                    error[i] -= steps
+            if on:
+                mask |= 1 << i
+        return mask
+
+    #
+    # REFRESH
+    #
+
+    def degrade(self):
+        """
+        Halves the gray steps, if above min_steps.
+        """
+        self._lock.acquire()
+        try:
+            if self.steps // 2 < self.min_steps:
+                return False
+            self.steps //= 2
+            self._cycle = None
+            self.degraded += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def recover(self):
+        """
+        Doubles the gray steps, up to the steps asked for.
+        """
+        self._lock.acquire()
+        try:
+            if self.steps * 2 > self.max_steps:
+                return False
+            self.steps *= 2
+            self._cycle = None
+            self.recovered += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def _falling_behind(self):
+        writer = self.vmeter.writer
+        return writer is not None and writer.pending() > 2
+
+    def run(self):
+        period = 1.0 / self.rate
+        next_time = time.time()
+        index = 0
+        # the link is judged every quarter second: frame slots and late (or
+        # skipped) frames in the current window, and good windows in a row
+        window = max(self.rate // 4, 8)
+        sent = late = 0
+        good_windows = 0
+
+        while not self.killed:
+            next_time += period
+            sent += 1
+            if self._falling_behind():
+                # the output queue is backed up: skip this frame rather than
+                # queue it, the cycle just takes longer
+                self.late += 1
+                late += 1
+            else:
+                cycle = self.cycle()
+                if index >= len(cycle):
+                    index = 0
+                self.vmeter.send_packed(cycle[index])
+                index += 1
+                self.frames += 1
+                self._send_times.append(time.time())
+
+            now = time.time()
+            if now > next_time + period:
+                # don't try to catch up with a burst
+                self.late += 1
+                late += 1
+                next_time = now
+            else:
+                delay = next_time - now
+                if delay > 0:
+                    time.sleep(delay)
+
+            if sent >= window:
+                if late * 8 > sent:
+                    good_windows = 0
+                    self.degrade()
+                else:
+                    good_windows += 1
+                    if good_windows >= 16:
+                        # kept up for about 4 seconds
+                        good_windows = 0
+                        self.recover()
+                sent = late = 0
+
+    def stop(self):
+        self.killed = True
+
+    def refresh_rate(self):
+        """
+        Frames per second sent over the last (up to) 256 frames.
+        """
+        times = self._send_times
+        if len(times) < 2 or times[-1] == times[0]:
+            return 0.0
+        return (len(times) - 1) / (times[-1] - times[0])
+
+    def stats(self):
+        rate = self.refresh_rate()
+        return {"frames": self.frames,
+                "late": self.late,
+                "refresh_rate": rate,
+                "cycle_rate": rate / max(len(self.cycle()), 1),
+                "steps": self.steps,
+                "degraded": self.degraded,
+                "recovered": self.recovered}
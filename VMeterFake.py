@@ -0,0 +1,352 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+In-memory MIDI backend emulating VMeters, for tests and benchmarks that
+should run without hardware.
+
+    backend = FakeBackend()
+    v = VMeter(backend=backend)
+    backend.devices[0].touch(64)
+
+FakeVMeter follows the protocol described in VMeter.py: it tracks config
+changes and controller mappings, keeps the LED state from column and
+aftertouch input, echoes Ctrl #118, answers get_version() and
+read_settings(), and turns touch()/release() calls into the enabled
+on/off, position and pressure output.
+"""
+
+import time
+from collections import deque
+
+from VMeter import Backend, LedFrame, LED_STATUS
+from VMeter import CONTROL, CTRL_ECHO, CTRL_CONFIG, CTRL_VERSION, CTRL_SETTINGS
+
+# config value (sent over Ctrl #119) -> (flag, state)
+_CONFIG_FLAGS = {
+    120: ("output_on_off", True), 119: ("output_on_off", False),
+    124: ("output_touch_position", True), 123: ("output_touch_position", False),
+    122: ("output_pressure", True), 121: ("output_pressure", False),
+    125: ("upside_down", True), 126: ("upside_down", False),
+    107: ("leds_ignore_touch", True), 106: ("leds_ignore_touch", False),
+    117: ("note_on_off", True), 116: ("note_on_off", False),
+    115: ("pitch_wheel", True), 114: ("pitch_wheel", False),
+    105: ("cross_fader", True), 104: ("cross_fader", False),
+    111: ("noteout_velocity_mode", True), 110: ("noteout_velocity_mode", False),
+    109: ("noteout_pitch_mode", True), 108: ("noteout_pitch_mode", False),
+}
+
+# controller number -> setting, for the set_*_ctrl style setters
+_CONTROLLER_SETTINGS = {
+    117: "midi_channel",
+    116: "ctrl_out_touch_pos",
+    115: "ctrl_out_on_off",
+    114: "ctrl_out_pressure",
+    113: "ctrl_in_light",
+    112: "ctrl_in_brightness",
+    111: "noteout_number",
+    110: "noteout_velocity",
+}
+
+class FakeVMeter(object):
+    """
+    The state of one emulated VMeter.
+    """
+
+    def __init__(self, backend, name="VMeter 1.0", version="1040"):
+        self.backend = backend
+        self.name = name
+        self.version = version
+
+        self.output_on_off = False
+        self.output_touch_position = True
+        self.output_pressure = False
+        self.upside_down = False
+        self.leds_ignore_touch = False
+        self.note_on_off = False
+        self.pitch_wheel = False
+        self.cross_fader = False
+        self.noteout_velocity_mode = False
+        self.noteout_pitch_mode = False
+
+        self.midi_channel = 1
+        self.ctrl_out_touch_pos = 20
+        self.ctrl_out_on_off = 17
+        self.ctrl_out_pressure = 18
+        self.ctrl_in_light = 20
+        self.ctrl_in_brightness = 21
+        self.noteout_number = 64
+        self.noteout_velocity = 100
+        self.brightness = 127
+        self.sensitivity = 64
+        self.return_speed = 0
+
+        # added to the timestamps of messages sent to the host, in ms
+        self.latency = 0
+
+        self.leds = 0
+        self.touching = False
+        self.stores = 0
+        self.recalibrations = 0
+
+        # messages waiting to be read by the host, as pypm events
+        self.pending = deque()
+
+        # everything received from the host, as (time, status, data1, data2)
+        self.received = deque(maxlen=4096)
+        self.messages = 0
+
+        # optional callable(status, data1, data2), called for every message
+        # received from the host
+        self.listener = None
+
+        # False while unplugged, see FakeBackend.unplug()
+        self.plugged = True
+
+    #
+    # HOST -> DEVICE
+    #
+
+    def receive(self, status, data1, data2):
+        self.messages += 1
+        self.received.append((self.backend.time(), status, data1, data2))
+        if self.listener is not None:
+            self.listener(status, data1, data2)
+
+        if status in LED_STATUS:
+            self._set_led_bytes(LED_STATUS.index(status), data1, data2)
+        elif status == CONTROL and data1 == CTRL_ECHO:
+            self.send(CONTROL, CTRL_ECHO, data2)
+        elif status == CONTROL and data1 == CTRL_CONFIG:
+            self._config(data2)
+        elif status == CONTROL and data1 in _CONTROLLER_SETTINGS:
+            setattr(self, _CONTROLLER_SETTINGS[data1], data2)
+        elif status == self.status():
+            if data1 == self.ctrl_in_light:
+                self.leds = LedFrame.height(data2, self.upside_down)
+            elif data1 == self.ctrl_in_brightness:
+                self.brightness = data2
+
+    def _set_led_bytes(self, pair, data1, data2):
+        shift = 14 * pair
+        bits = (data1 & 0x7F | (data2 & 0x7F) << 7) << shift
+        self.leds = (self.leds & ~(0x3FFF << shift) | bits) & LedFrame.ALL
+
+    def _config(self, value):
+        if value in _CONFIG_FLAGS:
+            flag, state = _CONFIG_FLAGS[value]
+            setattr(self, flag, state)
+        elif value == 103:
+            for c in self.version:
+                self.send(CONTROL, CTRL_VERSION, ord(c))
+        elif value == 113:
+            for byte in self.settings_bytes():
+                self.send(CONTROL, CTRL_SETTINGS, byte)
+        elif value == 118:
+            self.stores += 1
+        elif value == 112:
+            self.recalibrations += 1
+
+    def settings_bytes(self):
+        """
+        The 16 byte settings dump, see VMeter.read_settings().
+        """
+        return [85,
+                self.output_pressure << 3 | self.output_on_off << 2 |
+                self.output_touch_position << 1 | self.upside_down,
+                self.cross_fader << 5 | self.noteout_pitch_mode << 4 |
+                self.noteout_velocity_mode << 3 | self.leds_ignore_touch << 2 |
+                self.note_on_off << 1 | self.pitch_wheel,
+                self.ctrl_out_touch_pos,
+                self.ctrl_out_on_off,
+                self.ctrl_out_pressure,
+                self.ctrl_in_light,
+                self.ctrl_in_brightness,
+                self.noteout_number,
+                self.noteout_velocity,
+                self.brightness,
+                self.midi_channel - 1,
+                0,
+                5,
+                self.sensitivity,
+                self.return_speed]
+
+    #
+    # DEVICE -> HOST
+    #
+
+    def status(self):
+        return CONTROL | (self.midi_channel - 1)
+
+    def send(self, status, data1, data2):
+        self.pending.append([[status, data1, data2, 0],
+                             self.backend.time() + self.latency])
+
+    def touch(self, position, pressure=64):
+        """
+        Simulates a finger at position (0-127) with given pressure.
+        """
+        status = self.status()
+        if not self.touching:
+            self.touching = True
+            if self.output_on_off:
+                self.send(status, self.ctrl_out_on_off, 127)
+        if self.output_touch_position:
+            self.send(status, self.ctrl_out_touch_pos, position)
+        if self.output_pressure:
+            self.send(status, self.ctrl_out_pressure, pressure)
+        if not self.leds_ignore_touch:
+            self.leds = LedFrame.height(position, self.upside_down)
+
+    def release(self):
+        if self.touching:
+            self.touching = False
+            if self.output_on_off:
+                self.send(self.status(), self.ctrl_out_on_off, 0)
+
+    def swipe(self, start=0, end=127, pressure=64):
+        """
+        Simulates a touch moving from start to end, then a release.
+        """
+        step = 1 if end >= start else -1
+        for position in range(start, end + step, step):
+            self.touch(position, pressure)
+        self.release()
+
+    def led_array(self):
+        return LedFrame.to_array(self.leds)
+
+class FakePort(object):
+    def __init__(self, device, info=None, backend=None):
+        self.device = device
+        self.info = info
+        self.backend = backend
+        self.generation = backend.generation if backend is not None else 0
+        self.closed = False
+
+    def _check(self):
+        # like a PortMidi stream after the device went away or the
+        # library was restarted
+        if self.closed:
+            raise IOError("Port closed")
+        if not self.device.plugged:
+            raise IOError("Device unplugged")
+        if self.backend is not None and self.backend.generation != self.generation:
+            raise IOError("Port belongs to a previous device scan")
+
+    def Close(self):
+        self.closed = True
+        if self.info is not None:
+            self.info[4] = 0
+
+class FakeInput(FakePort):
+    def Poll(self):
+        self._check()
+        return len(self.device.pending) > 0
+
+    def Read(self, length):
+        self._check()
+        pending = self.device.pending
+        events = []
+        while pending and len(events) < length:
+            events.append(pending.popleft())
+        return events
+
+class FakeOutput(FakePort):
+    def __init__(self, device, info=None, backend=None):
+        FakePort.__init__(self, device, info, backend)
+        self.writes = 0
+
+    def Write(self, data):
+        self._check()
+        if len(data) > 1024:
+            raise IndexError("maximum list length is 1024")
+        self.writes += 1
+        receive = self.device.receive
+        for (status, data1, data2), timestamp in data:
+            receive(status, data1, data2)
+
+    def WriteShort(self, status, data1, data2):
+        self._check()
+        self.writes += 1
+        self.device.receive(status, data1, data2)
+
+class FakeBackend(Backend):
+    """
+    Backend with count emulated VMeters, each an input and an output device.
+
+    The clock is manual (see advance()) so runs are deterministic;
+    pass real_time=True to follow the wall clock instead.
+
+    unplug() and replug() simulate hot-plugging; like PortMidi, the device
+    list only changes on rescan(), which also invalidates all open ports.
+    A replugged device is listed in its old place.
+
+    Devices are named "VMeter 1.0 #1", "VMeter 1.0 #2", ... unless name is
+    given, which they then all share, like strips of the same model.
+    """
+
+    def __init__(self, count=1, real_time=False, name=None):
+        self.real_time = real_time
+        self.now = 0
+        self._start = time.time()
+        self.generation = 0
+
+        self.devices = []
+        for i in range(count):
+            self.devices.append(FakeVMeter(self, name=name or
+                                           "VMeter 1.0 #%d" % (i + 1)))
+        self._scan()
+
+    def _scan(self):
+        # device number -> [interface, name, input, output, opened, device]
+        self._info = []
+        for device in self.devices:
+            if device.plugged:
+                self._info.append(["Fake", device.name, 1, 0, 0, device])
+                self._info.append(["Fake", device.name, 0, 1, 0, device])
+
+    def count_devices(self):
+        return len(self._info)
+
+    def get_device_info(self, device):
+        return tuple(self._info[device][:5])
+
+    def open_input(self, device):
+        info = self._info[device]
+        if not info[2]:
+            raise Exception("Device %d is not an input" % device)
+        info[4] = 1
+        return FakeInput(info[5], info, self)
+
+    def open_output(self, device):
+        info = self._info[device]
+        if not info[3]:
+            raise Exception("Device %d is not an output" % device)
+        info[4] = 1
+        return FakeOutput(info[5], info, self)
+
+    def time(self):
+        if self.real_time:
+            return int((time.time() - self._start) * 1000)
+        return self.now
+
+    def advance(self, ms):
+        self.now += ms
+
+    def rescan(self):
+        # PortMidi must not be restarted under open streams
+        if [info for info in self._info if info[4]]:
+            raise IOError("Rescanning with ports still open")
+        self.generation += 1
+        self._scan()
+
+    def unplug(self, index=0):
+        self.devices[index].plugged = False
+
+    def replug(self, index=0):
+        device = self.devices[index]
+        device.plugged = True
+        # a freshly plugged strip starts from its stored state
+        device.pending.clear()
+        device.leds = 0
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Round-trip latency probe for a VMeter, using the echo controller (Ctrl #118).
+
+    probe = LatencyProbe(vMeter, rate=20)
+    probe.start()
+    ...
+    print probe.stats()
+
+Each ping sends a tag (0-127) to be echoed back. Send times and reply
+timestamps both come from the backend clock (pypm.Time()), so the round
+trip includes USB, the device and host scheduling, but not the time the
+reply spent waiting to be read. Nothing is drawn on the strip.
+"""
+
+import threading
+from bisect import bisect_right
+from collections import deque
+
+from VMeter import IntervalThread
+
+# upper bounds (ms) of the histogram buckets; the last bucket is open-ended
+BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+class LatencyProbe(object):
+    """
+    Sends tagged echo messages at rate per second and keeps the round-trip
+    times (ms) of the last window replies.
+
+    Pings not answered within timeout ms are counted as lost.
+    """
+
+    def __init__(self, vmeter, rate=10, window=256, timeout=1000):
+        self.vmeter = vmeter
+        self.rate = rate
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._outstanding = {}
+        self._tag = 0
+        self._last_rtt = None
+        self.thread = None
+
+        self.rtts = deque(maxlen=window)
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.unmatched = 0
+        # smoothed mean deviation between consecutive round trips (RFC 3550)
+        self.jitter = 0.0
+
+        vmeter.on_echo(self._reply)
+
+    def start(self):
+        self.stop()
+        self.thread = IntervalThread(self.ping, 1.0 / self.rate,
+                                     name="LatencyProbe")
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.thread.stop()
+            self.thread.join()
+            self.thread = None
+
+    def ping(self):
+        """
+        Sends one tagged echo.
+        """
+        now = self.vmeter.backend.time()
+        self._lock.acquire()
+        try:
+            outstanding = self._outstanding
+            for tag, sent_at in outstanding.items():
+                if now - sent_at > self.timeout:
+                    del outstanding[tag]
+                    self.lost += 1
+
+            tag = self._tag
+            self._tag = (tag + 1) % 128
+            if tag in outstanding:
+                # wrapped around before the reply came back
+                self.lost += 1
+            outstanding[tag] = now
+            self.sent += 1
+        finally:
+            self._lock.release()
+
+        self.vmeter.echo(tag)
+
+    def _reply(self, tag):
+        # reader thread
+        timestamp = self.vmeter.timestamp
+        self._lock.acquire()
+        try:
+            sent_at = self._outstanding.pop(tag, None)
+            if sent_at is None:
+                self.unmatched += 1
+                return
+
+            rtt = max(timestamp - sent_at, 0)
+            self.rtts.append(rtt)
+            self.received += 1
+            if self._last_rtt is not None:
+                self.jitter += (abs(rtt - self._last_rtt) - self.jitter) / 16.0
+            self._last_rtt = rtt
+        finally:
+            self._lock.release()
+
+    def histogram(self):
+        """
+        Returns [(upper bound in ms, count), ...] over the current window;
+        the last bound is None (everything above BUCKETS[-1]).
+        """
+        counts = [0] * (len(BUCKETS) + 1)
+        for rtt in list(self.rtts):
+            counts[bisect_right(BUCKETS, rtt - 1)] += 1
+        return zip(BUCKETS + (None,), counts)
+
+    def stats(self):
+        """
+        Returns a dict with ping counts and min/mean/p50/p99/max round trip
+        and jitter (ms) over the current window.
+        """
+        rtts = sorted(self.rtts)
+        result = {"sent": self.sent,
+                  "received": self.received,
+                  "lost": self.lost,
+                  "unmatched": self.unmatched,
+                  "jitter": self.jitter}
+        if rtts:
+            n = len(rtts)
+            result.update({"min": rtts[0],
+                           "mean": sum(rtts) / float(n),
+                           "p50": rtts[int(round(.5 * (n - 1)))],
+                           "p99": rtts[int(round(.99 * (n - 1)))],
+                           "max": rtts[-1]})
+        return result
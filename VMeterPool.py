@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Many VMeters served by a single reader thread.
+
+    pool = VMeterPool()
+
+    def touched(vmeter, position):
+        vmeter.draw_bar(position, 3)
+
+    pool.on_touch(touched)
+
+Every VMeter found is opened without a reader thread of its own; the pool's
+reader polls all of their inputs in turn, backing off while all of them are
+idle. Handlers registered on the pool get the VMeter an event came from as
+their first argument. Each VMeter keeps its own output (and, with
+threaded_output, its own output queue).
+"""
+
+from VMeter import VMeter, AdaptiveThread, IntervalThread
+from VMeter import get_registry
+
+def find_vmeters(backend=None):
+    """
+    Returns [(name, input device, output device), ...] for the unopened
+    VMeters, pairing each input with an output of the same name.
+    """
+    return get_registry(backend).pairs()
+
+class VMeterPool(object):
+    """
+    Opens every VMeter found and reads all of them from one thread.
+
+    Options not listed here are passed on to each VMeter.
+    """
+
+    def __init__(self, backend=None, adaptive=True, min_interval=.001,
+                 max_interval=.02, threaded_output=True, **options):
+        self.registry = get_registry(backend)
+        self.backend = backend = self.registry.backend
+
+        self.vmeters = []
+        self.names = {}
+        for name, input_device, output_device in find_vmeters(backend):
+            v = VMeter(input_device, output_device, backend=backend,
+                       reader=False, threaded_output=threaded_output,
+                       **options)
+            self.vmeters.append(v)
+            self.names[v] = name
+
+        if adaptive:
+            self.reader = AdaptiveThread(self.dispatch,
+                                         min_interval=min_interval,
+                                         max_interval=max_interval,
+                                         name="PoolReader")
+        else:
+            self.reader = IntervalThread(self.dispatch, interval=min_interval,
+                                         name="PoolReader")
+        self.reader.start()
+
+    def __len__(self):
+        return len(self.vmeters)
+
+    def __iter__(self):
+        return iter(self.vmeters)
+
+    def dispatch(self):
+        """
+        Dispatches pending events of every VMeter.
+        Returns a true value if any of them had something to do.
+        """
+        busy = 0
+        for v in self.vmeters:
+            if v.dispatch():
+                busy += 1
+        return busy
+
+    #
+    # EVENTING
+    #
+
+    def on_touch(self, handler, **options):
+        """
+        Register handler(vmeter, touch_position) on every VMeter.
+        See VMeter.register() for options.
+        """
+        for v in self.vmeters:
+            v.on_touch(lambda data, v=v: handler(v, data), **options)
+
+    def on_pressure(self, handler, **options):
+        """
+        Register handler(vmeter, pressure_strength) on every VMeter.
+        """
+        for v in self.vmeters:
+            v.on_pressure(lambda data, v=v: handler(v, data), **options)
+
+    def on_touch_start(self, handler, **options):
+        """
+        Register handler(vmeter) on every VMeter.
+        """
+        for v in self.vmeters:
+            v.on_touch_start(lambda v=v: handler(v), **options)
+
+    def on_touch_end(self, handler, **options):
+        """
+        Register handler(vmeter) on every VMeter.
+        """
+        for v in self.vmeters:
+            v.on_touch_end(lambda v=v: handler(v), **options)
+
+    #
+    # CONNECTION
+    #
+
+    def stop(self):
+        if self.reader.is_alive():
+            self.reader.stop()
+            self.reader.join()
+        for v in self.vmeters:
+            v.stop()
+
+    def close(self):
+        self.stop()
+        for v in self.vmeters:
+            v.close()
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Declarative VMeter settings.
+
+    profile = Profile.load("stage.json")
+    profile.apply(vMeter)
+
+A profile lists the settings it cares about, by their Settings attribute
+names; everything else is left as it is on the device:
+
+    {"output_on_off": true, "output_pressure": true,
+     "midi_channel": 2, "ctrl_out_touch_pos": 30, "brightness": 63}
+
+Applying compares the profile with the device's current settings and sends
+only the differences, in one batch, storing them in flash only if
+something changed (see VMeter.configure()).
+"""
+
+import json
+
+from VMeter import Settings
+
+class Profile(object):
+    """
+    A set of setting values, see Settings for the names.
+    """
+
+    def __init__(self, **values):
+        self.values = {}
+        self.update(values)
+
+    def update(self, values):
+        """
+        Adds or replaces values, checking them against Settings.
+        """
+        for name in values:
+            if name in Settings.VALUES and name != "brightness":
+                raise ValueError("%s can't be changed" % name)
+        Settings(**values).validate()
+        self.values.update(values)
+
+    @staticmethod
+    def from_settings(settings):
+        """
+        A profile with every changeable value of settings.
+        """
+        return Profile(**dict((name, getattr(settings, name))
+                              for name in Settings.PERSISTED))
+
+    @staticmethod
+    def load(path):
+        f = open(path)
+        try:
+            values = json.load(f)
+        finally:
+            f.close()
+        return Profile(**dict((str(name), value) for name, value in values.items()))
+
+    def save(self, path):
+        f = open(path, "w")
+        try:
+            json.dump(self.values, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    def diff(self, settings):
+        """
+        Returns {name: (current value, profile value)} for the values that
+        differ from settings.
+        """
+        return dict((name, (getattr(settings, name), value))
+                    for name, value in self.values.items()
+                    if getattr(settings, name) != value)
+
+    def apply(self, vmeter, store=True, timeout=1.0):
+        """
+        Brings vmeter to this profile, see VMeter.configure().
+        Returns the number of messages sent.
+        """
+        return vmeter.configure(self.values, store, timeout)
+
+    def __eq__(self, other):
+        return isinstance(other, Profile) and self.values == other.values
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Profile(%s)" % ", ".join("%s=%r" % item
+                                         for item in sorted(self.values.items()))
+
+def deploy(vmeters, profile, store=True, timeout=1.0):
+    """
+    Applies profile to every VMeter (e.g. a VMeterPool).
+    Returns the total number of messages sent.
+    """
+    return sum(profile.apply(v, store, timeout) for v in vmeters)
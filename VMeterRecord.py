@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Recording and replay of raw VMeter input.
+
+    recorder = EventRecorder("swipes.vmr")
+    recorder.attach(vMeter)
+    ...
+    recorder.close()
+
+    replay(otherVMeter, "swipes.vmr", speed=2.0)
+
+File format: the 5 byte header "VMRC" + version, then one 7 byte record per
+event: timestamp (ms, unsigned 32 bit little-endian), status, data1, data2.
+Records are packed into a fixed-size buffer and written out whenever it
+fills up, so recording runs in constant memory however long it goes.
+"""
+
+import struct
+import threading
+import time
+
+MAGIC = "VMRC"
+VERSION = 1
+
+_HEADER = struct.Struct("<4sB")
+_RECORD = struct.Struct("<IBBB")
+
+class EventRecorder(object):
+    """
+    Writes (timestamp, status, data1, data2) records to path.
+    """
+
+    def __init__(self, path, buffer_size=4096):
+        self.path = path
+        self.records = 0
+        self._lock = threading.Lock()
+        self._buffer = bytearray(_RECORD.size * buffer_size)
+        self._used = 0
+        self._vmeter = None
+
+        self._file = open(path, "wb")
+        self._file.write(_HEADER.pack(MAGIC, VERSION))
+
+    def attach(self, vmeter):
+        """
+        Starts recording everything vmeter dispatches.
+        """
+        self._vmeter = vmeter
+        vmeter.recorder = self
+
+    def detach(self):
+        if self._vmeter is not None:
+            if self._vmeter.recorder is self:
+                self._vmeter.recorder = None
+            self._vmeter = None
+
+    def write(self, events):
+        """
+        Appends events in the format returned by VMeter.read_batch().
+        """
+        self._lock.acquire()
+        try:
+            if self._file is None:
+                return
+            buf = self._buffer
+            pack_into = _RECORD.pack_into
+            size = _RECORD.size
+            for midi_data, timestamp in events:
+                if self._used + size > len(buf):
+                    self._flush()
+                pack_into(buf, self._used, timestamp & 0xFFFFFFFF,
+                          midi_data[0], midi_data[1], midi_data[2])
+                self._used += size
+            self.records += len(events)
+        finally:
+            self._lock.release()
+
+    def _flush(self):
+        # called with self._lock held
+        if self._used:
+            self._file.write(memoryview(self._buffer)[:self._used])
+            self._used = 0
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            if self._file is not None:
+                self._flush()
+                self._file.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self.detach()
+        self._lock.acquire()
+        try:
+            if self._file is not None:
+                self._flush()
+                self._file.close()
+                self._file = None
+        finally:
+            self._lock.release()
+
+def read_events(path, chunk=4096):
+    """
+    Yields (timestamp, status, data1, data2) records from a recording,
+    reading chunk records at a time.
+    """
+    f = open(path, "rb")
+    try:
+        magic, version = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a VMeter recording" % path)
+        if version != VERSION:
+            raise ValueError("Unsupported recording version %d" % version)
+
+        size = _RECORD.size
+        unpack_from = _RECORD.unpack_from
+        while True:
+            data = f.read(size * chunk)
+            if not data:
+                break
+            for offset in xrange(0, len(data) - size + 1, size):
+                yield unpack_from(data, offset)
+    finally:
+        f.close()
+
+def replay(vmeter, path, speed=1.0):
+    """
+    Feeds a recording to vmeter.dispatch_events().
+
+    speed 1.0 keeps the original timing, 2.0 plays twice as fast, etc.;
+    speed None plays as fast as possible, in batches of vmeter.batch_size.
+    Returns the number of events replayed.
+    """
+    count = 0
+    batch = []
+    start_time = None
+    start_timestamp = None
+
+    for timestamp, status, data1, data2 in read_events(path):
+        event = [[status, data1, data2, 0], timestamp]
+
+        if speed is None:
+            batch.append(event)
+            if len(batch) >= vmeter.batch_size:
+                vmeter.dispatch_events(batch)
+                count += len(batch)
+                batch = []
+            continue
+
+        if start_time is None:
+            start_time = time.time()
+            start_timestamp = timestamp
+        due = start_time + (timestamp - start_timestamp) / 1000.0 / speed
+
+        # events due at the same time go out together, like a real read
+        if batch and due > time.time():
+            vmeter.dispatch_events(batch)
+            count += len(batch)
+            batch = []
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        batch.append(event)
+
+    if batch:
+        vmeter.dispatch_events(batch)
+        count += len(batch)
+
+    return count
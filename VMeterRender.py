@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Vectorized level-meter rendering with NumPy.
+
+    renderer = LevelRenderer(decay=2, peak_hold=30, peak_decay=1)
+    frames = renderer.render(levels)        # levels: 0-127, one per frame
+    vMeter.play(renderer.animation(levels, interval=10))
+
+A whole block of levels, or a block per channel, is turned into packed
+six-byte LED frames (see LedFrame.pack) with array operations only:
+
+- ballistics: instant attack, falling back by at most decay per frame;
+- peak hold: the highest level stays for peak_hold frames, then falls
+  by peak_decay per frame, and is drawn as a single LED above the column.
+
+Both fall-back curves are linear, which turns them into running maxima:
+max over k <= t of (x[k] - d * (t - k)) is cummax(x + d * k)[t] - d * t.
+State is carried from block to block, so rendering a stream in blocks
+gives the same frames as rendering it in one go.
+
+Requires numpy.
+"""
+
+import numpy as np
+
+from VMeter import Animation, LedFrame, NUM_LEDS
+
+def _lookup_tables(upside_down):
+    # packed frame for each LED count (0-38): the column, and its top LED
+    columns = np.zeros((NUM_LEDS + 1, 6), np.uint8)
+    dots = np.zeros((NUM_LEDS + 1, 6), np.uint8)
+    for count in range(NUM_LEDS + 1):
+        mask = LedFrame.column(count)
+        dot = LedFrame.led(count - 1) if count else 0
+        if upside_down:
+            mask = _flip(mask)
+            dot = _flip(dot)
+        columns[count] = LedFrame.pack(mask)
+        dots[count] = LedFrame.pack(dot)
+    return columns, dots
+
+def _flip(mask):
+    return LedFrame.from_array(LedFrame.to_array(mask)[::-1])
+
+def _running_max(values, width):
+    """
+    Maximum of the last width values (fewer at the start), along the last
+    axis, in log2(width) passes.
+    """
+    result = values.copy()
+    span = 1
+    while span < width:
+        step = min(span, width - span)
+        result[..., step:] = np.maximum(result[..., step:], result[..., :-step])
+        span += step
+    return result
+
+class LevelRenderer(object):
+    """
+    Turns blocks of levels (0-127) into packed LED frames.
+
+    decay and peak_decay are in level units per frame; peak_hold is in
+    frames (0 disables the peak LED). State is kept per channel, so
+    render() must always be given the same number of channels.
+    """
+
+    def __init__(self, decay=2.0, peak_hold=30, peak_decay=1.0,
+                 upside_down=False):
+        self.decay = float(decay)
+        self.peak_hold = int(peak_hold)
+        self.peak_decay = float(peak_decay)
+        self.columns, self.dots = _lookup_tables(upside_down)
+        self.reset()
+
+    def reset(self):
+        # displayed level after the last frame
+        self._level = None
+        # the last peak_hold input levels, still holding their peak
+        self._recent = None
+        # the fall-back line of all older levels, after the last frame
+        self._peak = None
+
+    def process(self, levels):
+        """
+        Applies ballistics and peak hold to levels, an array of shape
+        (frames,) or (channels, frames).
+        Returns (displayed levels, peak levels) of the same shape.
+        """
+        x = np.asarray(levels, np.float64)
+        n = x.shape[-1]
+        t = np.arange(n, dtype=np.float64)
+        shape = x.shape[:-1] + (1,)
+
+        # ballistics
+        decay = self.decay
+        level = np.maximum.accumulate(x + decay * t, axis=-1) - decay * t
+        if self._level is not None:
+            level = np.maximum(level, self._level - decay * (t + 1))
+        self._level = level[..., -1:].copy()
+
+        if not self.peak_hold:
+            return level, level
+
+        # peak hold, over the recent levels followed by this block
+        hold = self.peak_hold
+        pd = self.peak_decay
+        recent = self._recent
+        if recent is None:
+            recent = np.zeros(shape[:-1] + (0,))
+        m = recent.shape[-1]
+        z = np.concatenate((recent, x), axis=-1)
+        k = np.arange(m + n, dtype=np.float64)
+
+        held = _running_max(z, hold + 1)[..., m:]
+        line = np.maximum.accumulate(z + pd * k, axis=-1)
+        peak = held
+        # levels older than hold frames: fall back from hold frames on
+        j = np.arange(m, m + n)
+        old = j - hold - 1
+        valid = old >= 0
+        if valid.any():
+            fallen = line[..., old[valid]] - pd * (j[valid] - hold)
+            peak[..., valid] = np.maximum(peak[..., valid], fallen)
+        if self._peak is not None:
+            peak = np.maximum(peak, self._peak - pd * (t + 1))
+
+        # carry the state over to the next block
+        end = m + n - 1
+        carried = self._peak - pd * n if self._peak is not None else None
+        if end - hold >= 0:
+            tail = line[..., end - hold:end - hold + 1] - pd * (end - hold)
+            carried = tail if carried is None else np.maximum(carried, tail)
+        self._peak = carried
+        self._recent = z[..., max(m + n - hold, 0):].copy()
+
+        return level, peak
+
+    def counts(self, levels):
+        """
+        LED counts (0-38) for levels, as LedFrame.height() lights them.
+        """
+        levels = np.clip(np.asarray(levels), 0, 127).astype(np.int64)
+        return (levels * NUM_LEDS + 63) // 127
+
+    def render(self, levels):
+        """
+        Returns packed frames for levels, as an uint8 array of shape
+        (frames, 6) or (channels, frames, 6).
+        """
+        level, peak = self.process(levels)
+        frames = self.columns[self.counts(level)]
+        if self.peak_hold:
+            frames |= self.dots[self.counts(peak)]
+        return frames
+
+    def animation(self, levels, interval=10, **options):
+        """
+        An Animation showing levels (one channel), interval ms per frame.
+        """
+        return Animation(map(tuple, self.render(levels).tolist()),
+                         interval, **options)
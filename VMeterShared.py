@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Shared-memory LED framebuffer, so that several processes can draw on one
+VMeter.
+
+In the process that owns the VMeter:
+
+    owner = SharedOwner(vMeter, "/tmp/vmeter.fb", slots=8)
+    owner.start()
+
+In any other process:
+
+    fb = SharedFramebuffer("/tmp/vmeter.fb")
+    meter = fb.slot(2, priority=10)
+    meter.column(height)
+    meter.mask(LedFrame.bar(64, 5), blend=OVERLAY)
+
+The file holds a header and a fixed number of 16 byte slots, each written
+by one producer: a sequence counter (uint32), mode, priority, column
+height, a pad byte, the six packed LED bytes, and two pad bytes. The
+counter works as a seqlock: it is odd while the producer writes and is
+bumped again when done, so the owner can tell a torn read and retry.
+Producers never talk to the owner. The owner polls the counters (backing
+off while nothing changes), composes the changed picture and sends it
+through send_packed().
+
+Composition goes by priority, lowest first: an OPAQUE slot replaces
+everything below it, an OVERLAY slot adds its LEDs to it. EMPTY slots
+are skipped.
+"""
+
+import mmap
+import os
+import struct
+import threading
+
+from VMeter import AdaptiveThread, LedFrame
+
+MAGIC = "VMSH"
+VERSION = 1
+
+# slot modes
+EMPTY = 0
+PACKED = 1
+COLUMN = 2
+
+# blending
+OPAQUE = 0
+OVERLAY = 1
+
+_HEADER = struct.Struct("<4sBB2x")
+_SLOT = struct.Struct("<IBBBB6s2x")
+_SEQ = struct.Struct("<I")
+
+def _size(slots):
+    return _HEADER.size + slots * _SLOT.size
+
+def _open(path, slots=None):
+    """
+    Maps path, creating (or resetting) it for slots slots if given.
+    Returns (mmap, number of slots).
+    """
+    if slots is not None:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            os.write(fd, _HEADER.pack(MAGIC, VERSION, slots) +
+                     "\0" * (slots * _SLOT.size))
+            return mmap.mmap(fd, _size(slots)), slots
+        finally:
+            os.close(fd)
+
+    fd = os.open(path, os.O_RDWR)
+    try:
+        header = os.read(fd, _HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError("%s is not a shared framebuffer" % path)
+        magic, version, slots = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("%s is not a shared framebuffer" % path)
+        if version != VERSION:
+            raise ValueError("Unsupported framebuffer version %d" % version)
+        return mmap.mmap(fd, _size(slots)), slots
+    finally:
+        os.close(fd)
+
+class SharedFramebuffer(object):
+    """
+    A producer's view of a framebuffer file created by a SharedOwner.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.map, self.slots = _open(path)
+
+    def slot(self, index, priority=0):
+        """
+        Returns slot index (0 to slots - 1) for drawing.
+        Each slot must only be used by one producer at a time.
+        """
+        if not 0 <= index < self.slots:
+            raise IndexError("No slot %d" % index)
+        return Slot(self.map, index, priority)
+
+    def close(self):
+        self.map.close()
+
+class Slot(object):
+    """
+    One producer's frame in the framebuffer.
+    """
+
+    def __init__(self, map, index, priority=0):
+        self.map = map
+        self.offset = _HEADER.size + index * _SLOT.size
+        self.priority = priority
+        self.seq = _SEQ.unpack_from(map, self.offset)[0] & ~1
+
+    def _write(self, mode, height=0, data=(0, 0, 0, 0, 0, 0), blend=OPAQUE):
+        # odd while writing, even again once done
+        seq = self.seq
+        _SEQ.pack_into(self.map, self.offset, (seq + 1) & 0xFFFFFFFF)
+        _SLOT.pack_into(self.map, self.offset, (seq + 1) & 0xFFFFFFFF,
+                        mode, self.priority, height, blend,
+                        struct.pack("6B", *data))
+        self.seq = (seq + 2) & 0xFFFFFFFF
+        _SEQ.pack_into(self.map, self.offset, self.seq)
+
+    def packed(self, data, blend=OPAQUE):
+        """
+        Shows six packed LED bytes, see LedFrame.pack.
+        """
+        self._write(PACKED, 0, data, blend)
+
+    def mask(self, mask, blend=OPAQUE):
+        self._write(PACKED, 0, LedFrame.pack(mask), blend)
+
+    def array(self, array, blend=OPAQUE):
+        self._write(PACKED, 0, LedFrame.pack(LedFrame.from_array(array)), blend)
+
+    def column(self, height, blend=OPAQUE):
+        """
+        Shows a column of height (0-127), drawn with LedFrame.height();
+        only heights 0 and 127 are known to match what the device draws
+        for a column message, the ones in between are a guess.
+        """
+        self._write(COLUMN, height, blend=blend)
+
+    def clear(self):
+        """
+        Empties the slot, showing what is below it.
+        """
+        self._write(EMPTY)
+
+class SharedOwner(object):
+    """
+    Creates the framebuffer file at path and shows its slots on vmeter.
+    """
+
+    def __init__(self, vmeter, path, slots=8, min_interval=.001,
+                 max_interval=.02, retries=8):
+        self.vmeter = vmeter
+        self.path = path
+        self.map, self.slots = _open(path, slots)
+        self.retries = retries
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.thread = None
+        self._lock = threading.Lock()
+
+        self._seqs = [0] * self.slots
+        self._contents = [None] * self.slots
+
+        self.polls = 0
+        self.changes = 0
+        self.torn_reads = 0
+        self.frames = 0
+
+    def _read(self, index):
+        """
+        Returns (seq, slot contents) for a consistent read of slot index,
+        or None if the producer kept writing through all retries.
+        """
+        offset = _HEADER.size + index * _SLOT.size
+        for attempt in range(self.retries):
+            contents = _SLOT.unpack_from(self.map, offset)
+            seq = contents[0]
+            if not seq & 1 and _SEQ.unpack_from(self.map, offset)[0] == seq:
+                return seq, contents[1:]
+            self.torn_reads += 1
+        return None
+
+    def poll(self):
+        """
+        Picks up changed slots and sends the composed frame if any changed.
+        Returns True if something changed.
+        """
+        self._lock.acquire()
+        try:
+            self.polls += 1
+            unpack_seq = _SEQ.unpack_from
+            changed = False
+            for index in range(self.slots):
+                seq = unpack_seq(self.map, _HEADER.size + index * _SLOT.size)[0]
+                if seq == self._seqs[index]:
+                    continue
+                read = self._read(index)
+                if read is None:
+                    # try again on the next poll
+                    continue
+                self._seqs[index], self._contents[index] = read
+                changed = True
+
+            if changed:
+                self.changes += 1
+                self.vmeter.send_packed(self.compose())
+                self.frames += 1
+            return changed
+        finally:
+            self._lock.release()
+
+    def compose(self):
+        """
+        The packed frame for the current slot contents.
+        """
+        upside_down = bool(self.vmeter.upside_down)
+        layers = [(contents[1], index, contents)
+                  for index, contents in enumerate(self._contents)
+                  if contents is not None and contents[0] != EMPTY]
+        layers.sort()
+
+        frame = LedFrame.OFF
+        for priority, index, (mode, _, height, blend, data) in layers:
+            if mode == COLUMN:
+                mask = LedFrame.height(height, upside_down)
+            else:
+                mask = LedFrame.unpack(struct.unpack("6B", data))
+            if blend == OVERLAY:
+                frame |= mask
+            else:
+                frame = mask
+        return LedFrame.pack(frame)
+
+    def start(self):
+        """
+        Starts polling from a thread, backing off while nothing changes.
+        """
+        if self.thread is None:
+            self.thread = AdaptiveThread(self.poll,
+                                         min_interval=self.min_interval,
+                                         max_interval=self.max_interval,
+                                         name="SharedOwner")
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.thread.stop()
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        self.map.close()
+
+    def stats(self):
+        return {"polls": self.polls,
+                "changes": self.changes,
+                "torn_reads": self.torn_reads,
+                "frames": self.frames}